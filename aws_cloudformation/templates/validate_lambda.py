@@ -1,126 +1,226 @@
-import json,logging,threading,boto3
-from botocore.vendored import requests
+import os,sys,json,logging
 import re
-import urllib3
+import metrics
+import retry
+import cfn_response
 CFN_SUCCESS = "SUCCESS"
 CFN_FAILED = "FAILED"
 
-g_return_error = True
-
 def cfn_send(evt, context, responseStatus, respData, reason=''):
-    respUrl = evt['ResponseURL']
-    print(respUrl)
-    respBody = {}
-    respBody['Status'] = responseStatus
-    respBody['Reason'] = reason + '\nSee the details in CloudWatch:' + context.log_group_name + ',' + context.log_stream_name
-    respBody['PhysicalResourceId'] = context.log_stream_name
-    respBody['StackId'] = evt['StackId']
-    respBody['RequestId'] = evt['RequestId']
-    respBody['LogicalResourceId'] = evt['LogicalResourceId']
-    respBody['NoEcho'] = None
-    respBody['Data'] = respData
-
-    json_respBody = json.dumps(respBody)
-    print("Response body:\n" + json_respBody)
-    headers = {'content-type' : '', 'content-length' : str(len(json_respBody)) }
-    try:
-        http = urllib3.PoolManager()
-        response = http.request('PUT', respUrl, headers=headers, body=json_respBody)
-        #response = requests.put(respUrl,data=json_respBody,headers=head    ers)
-        print("Status code: " + response.status)
-    except Exception as e:
-        print("failed executing requests.put(..): " + str(e))
+    if not cfn_response.send(evt, context, responseStatus, respData, reason):
+        logging.error('send response to cloudformation failed')
+
+# Parameter rules, checked in order. Each rule is (id, applies, check, message):
+# 'applies' and 'check' take the normalized parameters, 'message' is formatted
+# with them when the check fails. Regexes are compiled once at import time and
+# nothing is kept between calls, so checks can run concurrently.
+IP_RE = re.compile(r'^(([0-9]|[1-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5]){1}$')
+MAX_INSTANCES = 16
+
+# ResourceProperties name -> (parameter name, type)
+PROPERTIES = [
+    ('FortiWebAsgCapacityBYOL', 'byol_cnt', int),
+    ('FortiWebAsgDesiredCapacityOnDemand', 'asgdc', int),
+    ('FortiWebAsgMinSizeOnDemand', 'asgmin', int),
+    ('FortiWebAsgMaxSizeOnDemand', 'asgmax', int),
+    ('FortiWebAsgScaleInThreshold', 'scaleInTh', int),
+    ('FortiWebAsgScaleOutThreshold', 'scaleOutTh', int),
+    ('AddNewElasticIPorNot', 'eipOpt', str),
+    ('FortiWebElasticIP', 'eip', str),
+]
+
+def always(p):
+    return True
+
+def existing_eip(p):
+    return 'no' == p['eipOpt']
+
+def new_eip(p):
+    return 'no' != p['eipOpt']
+
+RULES = [
+    ('on_demand_not_negative', always,
+        lambda p: p['asgmin'] >= 0 and p['asgmax'] >= 0 and p['asgdc'] >= 0,
+        '(FortiWebAsgMinSizeOnDemand:%(asgmin)d, FortiWebAsgDesiredCapacityOnDemand:%(asgdc)d, FortiWebAsgMaxSizeOnDemand:%(asgmax)d) each should be not less than 0.'),
+    ('byol_not_negative', always,
+        lambda p: p['byol_cnt'] >= 0,
+        'FortiWebAsgCapacityBYOL(%(byol_cnt)d) should be not less than 0.'),
+    ('min_not_above_max', always,
+        lambda p: p['asgmin'] <= p['asgmax'],
+        'FortiWebAsgMinSizeOnDemand(%(asgmin)d) should be less than or equal to FortiWebAsgMaxSizeOnDemand(%(asgmax)d).'),
+    ('desired_not_below_min', always,
+        lambda p: p['asgdc'] >= p['asgmin'],
+        'FortiWebAsgDesiredCapacityOnDemand(%(asgdc)d) should be bigger than or equal to FortiWebAsgMinSizeOnDemand(%(asgmin)d).'),
+    ('desired_not_above_max', always,
+        lambda p: p['asgdc'] <= p['asgmax'],
+        'FortiWebAsgDesiredCapacityOnDemand(%(asgdc)d) should be less than or equal to FortiWebAsgMaxSizeOnDemand(%(asgmax)d).'),
+    ('instance_cap', always,
+        lambda p: p['byol_cnt'] + p['asgmax'] <= MAX_INSTANCES,
+        'Sum of FortiWebAsgCapacityBYOL and FortiWebAsgMaxSizeOnDemand should not bigger than 16.'),
+    ('threshold_order', always,
+        lambda p: p['scaleInTh'] < p['scaleOutTh'],
+        'FortiWebAsgScaleInThreshold(%(scaleInTh)d) should be less than FortiWebAsgScaleOutThreshold(%(scaleOutTh)d).'),
+    ('existing_eip_not_empty', existing_eip,
+        lambda p: len(p['eip']) >= 1,
+        'FortiWebElasticIP(%(eip)s) should not be empty.'),
+    ('existing_eip_is_ip', existing_eip,
+        lambda p: None != IP_RE.match(p['eip']),
+        'FortiWebElasticIP(%(eip)s) should be valid IP address when use existing Elastic IP.'),
+    ('new_eip_name_not_empty', new_eip,
+        lambda p: len(p['eip']) >= 1,
+        'FortiWebElasticIP Name(%(eip)s) should be valid tag value when creating a new Elastic IP.'),
+]
+
+def normalize(rpt):
+    params = {}
+    errors = []
+    for prop, name, conv in PROPERTIES:
+        if prop not in rpt or None == rpt[prop]:
+            errors.append({'rule': 'required', 'parameter': prop, 'message': '%s is required.' % (prop)})
+            continue
+        try:
+            params[name] = conv(rpt[prop])
+        except (TypeError, ValueError):
+            errors.append({'rule': 'type', 'parameter': prop, 'message': '%s(%s) should be a number.' % (prop, rpt[prop])})
+    return params, errors
+
+def check(params):
+    errors = []
+    for rule_id, applies, ok, message in RULES:
+        if applies(params) and not ok(params):
+            errors.append({'rule': rule_id, 'message': message % params})
+    return errors
+
+def validate_properties(rpt):
+    params, errors = normalize(rpt)
+    if len(errors) > 0:
+        return errors
+    return check(params)
+
+def error_message(errors):
+    return ''.join(e['message'] + '\n' for e in errors)
 
 def validate_parameters(byol_cnt, asgdc, asgmin, asgmax, scaleInTh, scaleOutTh, eipOpt, eip):
-    global g_return_error
-    message = ''
-    if asgmin < 0 or asgmax < 0 or asgdc < 0:
-        message = message + '(FortiWebAsgMinSizeOnDemand:%d, FortiWebAsgDesiredCapacityOnDemand:%d, FortiWebAsgMaxSizeOnDemand:%d) each should be not less than 0.\n' % (asgmin, asgdc, asgmax)
-    if byol_cnt < 0:
-        message = message + 'FortiWebAsgCapacityBYOL(%d) should be not less than 0.\n' % (byol_cnt)
-    if (asgmin > asgmax):
-        message = message + 'FortiWebAsgMinSizeOnDemand(%d) should be less than or equal to FortiWebAsgMaxSizeOnDemand(%d).\n' % (asgmin, asgmax)
-    if (asgdc < asgmin):
-        message = message + 'FortiWebAsgDesiredCapacityOnDemand(%d) should be bigger than or equal to FortiWebAsgMinSizeOnDemand(%d).\n' % (asgdc, asgmin)
-    if (asgdc > asgmax):
-        message = message + 'FortiWebAsgDesiredCapacityOnDemand(%d) should be less than or equal to FortiWebAsgMaxSizeOnDemand(%d).\n' % (asgdc, asgmax)
-    if byol_cnt + asgmax > 16:
-        message = message + 'Sum of FortiWebAsgCapacityBYOL and FortiWebAsgMaxSizeOnDemand should not bigger than 16.\n'
-    if (scaleInTh >= scaleOutTh):
-        message = message + 'FortiWebAsgScaleInThreshold(%d) should be less than FortiWebAsgScaleOutThreshold(%d).\n' % (scaleInTh, scaleOutTh)
-    if ('no' == eipOpt):
-        if len(eip) < 1:
-            message = message + 'FortiWebElasticIP(%s) should not be empty.\n' % (eip)
-        ip_expr='^(([0-9]|[1-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5]){1}$'
-        if None == re.match(ip_expr, eip):
-            message = message + 'FortiWebElasticIP(%s) should be valid IP address when use existing Elastic IP.\n' % (eip)
-    if ('no' != eipOpt):
-        if len(eip) < 1:
-            message = message + 'FortiWebElasticIP Name(%s) should be valid tag value when creating a new Elastic IP.\n' % (eip)
-    if (0 != len(message)):
+    params = {'byol_cnt': byol_cnt, 'asgdc': asgdc, 'asgmin': asgmin, 'asgmax': asgmax,
+            'scaleInTh': scaleInTh, 'scaleOutTh': scaleOutTh, 'eipOpt': eipOpt, 'eip': eip}
+    errors = check(params)
+    if len(errors) > 0:
+        message = error_message(errors)
         print('Parameter(s) not valid, see blow:')
         print('%s' % (message))
-    else:
-        g_return_error = False
-        print('parameter valid')
-        message = 'no error'
-    return message
+        return message
+    print('parameter valid')
+    return 'no error'
 
 def delete_objects():
     print("nothing to do")
 
-def timeout(event, context):
-    logging.error('Time out, failure response to CloudFormation')
-    cfn_send(event, context, CFN_FAILED, {}, 'fwb labmda timeout')
-
 def handler(event, context):
-    global g_return_error
-    #initiallize it, because global values may keep last run assigned value
-    g_return_error = True
-    # make sure we send a failure to CloudFormation if the function is going to timeout
-    timer = threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
-    timer.start()
+    metrics.begin('validate_lambda')
+    try:
+        do_handler(event, context)
+    finally:
+        metrics.end()
+
+def do_handler(event, context):
+    # make sure we send a failure to CloudFormation before the function times out
+    retry.begin(context, margin=cfn_response.RESPONSE_TIME)
     print('event: %s' % json.dumps(event))
     print('context:%s' % (str(context)))
-    status = CFN_SUCCESS
+    status = CFN_FAILED
     respData = {}
     err_msg = 'no error'
     rpt = event['ResourceProperties']
     try:
-        byol_cnt = rpt['FortiWebAsgCapacityBYOL']
-        asgdc = rpt['FortiWebAsgDesiredCapacityOnDemand']
-        asgmin = rpt['FortiWebAsgMinSizeOnDemand']
-        asgmax = rpt['FortiWebAsgMaxSizeOnDemand']
-        scaleInTh = rpt['FortiWebAsgScaleInThreshold']
-        scaleOutTh = rpt['FortiWebAsgScaleOutThreshold']
-        FortiWebVersionInternal = rpt['FortiWebVersionShow']
-        eipOpt = rpt['AddNewElasticIPorNot']
-        eip = rpt['FortiWebElasticIP']
-        respData['FortiWebVersionInternal'] = FortiWebVersionInternal.replace('.', '')
+        #keep the dots, without them 10.1.2 and 1.0.12 are the same string
+        respData['FortiWebVersionInternal'] = rpt['FortiWebVersionShow']
         if event['RequestType'] == 'Delete':
             delete_objects()
-            g_return_error = False
+            status = CFN_SUCCESS
         else:
-            err_msg = validate_parameters(int(byol_cnt), int(asgdc), int(asgmin), int(asgmax),
-                            int(scaleInTh), int(scaleOutTh),
-                            eipOpt, eip)
+            with metrics.span('validate'):
+                errors = retry.run_until(validate_properties, rpt)
+            if len(errors) > 0:
+                err_msg = error_message(errors)
+                print('Parameter(s) not valid, see blow:')
+                print('%s' % (err_msg))
+            else:
+                print('parameter valid')
+                status = CFN_SUCCESS
+    except retry.DeadlineExceeded as e:
+        logging.error('Time out, failure response to CloudFormation')
+        err_msg = 'fwb lambda timeout: %s' % (str(e))
+        status = CFN_FAILED
     except Exception as e:
         logging.error('Exception: %s' % (str(e)), exc_info=True)
         err_msg = 'exception: %s' % (str(e))
         status = CFN_FAILED
     finally:
-        timer.cancel()
-        if True == g_return_error:
-            status = CFN_FAILED
+        metrics.current().outcome = status
         cfn_send(event, context, status, respData, err_msg)
 
+# Batch mode: lint many stack parameter sets before deploying.
+#   python3 validate_lambda.py lint envs.jsonl prod.json [--jobs 8]
+# .jsonl files hold one parameter set per line; .json files hold one set, a
+# list of sets, or a CloudFormation parameters file ([{"ParameterKey": ..,
+# "ParameterValue": ..}]). Keys are the validate-lambda ResourceProperties
+# names. One JSON result per set is written to stdout, the exit code is 1 when
+# any set is invalid.
+def as_properties(record):
+    if isinstance(record, list):
+        return dict((p['ParameterKey'], p['ParameterValue']) for p in record)
+    if isinstance(record, dict) and 'Parameters' in record:
+        return as_properties(record['Parameters'])
+    return record
+
+def read_records(path):
+    records = []
+    f = sys.stdin if '-' == path else open(path)
+    try:
+        if path.endswith('.jsonl') or '-' == path:
+            for lineno, line in enumerate(f, 1):
+                if len(line.strip()) > 0:
+                    records.append(('%s:%d' % (path, lineno), line))
+        else:
+            data = json.load(f)
+            if isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict) and 'ParameterKey' not in data[0]:
+                for index, record in enumerate(data):
+                    records.append(('%s[%d]' % (path, index), record))
+            else:
+                records.append((path, data))
+    finally:
+        if f != sys.stdin:
+            f.close()
+    return records
+
+def lint_record(item):
+    source, record = item
+    try:
+        if isinstance(record, str):
+            record = json.loads(record)
+        errors = validate_properties(as_properties(record))
+    except Exception as e:
+        errors = [{'rule': 'parse', 'message': str(e)}]
+    return {'source': source, 'valid': len(errors) <= 0, 'errors': errors}
+
+def lint(paths, jobs=None):
+    records = []
+    for path in paths:
+        records.extend(read_records(path))
+    jobs = jobs or os.cpu_count() or 1
+    if jobs <= 1 or len(records) < 2 * jobs:
+        return [lint_record(r) for r in records]
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(lint_record, records, chunksize=max(1, len(records) // (jobs * 4)))
+
 class fake_ctx(object):
     def __init__(self):
         pass
     def get_remaining_time_in_millis(self):
         return 100000
 
-if __name__ == "__main__":
+def local_run():
     print('hello')
     rpt = {}
     rpt['FortiWebAsgCapacityBYOL'] = 0
@@ -138,3 +238,21 @@ if __name__ == "__main__":
     ctx = fake_ctx()
     handler(event, ctx)
 
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='FortiWeb autoscale stack parameter validation')
+    sub = parser.add_subparsers(dest='command')
+    lint_parser = sub.add_parser('lint', help='validate parameter sets from JSON / JSONL files')
+    lint_parser.add_argument('paths', nargs='+', help='.json / .jsonl files, - for JSONL on stdin')
+    lint_parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: cpu count)')
+    args = parser.parse_args(argv)
+    if 'lint' != args.command:
+        local_run()
+        return 0
+    results = lint(args.paths, args.jobs)
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+    return 0 if all(r['valid'] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
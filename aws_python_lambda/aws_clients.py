@@ -0,0 +1,102 @@
+##python3
+# Shared AWS client / HTTP pool registry for the python lambdas.
+# Clients are built lazily on first use and kept in module globals, so a warm
+# lambda container reuses endpoint resolution, credentials and TLS connections
+# across invocations instead of paying for them on every call.
+#
+# Tuning (environment variables):
+#   AWS_CLIENT_MAX_POOL        max connections per client / http pool (default 10)
+#   AWS_CLIENT_CONNECT_TIMEOUT connect timeout in seconds (default 5)
+#   AWS_CLIENT_READ_TIMEOUT    read timeout in seconds (default 30)
+#   AWS_CLIENT_RETRY_MODE      botocore retry mode: legacy/standard/adaptive (default standard)
+#   AWS_CLIENT_MAX_ATTEMPTS    botocore max attempts (default 3)
+import os
+import threading
+import metrics
+
+DEFAULT_MAX_POOL = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRY_MODE = 'standard'
+DEFAULT_MAX_ATTEMPTS = 3
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_http = None
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def get_settings():
+    return {
+        'max_pool': _env_int('AWS_CLIENT_MAX_POOL', DEFAULT_MAX_POOL),
+        'connect_timeout': _env_float('AWS_CLIENT_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+        'read_timeout': _env_float('AWS_CLIENT_READ_TIMEOUT', DEFAULT_READ_TIMEOUT),
+        'retry_mode': os.environ.get('AWS_CLIENT_RETRY_MODE', DEFAULT_RETRY_MODE),
+        'max_attempts': _env_int('AWS_CLIENT_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS),
+    }
+
+def client_config():
+    from botocore.config import Config
+    settings = get_settings()
+    return Config(max_pool_connections=settings['max_pool'],
+            connect_timeout=settings['connect_timeout'],
+            read_timeout=settings['read_timeout'],
+            retries={'mode': settings['retry_mode'], 'max_attempts': settings['max_attempts']})
+
+def get_session():
+    global _session
+    if None == _session:
+        with _lock:
+            if None == _session:
+                import boto3
+                _session = boto3.session.Session()
+    return _session
+
+def get_client(service_name, region_name=None, endpoint_url=None):
+    key = (service_name, region_name, endpoint_url)
+    client = _clients.get(key)
+    if None != client:
+        return client
+    session = get_session()
+    with _lock:
+        client = _clients.get(key)
+        if None == client:
+            # boto3 clients are thread safe, sessions are not: build under the lock
+            client = session.client(service_name, region_name=region_name,
+                    endpoint_url=endpoint_url, config=client_config())
+            metrics.instrument_client(client)
+            _clients[key] = client
+    return client
+
+def get_http():
+    global _http
+    if None == _http:
+        with _lock:
+            if None == _http:
+                import urllib3
+                settings = get_settings()
+                _http = urllib3.PoolManager(maxsize=settings['max_pool'],
+                        timeout=urllib3.Timeout(connect=settings['connect_timeout'],
+                            read=settings['read_timeout']))
+    return _http
+
+def reset():
+    # drop every cached client, mostly for tests and benchmarks
+    global _session, _http
+    with _lock:
+        _clients.clear()
+        _session = None
+        if None != _http:
+            _http.clear()
+        _http = None
@@ -0,0 +1,108 @@
+##python3
+# Shared CloudFormation custom resource response sender.
+#
+#   cfn_response.send(event, context, cfn_response.SUCCESS, {'Key': 'value'}, 'no error')
+#
+# The PUT to the pre-signed ResponseURL goes through the pooled aws_clients http
+# pool. Connection errors, 5xx and 429 answers are retried with capped, jittered
+# exponential backoff for as long as the lambda has time left; other 4xx answers
+# (expired or tampered url) are not retried. CloudFormation rejects response
+# objects over 4096 bytes, so Reason is truncated until the body fits.
+#
+# Environment variables:
+#   CFN_SEND_MAX_ATTEMPTS   attempts per response (default 5)
+import os
+import json
+import logging
+import aws_clients
+import metrics
+import retry
+
+logger = logging.getLogger()
+
+SUCCESS = 'SUCCESS'
+FAILED = 'FAILED'
+
+MAX_RESPONSE_BYTES = 4096
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 4.0
+# time kept back for the request itself and for the lambda to return
+SAFETY_MARGIN = 0.5
+# what a custom resource handler keeps back (retry.begin margin) to deliver its answer
+RESPONSE_TIME = 2.0
+TRUNCATED_MARK = '...(truncated)'
+
+def max_attempts():
+    try:
+        return max(1, int(os.environ.get('CFN_SEND_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)))
+    except ValueError:
+        return DEFAULT_MAX_ATTEMPTS
+
+def log_location(context):
+    return '\nSee the details in CloudWatch:%s,%s' % (context.log_group_name, context.log_stream_name)
+
+def build_body(event, context, status, data=None, reason='', physical_resource_id=None, no_echo=None):
+    body = {}
+    body['Status'] = status
+    body['Reason'] = reason + log_location(context)
+    body['PhysicalResourceId'] = physical_resource_id or context.log_stream_name
+    body['StackId'] = event['StackId']
+    body['RequestId'] = event['RequestId']
+    body['LogicalResourceId'] = event['LogicalResourceId']
+    body['NoEcho'] = no_echo
+    body['Data'] = data if None != data else {}
+    encoded = json.dumps(body).encode('utf-8')
+    if len(encoded) <= MAX_RESPONSE_BYTES:
+        return encoded
+    # cut the reason, keep the CloudWatch pointer: it is where the full text is
+    suffix = log_location(context)
+    keep = len(reason)
+    while len(encoded) > MAX_RESPONSE_BYTES and keep > 0:
+        keep = max(0, keep - (len(encoded) - MAX_RESPONSE_BYTES) - len(TRUNCATED_MARK))
+        body['Reason'] = reason[:keep] + TRUNCATED_MARK + suffix
+        encoded = json.dumps(body).encode('utf-8')
+    if len(encoded) > MAX_RESPONSE_BYTES:
+        logger.error('cloudformation response is %d bytes even without reason, Data is too big' % (len(encoded)))
+    else:
+        logger.warning('reason truncated to fit the %d bytes response limit' % (MAX_RESPONSE_BYTES))
+    return encoded
+
+def remaining_seconds(context):
+    try:
+        return context.get_remaining_time_in_millis() / 1000.0
+    except Exception:
+        return 30.0
+
+def retryable(status_code):
+    return status_code >= 500 or 429 == status_code
+
+def send(event, context, status, data=None, reason='', physical_resource_id=None, no_echo=None):
+    url = event['ResponseURL']
+    body = build_body(event, context, status, data, reason, physical_resource_id, no_echo)
+    logger.info('response to cloudformation: %s', body.decode('utf-8'))
+    headers = {'content-type': '', 'content-length': str(len(body))}
+    http = aws_clients.get_http()
+    attempts = max_attempts()
+    for attempt in range(attempts):
+        left = remaining_seconds(context) - SAFETY_MARGIN
+        try:
+            with metrics.span('cfn_send'):
+                response = http.request('PUT', url, headers=headers, body=body, retries=False,
+                        timeout=max(1.0, min(left, aws_clients.get_settings()['read_timeout'])))
+            logger.info('cloudformation status code: %s, body: %s' % (response.status, response.data.decode('utf-8', 'replace')))
+            if 200 <= response.status < 300:
+                return True
+            if not retryable(response.status):
+                logger.error('cloudformation rejected the response with status %s' % (response.status))
+                return False
+        except Exception as e:
+            logger.warning('send response to cloudformation failed (attempt %d): %s' % (attempt + 1, str(e)))
+        if attempt + 1 >= attempts:
+            break
+        delay = retry.full_jitter(attempt, BACKOFF_BASE, BACKOFF_CAP)
+        if remaining_seconds(context) - SAFETY_MARGIN - delay <= 1.0:
+            logger.error('no lambda time left to retry the cloudformation response')
+            break
+        metrics.sleep('cfn_send', delay)
+    return False
@@ -1,80 +1,162 @@
 ##python3
 import os
 import sys
-import boto3
 import json
 import threading
 import logging
-import urllib3
-import functools
-#from functools import cmp_to_key
+import re
+import time
+import aws_clients
+import metrics
+import retry
+import cfn_response
 
 CFN_SUCCESS = "SUCCESS"
 CFN_FAILED = "FAILED"
 
-class my_version(str):
-    def __init__(self, str_version):
-        version = str_version.split('.')
-        self.major = self.minor = self.patch = 0
-        if len(version) >= 1:
-            self.major = int(version[0])
-        if len(version) >= 2:
-            self.minor = int(version[1])
-        if len(version) >= 3:
-            self.patch = int(version[2])
-
-#input: {'name': 'xx', 'ami_id': 'xx', 'version': 'x.y.z'}
-def mycmp(x, y):
-    xv = my_version(x['version'])
-    yv = my_version(y['version'])
-    ret = xv.major - yv.major
-    if 0 != ret:
-        return ret
-    ret = xv.minor - yv.minor
-    if 0 != ret:
-        return ret
-    ret = xv.patch - yv.patch
-    return ret
-
-def find_amis(filters):
-    client = boto3.client('ec2')
-    #resp = client.describe_images(Owners=['aws-marketplace'], Filters=filters)
-    resp = client.describe_images(Filters=filters)
-    all_images = resp['Images']
-    ret_list = []
-    for image in all_images:
-        ret_list.append({'name':image['Name'], 'ami_id': image['ImageId']})
-    return ret_list
-
-def find_custom_ami(ami_name):
+# Image versions are parsed once into a tuple key (major, minor, patch, build),
+# so picking an image is a single max() over precomputed keys. Names look like
+# FortiWeb-AWS-7.4.1_BYOL... or FortiWeb-AWS-7.4.1.build0123_BYOL...
+VERSION_RE = re.compile(r'^v?(\d+)\.(\d+)(?:\.(\d+))?(?:[._-]?(?:build|b)?(\d+))?', re.IGNORECASE)
+
+def version_key(version):
+    m = VERSION_RE.match(version.strip())
+    if None == m:
+        return None
+    return tuple(int(part) if None != part else 0 for part in m.groups())
+
+#LATEST / '' -> (), '7.4.x' -> (7, 4), '7.2.3' -> (7, 2, 3), '10.1.2' -> (10, 1, 2)
+#the old dotless FortiWebVersionInternal values had one digit per part and are
+#accepted too: '74x' -> (7, 4), '723' -> (7, 2, 3). Any other dotless value is
+#ambiguous ('7101' may be 7.10.1 or 71.0.1) and refused.
+DOTLESS_RE = re.compile(r'^[0-9]{2}([0-9]|x)$')
+
+def parse_constraint(constraint):
+    if None == constraint:
+        return ()
+    text = constraint.strip().lower()
+    if text in ['', 'latest']:
+        return ()
+    if '.' in text:
+        parts = text.split('.')
+    elif None != DOTLESS_RE.match(text):
+        parts = [text[0:1], text[1:2], text[2:]]
+    else:
+        raise Exception('ambiguous FortiWeb version constraint: %s, write it with dots like 7.4.x or 10.1.2' % (constraint))
+    while len(parts) > 0 and parts[-1] in ['x', '*', '']:
+        parts.pop()
+    prefix = []
+    for part in parts:
+        digits = re.sub(r'^(build|b)', '', part)
+        if not digits.isdigit() or len(prefix) >= 4:
+            raise Exception('invalid FortiWeb version constraint: %s' % (constraint))
+        prefix.append(int(digits))
+    if len(prefix) <= 0:
+        raise Exception('invalid FortiWeb version constraint: %s' % (constraint))
+    return tuple(prefix)
+
+# The catalog keeps one image per version (the first one seen) and the running
+# latest, so it stays as small as the list of released versions however many
+# marketplace listings there are, and LATEST needs no scan at all.
+class AmiCatalog(object):
+    def __init__(self, images=None):
+        self.entries = {}
+        self.latest = None
+        for image in images or []:
+            self.add(image)
+
+    def add(self, image):
+        key = version_key(image['version'])
+        if None == key:
+            print('skip image with unknown version: %s' % (image['name']))
+            return
+        if key in self.entries:
+            return
+        self.entries[key] = image
+        if None == self.latest or key > self.latest[0]:
+            self.latest = (key, image)
+
+    def best(self, constraint=None):
+        prefix = parse_constraint(constraint)
+        size = len(prefix)
+        if size <= 0:
+            return None if None == self.latest else self.latest[1]
+        best = None
+        for key, image in self.entries.items():
+            if key[:size] == prefix and (None == best or key > best[0]):
+                best = (key, image)
+        return None if None == best else best[1]
+
+    def versions(self):
+        return [self.entries[key]['version'] for key in sorted(self.entries)]
+
+# describe_images is paged (MaxResults / NextToken), find_amis yields the images
+# page by page cut down to name and id, so a caller that stops iterating stops
+# paging and no page is kept once it is read. Every page goes through the retry
+# policy, which also checks the invocation deadline before each call.
+AMI_PAGE_SIZE = 1000
+DESCRIBE_IMAGES = retry.RetryPolicy('describe_images', max_attempts=5, base=0.2, cap=2.0)
+
+def find_amis(filters, region=None, page_size=AMI_PAGE_SIZE):
+    client = aws_clients.get_client('ec2', region_name=region)
+    #kwargs = {'Owners': ['aws-marketplace'], 'Filters': filters}
+    kwargs = {'Filters': filters, 'MaxResults': page_size}
+    while True:
+        resp = DESCRIBE_IMAGES.call(client.describe_images, **kwargs)
+        for image in resp.get('Images', []):
+            yield {'name': image['Name'], 'ami_id': image['ImageId']}
+        token = resp.get('NextToken')
+        if not token:
+            return
+        kwargs['NextToken'] = token
+
+def find_custom_ami(ami_name, region=None):
     filters = []
     filters.append({'Name': 'name', 'Values': [ami_name]})
-    image_list = find_amis(filters)
-    if len(image_list) <= 0:
+    #the first match is the answer, the pages after it are never asked for
+    image = next(find_amis(filters, region), None)
+    if None == image:
         msg = 'Can not found custom AMI! ami_name: %s' % (ami_name)
         raise Exception(msg)
-    image = image_list[0]
     image['version'] = 'x.x.x'
     return image
 
-def find_latest(pay_type, ami_name=None):
-    if None != ami_name:
-        return find_custom_ami(ami_name)
+# catalogs are kept per (region, pay type), so another version constraint in
+# the same warm container does not scan EC2 again
+g_catalogs = {}
+
+def get_catalog(pay_type, region=None):
+    key = (region or current_region(), pay_type)
+    entry = g_catalogs.get(key)
+    if None != entry and time.time() - entry['cached_at'] < ami_cache_ttl():
+        return entry['catalog']
     filters = []
     filters.append({'Name': 'owner-alias', 'Values': ['aws-marketplace']})
     filters.append({'Name': 'is-public', 'Values': ['true']})
     filters.append({'Name': 'name', 'Values': ['*FortiWeb-AWS-*%s*' % (pay_type)]})
-    image_list = find_amis(filters)
-    if len(image_list) <= 0:
+    catalog = AmiCatalog()
+    scanned = 0
+    for image in find_amis(filters, region):
+        scanned += 1
+        image['version'] = image['name'].split('FortiWeb-AWS-')[1].split(pay_type)[0]
+        catalog.add(image)
+    if scanned <= 0:
         msg = 'Can not found latest AMI! type: %s' % pay_type
         raise Exception(msg)
-    for image in image_list:
-        version = image['name'].split('FortiWeb-AWS-')[1].split(pay_type)[0]
-        image['version'] = version
-    image_list.sort(key=functools.cmp_to_key(mycmp))
-	#image_list.sort(mycmp)
-    print('pay_type(%s) ami list: %s' % (pay_type, image_list))
-    return image_list[-1]
+    print('pay_type(%s) ami versions: %s' % (pay_type, catalog.versions()))
+    with g_ami_cache_lock:
+        g_catalogs[key] = {'catalog': catalog, 'cached_at': time.time()}
+    return catalog
+
+def find_latest(pay_type, ami_name=None, region=None, version=None):
+    if None != ami_name:
+        return find_custom_ami(ami_name, region)
+    image = get_catalog(pay_type, region).best(version)
+    if None == image:
+        msg = 'Can not found AMI! type: %s, version: %s' % (pay_type, version if version else 'LATEST')
+        raise Exception(msg)
+    print('pay_type(%s) version(%s) ami: %s' % (pay_type, version if version else 'LATEST', image))
+    return image
 
 def find_byol_latest(byol_ami_name=None):
     return find_latest('_BYOL', byol_ami_name)
@@ -82,47 +164,81 @@ def find_byol_latest(byol_ami_name=None):
 def find_on_demand_latest(on_demand_ami_name=None):
     return find_latest('_OnDemand', on_demand_ami_name)
 
-def cfn_send(evt, context, responseStatus, respData, reason=''):
-    respUrl = evt['ResponseURL']
-    print(respUrl)
-    respBody = {}
-    respBody['Status'] = responseStatus
-    respBody['Reason'] = reason + '\nSee the details in CloudWatch:' + context.log_group_name + ',' + context.log_stream_name
-    respBody['PhysicalResourceId'] = context.log_stream_name
-    respBody['StackId'] = evt['StackId']
-    respBody['RequestId'] = evt['RequestId']
-    respBody['LogicalResourceId'] = evt['LogicalResourceId']
-    respBody['NoEcho'] = None
-    respBody['Data'] = respData
-
-    json_respBody = json.dumps(respBody)
-    print("Response to cloudformation:\n" + json_respBody)
-    headers = {'content-type' : '', 'content-length' : str(len(json_respBody)) }
+# AMI lookups are cached by (pay type, ami name, region): in the warm container
+# for AMI_CACHE_TTL seconds (default 3600), and optionally in a persistent store
+# shared by every container and stack:
+#   AMI_CACHE_SSM_PREFIX  SSM parameter path, e.g. /fortiweb/ami-cache
+#   AMI_CACHE_S3_URL      s3://bucket/prefix/
+g_ami_cache = {}
+g_ami_cache_lock = threading.Lock()
+
+def current_region():
+    #the environment first, a boto3 session only when it does not tell
+    region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    return region or aws_clients.get_session().region_name or 'us-east-1'
+
+def ami_cache_key(pay_type, ami_name, region, version=None):
+    if None == ami_name and len(parse_constraint(version)) > 0:
+        ami_name = 'version-' + '.'.join(str(v) for v in parse_constraint(version))
+    return '%s/%s/%s' % (region, pay_type.strip('_'), ami_name if ami_name else 'LATEST')
+
+def ami_cache_ttl():
+    return float(os.environ.get('AMI_CACHE_TTL', 3600))
+
+def load_persistent_ami(key):
+    ssm_prefix = os.environ.get('AMI_CACHE_SSM_PREFIX', '')
+    s3_url = os.environ.get('AMI_CACHE_S3_URL', '')
     try:
-        http = urllib3.PoolManager()
-        response = http.request('PUT', respUrl, headers=headers, body=json_respBody)
-        print("cloudformation status code: %s" % (response.status))
-        print("cloudformation return body: %s" %(response.data.decode('utf-8')))
+        if ssm_prefix:
+            client = aws_clients.get_client('ssm')
+            resp = client.get_parameter(Name=ssm_prefix.rstrip('/') + '/' + key.replace(' ', '_'))
+            return json.loads(resp['Parameter']['Value'])
+        if s3_url:
+            bucket, _, prefix = s3_url[len('s3://'):].partition('/')
+            client = aws_clients.get_client('s3')
+            resp = client.get_object(Bucket=bucket, Key=prefix + key + '.json')
+            return json.loads(resp['Body'].read())
     except Exception as e:
-        print("send(..) failed sending response: " + str(e))
-        raise
+        print('no persistent ami cache entry for %s: %s' % (key, str(e)))
+    return None
 
-def timeout(event, context):
-    logging.error('Time out, failure response to CloudFormation')
-    cfn_send(event, context, CFN_FAILED, {}, 'fwb labmda timeout')
+def save_persistent_ami(key, entry):
+    ssm_prefix = os.environ.get('AMI_CACHE_SSM_PREFIX', '')
+    s3_url = os.environ.get('AMI_CACHE_S3_URL', '')
+    try:
+        if ssm_prefix:
+            client = aws_clients.get_client('ssm')
+            client.put_parameter(Name=ssm_prefix.rstrip('/') + '/' + key.replace(' ', '_'),
+                    Value=json.dumps(entry), Type='String', Overwrite=True)
+        elif s3_url:
+            bucket, _, prefix = s3_url[len('s3://'):].partition('/')
+            client = aws_clients.get_client('s3')
+            client.put_object(Bucket=bucket, Key=prefix + key + '.json', Body=json.dumps(entry).encode())
+    except Exception as e:
+        #the cache is an optimization only
+        print('save persistent ami cache entry for %s failed: %s' % (key, str(e)))
 
-def handler(event, context):
-    print('event: %s' % json.dumps(event))
-    status = CFN_SUCCESS
-    respData = {}
-    err_msg = 'no error'
-    if event['RequestType'] not in ['Create', 'Update']:
-        cfn_send(event, context, status, respData, err_msg)
-        return
-    # make sure we send a failure to CloudFormation if the function is going to timeout
-    timer = threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
-    timer.start()
-    rpt = event['ResourceProperties']
+def find_latest_cached(pay_type, ami_name=None, allow_stale=False, version=None):
+    key = ami_cache_key(pay_type, ami_name, current_region(), version)
+    now = time.time()
+    entry = g_ami_cache.get(key)
+    if None == entry:
+        entry = load_persistent_ami(key)
+        if None != entry:
+            with g_ami_cache_lock:
+                g_ami_cache[key] = entry
+    if None != entry and (allow_stale or now - entry['cached_at'] < ami_cache_ttl()):
+        print('ami cache hit: %s' % (key))
+        metrics.count('AmiCacheHits')
+        return entry['image']
+    image = find_latest(pay_type, ami_name, None, version)
+    entry = {'image': image, 'cached_at': now}
+    with g_ami_cache_lock:
+        g_ami_cache[key] = entry
+    save_persistent_ami(key, entry)
+    return image
+
+def resolve_images(rpt, allow_stale=False):
     byol_needed = True
     on_demand_needed = True
     byol_ami_name = None
@@ -135,34 +251,140 @@ def handler(event, context):
         byol_ami_name = rpt['BYOLAMIName']
     if 'OnDemandAMIName' in rpt and len(rpt['OnDemandAMIName'].lstrip().rstrip()) > 0:
         on_demand_ami_name = rpt['OnDemandAMIName']
-    try:
-        print('try to find ami id')
+    respData = {}
+    respData['LatestBYOLAmiId'] = 'i-not-required'
+    respData['LatestBYOLAmiVersion'] = '0.0.0'
+    respData['LatestOnDemandAmiId'] = 'i-not-required'
+    respData['LatestOnDemandAmiVersion'] = '0.0.0'
+    #FortiWebVersion pins a version ('7.2.3') or a line ('7.4.x'), the map only knows LATEST
+    version = rpt.get('FortiWebVersion', '').strip()
+    mapped = {}
+    if len(parse_constraint(version)) <= 0:
+        mapped = ami_map_entry(rpt)
+    if None == byol_ami_name and 'LatestBYOLAmiId' in mapped:
+        byol_needed = False
+        if 'BYOLNeeded' not in rpt or not rpt['BYOLNeeded'].strip().startswith('n'):
+            respData['LatestBYOLAmiId'] = mapped['LatestBYOLAmiId']
+            respData['LatestBYOLAmiVersion'] = mapped['LatestBYOLAmiVersion']
+    if None == on_demand_ami_name and 'LatestOnDemandAmiId' in mapped:
+        on_demand_needed = False
+        if 'OnDemandNeeded' not in rpt or not rpt['OnDemandNeeded'].strip().startswith('n'):
+            respData['LatestOnDemandAmiId'] = mapped['LatestOnDemandAmiId']
+            respData['LatestOnDemandAmiVersion'] = mapped['LatestOnDemandAmiVersion']
+    #both lookups are slow marketplace scans, run them at the same time
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        byol_future = None
+        on_demand_future = None
         if True == byol_needed:
             print('BYOL needed')
-            image_info = find_byol_latest(byol_ami_name)
-            respData['LatestBYOLAmiId'] = image_info['ami_id']
-            respData['LatestBYOLAmiVersion'] = image_info['version']
-        else:
-            print('BYOL not needed')
-            respData['LatestBYOLAmiId'] = 'i-not-required'
-            respData['LatestBYOLAmiVersion'] = '0.0.0'
+            byol_future = pool.submit(metrics.bind(find_latest_cached), '_BYOL', byol_ami_name, allow_stale, version)
         if True == on_demand_needed:
             print('OnDemand needed')
-            image_info = find_on_demand_latest(on_demand_ami_name)
+            on_demand_future = pool.submit(metrics.bind(find_latest_cached), '_OnDemand', on_demand_ami_name, allow_stale, version)
+        if None != byol_future:
+            with metrics.span('find_byol'):
+                image_info = byol_future.result()
+            respData['LatestBYOLAmiId'] = image_info['ami_id']
+            respData['LatestBYOLAmiVersion'] = image_info['version']
+        if None != on_demand_future:
+            with metrics.span('find_on_demand'):
+                image_info = on_demand_future.result()
             respData['LatestOnDemandAmiId'] = image_info['ami_id']
             respData['LatestOnDemandAmiVersion'] = image_info['version']
-        else:
-            print('OnDemand not needed')
-            respData['LatestOnDemandAmiId'] = 'i-not-required'
-            respData['LatestOnDemandAmiVersion'] = '0.0.0'
+    return respData
+
+# A region -> image map built ahead of time (see 'find_ami.py map --help') turns
+# stack creation into a lookup. Each region holds the same keys the custom
+# resource returns, so the file also fits a template Mappings section:
+#   {"us-east-1": {"LatestBYOLAmiId": "ami-..", "LatestBYOLAmiVersion": "7.4.1",
+#                  "LatestOnDemandAmiId": "ami-..", "LatestOnDemandAmiVersion": "7.4.1"}}
+PAY_TYPE_KEYS = {'_BYOL': 'BYOL', '_OnDemand': 'OnDemand'}
+
+def build_ami_map(regions, pay_types=('_BYOL', '_OnDemand'), concurrency=4):
+    ami_map = {}
+    errors = {}
+    from concurrent.futures import ThreadPoolExecutor
+    tasks = [(region, pay_type) for region in regions for pay_type in pay_types]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [(region, pay_type, pool.submit(find_latest, pay_type, None, region)) for region, pay_type in tasks]
+        for region, pay_type, future in futures:
+            try:
+                image = future.result()
+            except Exception as e:
+                errors.setdefault(region, []).append('%s: %s' % (pay_type, str(e)))
+                continue
+            entry = ami_map.setdefault(region, {})
+            entry['Latest%sAmiId' % (PAY_TYPE_KEYS[pay_type])] = image['ami_id']
+            entry['Latest%sAmiVersion' % (PAY_TYPE_KEYS[pay_type])] = image['version']
+    return ami_map, errors
+
+def load_ami_map(url):
+    if url.startswith('s3://'):
+        bucket, _, key = url[len('s3://'):].partition('/')
+        client = aws_clients.get_client('s3')
+        return json.loads(client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    with open(url) as f:
+        return json.load(f)
+
+def ami_map_entry(rpt):
+    url = rpt.get('AMIMapUrl', '').strip() or os.environ.get('AMI_MAP_URL', '')
+    if not url:
+        return {}
+    try:
+        return load_ami_map(url).get(current_region(), {})
+    except Exception as e:
+        print('can not load ami map %s, fall back to describe_images: %s' % (url, str(e)))
+        return {}
+
+def same_properties(event):
+    #an Update that changes nothing but the stack around us
+    if 'Update' != event['RequestType'] or 'OldResourceProperties' not in event:
+        return False
+    new = dict(event['ResourceProperties'])
+    old = dict(event['OldResourceProperties'])
+    new.pop('ServiceToken', None)
+    old.pop('ServiceToken', None)
+    return new == old
+
+def cfn_send(evt, context, responseStatus, respData, reason=''):
+    if not cfn_response.send(evt, context, responseStatus, respData, reason):
+        raise Exception('send response to cloudformation failed')
+
+def handler(event, context):
+    metrics.begin('find_ami')
+    try:
+        do_handler(event, context)
+    finally:
+        metrics.end()
+
+def do_handler(event, context):
+    print('event: %s' % json.dumps(event))
+    status = CFN_SUCCESS
+    respData = {}
+    err_msg = 'no error'
+    if event['RequestType'] not in ['Create', 'Update']:
+        metrics.current().outcome = status
+        cfn_send(event, context, status, respData, err_msg)
+        return
+    # make sure we send a failure to CloudFormation before the function times out
+    retry.begin(context, margin=cfn_response.RESPONSE_TIME)
+    rpt = event['ResourceProperties']
+    try:
+        print('try to find ami id')
+        #unchanged properties: hand back the previous answer, even a stale one
+        respData = retry.run_until(resolve_images, rpt, same_properties(event))
+    except retry.DeadlineExceeded as e:
+        logging.error('Time out, failure response to CloudFormation')
+        err_msg = 'fwb lambda timeout: %s' % (str(e))
+        status = CFN_FAILED
     except Exception as e:
         err_msg = 'exception: %s' % (str(e))
         status = CFN_FAILED
-    finally:
-        timer.cancel()
+    metrics.current().outcome = status
     cfn_send(event, context, status, respData, err_msg)
 
-if '__main__' == __name__:
+def local_run():
     event = {}
     class fake_context: pass
     fake_context.get_remaining_time_in_millis = lambda self: 2*60*1000
@@ -183,3 +405,33 @@ if '__main__' == __name__:
     context.log_stream_name = 'log_stream'
     handler(event, context)
 
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='FortiWeb AMI lookup')
+    sub = parser.add_subparsers(dest='command')
+    map_parser = sub.add_parser('map', help='write a region -> latest BYOL/OnDemand AMI map')
+    map_parser.add_argument('--regions', required=True, help='comma separated region list')
+    map_parser.add_argument('--concurrency', type=int, default=4, help='regions scanned at the same time')
+    map_parser.add_argument('--output', default='-', help='local file, s3://bucket/key or - for stdout')
+    args = parser.parse_args(argv)
+    if 'map' != args.command:
+        local_run()
+        return 0
+    regions = [r.strip() for r in args.regions.split(',') if r.strip()]
+    ami_map, errors = build_ami_map(regions, concurrency=args.concurrency)
+    content = json.dumps(ami_map, indent=4, sort_keys=True)
+    if '-' == args.output:
+        print(content)
+    elif args.output.startswith('s3://'):
+        bucket, _, key = args.output[len('s3://'):].partition('/')
+        aws_clients.get_client('s3').put_object(Bucket=bucket, Key=key, Body=content.encode(),
+                ContentType='application/json')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    for region, msgs in sorted(errors.items()):
+        sys.stderr.write('%s: %s\n' % (region, '; '.join(msgs)))
+    return 1 if len(errors) > 0 else 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
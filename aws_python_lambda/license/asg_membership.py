@@ -0,0 +1,111 @@
+##python3
+# Autoscaling group membership checks for the license API.
+# Instances are looked up with describe_auto_scaling_instances instead of
+# describing whole groups. Known members are kept for ASG_MEMBER_TTL seconds
+# (default 60) in the warm container. An instance found in none of the groups is
+# asked about again only after a backoff that starts at ASG_NEGATIVE_BACKOFF
+# seconds (default 2) and doubles up to ASG_NEGATIVE_BACKOFF_MAX (default 30).
+import os
+import time
+import logging
+import threading
+import aws_clients
+
+logger = logging.getLogger()
+
+DESCRIBE_LIMIT = 50
+
+def parse_asg_names(asgnames):
+    if isinstance(asgnames, str):
+        asgnames = asgnames.split(',')
+    return tuple(sorted(set(n.strip() for n in asgnames if n and n.strip())))
+
+class AsgMembership(object):
+    def __init__(self, asg_names, ttl=None, negative_backoff=None, negative_backoff_max=None):
+        self.asg_names = set(parse_asg_names(asg_names))
+        if None == ttl:
+            ttl = float(os.environ.get('ASG_MEMBER_TTL', 60))
+        if None == negative_backoff:
+            negative_backoff = float(os.environ.get('ASG_NEGATIVE_BACKOFF', 2))
+        if None == negative_backoff_max:
+            negative_backoff_max = float(os.environ.get('ASG_NEGATIVE_BACKOFF_MAX', 30))
+        self.ttl = ttl
+        self.negative_backoff = negative_backoff
+        self.negative_backoff_max = negative_backoff_max
+        # instance_id -> expires_at
+        self.members = {}
+        # instance_id -> (retry_at, failures)
+        self.negatives = {}
+        self.describe_calls = 0
+        self.lock = threading.Lock()
+
+    def cached(self, instance_id, now):
+        if self.members.get(instance_id, 0) > now:
+            return True
+        negative = self.negatives.get(instance_id)
+        if None != negative and negative[0] > now:
+            return False
+        return None
+
+    def forget(self, instance_id):
+        with self.lock:
+            self.members.pop(instance_id, None)
+            self.negatives.pop(instance_id, None)
+
+    def is_member(self, instance_id):
+        return instance_id in self.check_many([instance_id])
+
+    def check_many(self, instance_ids):
+        now = time.time()
+        authorized = set()
+        unknown = []
+        for instance_id in instance_ids:
+            answer = self.cached(instance_id, now)
+            if True == answer:
+                authorized.add(instance_id)
+            elif None == answer:
+                unknown.append(instance_id)
+        if len(unknown) <= 0:
+            return authorized
+        found = self.describe(unknown)
+        now = time.time()
+        with self.lock:
+            for instance_id in unknown:
+                if instance_id in found:
+                    authorized.add(instance_id)
+                    self.members[instance_id] = now + self.ttl
+                    self.negatives.pop(instance_id, None)
+                else:
+                    failures = self.negatives.get(instance_id, (0, 0))[1] + 1
+                    backoff = min(self.negative_backoff * (2 ** (failures - 1)), self.negative_backoff_max)
+                    self.negatives[instance_id] = (now + backoff, failures)
+        return authorized
+
+    def describe(self, instance_ids):
+        found = set(self.lifecycle_states(instance_ids))
+        logger.debug('asg members found: %s', found)
+        return found
+
+    def lifecycle_states(self, instance_ids):
+        # instance_id -> LifecycleState ('InService', 'Terminating:Wait', ...) of
+        # the members, read every time
+        client = aws_clients.get_client('autoscaling')
+        states = {}
+        for start in range(0, len(instance_ids), DESCRIBE_LIMIT):
+            self.describe_calls += 1
+            resp = client.describe_auto_scaling_instances(InstanceIds=instance_ids[start:start + DESCRIBE_LIMIT])
+            for i in resp['AutoScalingInstances']:
+                if i['AutoScalingGroupName'] in self.asg_names:
+                    states[i['InstanceId']] = i.get('LifecycleState', '')
+        return states
+
+_checkers = {}
+_checkers_lock = threading.Lock()
+
+def get_membership(asgnames):
+    key = parse_asg_names(asgnames)
+    checker = _checkers.get(key)
+    if None == checker:
+        with _checkers_lock:
+            checker = _checkers.setdefault(key, AsgMembership(key))
+    return checker
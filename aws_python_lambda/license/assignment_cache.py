@@ -0,0 +1,100 @@
+##python3
+# Warm container cache of confirmed instance -> license answers.
+# A booting FortiWeb keeps asking for its license, an answer confirmed by our own
+# write or read is served from memory for LICENSE_ANSWER_TTL seconds (default
+# 300, 0 turns the cache off). After that it is checked against the record
+# version (store.get_entry) before it is served again. Releases made through
+# this container drop the entry right away; the TTL bounds how long another
+# container may keep answering for a released instance.
+#
+# Concurrent requests for the same instance are coalesced: the first one runs
+# the lookup / allocation, the others wait for its answer.
+import os
+import time
+import logging
+import threading
+import assignment_store
+
+logger = logging.getLogger()
+
+class InFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class AssignmentCache(object):
+    def __init__(self, table_name, ttl=None):
+        self.table_name = table_name
+        if None == ttl:
+            ttl = float(os.environ.get('LICENSE_ANSWER_TTL', 300))
+        self.ttl = ttl
+        # instance_id -> (lic_name, version, checked_at)
+        self.answers = {}
+        # instance_id -> InFlight
+        self.in_flight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def get(self, instance_id):
+        if self.ttl <= 0:
+            return None
+        entry = self.answers.get(instance_id)
+        if None == entry:
+            return None
+        lic_name, version, checked_at = entry
+        if time.time() - checked_at >= self.ttl:
+            current = assignment_store.get_store(self.table_name).get_entry(instance_id)
+            if None == current or current[0] != lic_name or (None != version and current[1] != version):
+                logger.info('cached license of %s is outdated, record: %s', instance_id, current)
+                self.forget(instance_id)
+                return None
+            self.put(instance_id, lic_name, current[1])
+        self.hits += 1
+        return lic_name
+
+    def put(self, instance_id, lic_name, version=None):
+        # version None: confirmed by our own write, the first revalidation learns it
+        if self.ttl <= 0 or None == lic_name:
+            return
+        with self.lock:
+            self.answers[instance_id] = (lic_name, version, time.time())
+
+    def forget(self, instance_id):
+        with self.lock:
+            self.answers.pop(instance_id, None)
+
+    def coalesce(self, instance_id, fn, *args):
+        with self.lock:
+            flight = self.in_flight.get(instance_id)
+            leader = None == flight
+            if leader:
+                flight = InFlight()
+                self.in_flight[instance_id] = flight
+        if not leader:
+            self.coalesced += 1
+            flight.done.wait()
+            if None != flight.error:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(instance_id, None)
+            flight.done.set()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(table_name):
+    cache = _caches.get(table_name)
+    if None == cache:
+        with _caches_lock:
+            cache = _caches.setdefault(table_name, AssignmentCache(table_name))
+    return cache
@@ -0,0 +1,330 @@
+##python3
+# Storage layouts for the instance <-> license assignment records.
+#
+# 'set' (default, the original layout): one item, assigned_records = total_records,
+# whose inst_lic_pair string set holds instance_id, lic_name and
+# instance_id + MAGIC_CONCATENATOR + lic_name for every assignment.
+#
+# 'item': one item per instance (assigned_records = instance#<instance_id>) and one
+# per license (assigned_records = license#<lic_name>) in the same table. Both are
+# written in a single conditional transaction, so an instance and a license can
+# still only be assigned once, reads are keyed O(1) lookups and no single item is
+# written by the whole fleet. Existing tables are converted with
+# migrate_license_records.py.
+#
+# The instance item also carries a 'version' token, new for every assignment, so a
+# cached answer can be checked against the record (see assignment_cache.py).
+#
+# The layout is selected with the LICENSE_RECORD_LAYOUT environment variable.
+import os
+import uuid
+import logging
+import aws_clients
+
+logger = logging.getLogger()
+
+MAGIC_CONCATENATOR = '=|fwb|='
+LEGACY_KEY = 'total_records'
+INSTANCE_PREFIX = 'instance#'
+LICENSE_PREFIX = 'license#'
+
+LAYOUT_SET = 'set'
+LAYOUT_ITEM = 'item'
+
+# put_if_not_exists results
+ASSIGNED = 0
+CONFLICT = 1
+INSTANCE_TAKEN = 2
+
+def parse_pairs(all_records):
+    pairs = {}
+    for record in all_records:
+        if record.find(MAGIC_CONCATENATOR) != -1:
+            instance_id, lic_name = record.split(MAGIC_CONCATENATOR, 1)
+            pairs[instance_id] = lic_name
+    return pairs
+
+def _error_code(e):
+    # botocore ClientError code without importing botocore at load time
+    resp = getattr(e, 'response', None) or {}
+    return str(resp.get('Error', {}).get('Code', ''))
+
+def _cancel_codes(e):
+    return [reason.get('Code', 'None') for reason in e.response.get('CancellationReasons', [])]
+
+class SetAssignmentStore(object):
+    layout = LAYOUT_SET
+    # pairs per put_many_if_not_exists call, bounded by the condition expression size
+    batch_limit = 25
+    # licenses checked per taken_licenses call while allocating, None: the whole
+    # pool, it is the same single get_item anyway
+    read_window = None
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def read_records(self, consistent=False):
+        client = aws_clients.get_client('dynamodb')
+        resp = client.get_item(TableName=self.table_name,
+                    Key={'assigned_records': {'S': LEGACY_KEY}},
+                    ConsistentRead=consistent)
+        if 'Item' not in resp or 'inst_lic_pair' not in resp['Item']:
+            return []
+        all_records = resp['Item']['inst_lic_pair']['SS']
+        if 0 != len(all_records) % 3:
+            raise Exception('record not paired! manually changed record?')
+        return all_records
+
+    def get(self, instance_id, consistent=False):
+        prefix = instance_id + MAGIC_CONCATENATOR
+        for i in self.read_records(consistent):
+            if i.startswith(prefix):
+                return i.split(MAGIC_CONCATENATOR)[1]
+        return None
+
+    def get_entry(self, instance_id):
+        # (lic_name, version), the set layout has no per pair attribute: the pair is the version
+        lic_name = self.get(instance_id)
+        if None == lic_name:
+            return None
+        return (lic_name, lic_name)
+
+    def list_assignments(self):
+        return parse_pairs(self.read_records())
+
+    def assigned_licenses(self):
+        return set(self.list_assignments().values())
+
+    def taken_licenses(self, lic_names):
+        assigned = self.assigned_licenses()
+        return set(n for n in lic_names if n in assigned)
+
+    def get_many(self, instance_ids):
+        pairs = self.list_assignments()
+        return dict((i, pairs[i]) for i in instance_ids if i in pairs)
+
+    def put_many_if_not_exists(self, pairs):
+        # pairs: [(instance_id, lic_name), ...], all or nothing in one conditional update
+        client = aws_clients.get_client('dynamodb')
+        records = []
+        conditions = []
+        values = {}
+        for idx, (instance_id, lic_name) in enumerate(pairs):
+            records += [instance_id, lic_name, instance_id + MAGIC_CONCATENATOR + lic_name]
+            conditions.append('not contains(inst_lic_pair, :i%d) AND not contains(inst_lic_pair, :l%d)' % (idx, idx))
+            values[':i%d' % (idx)] = {'S': instance_id}
+            values[':l%d' % (idx)] = {'S': lic_name}
+        values[':pair'] = {'SS': records}
+        try:
+            client.update_item(TableName=self.table_name,
+                    Key = {'assigned_records': {'S': LEGACY_KEY}},
+                    UpdateExpression = 'ADD inst_lic_pair :pair',
+                    ConditionExpression=' AND '.join(conditions),
+                    ExpressionAttributeValues = values,
+                )
+        except Exception as e:
+            if _error_code(e) == 'ConditionalCheckFailedException':
+                return CONFLICT
+            raise
+        return ASSIGNED
+
+    def put_if_not_exists(self, instance_id, lic_name):
+        client = aws_clients.get_client('dynamodb')
+        try:
+            #just for query
+            combine = instance_id + MAGIC_CONCATENATOR + lic_name
+            client.update_item(TableName=self.table_name,
+                    Key = {'assigned_records': {'S': LEGACY_KEY}},
+                    UpdateExpression = 'ADD inst_lic_pair :pair',
+                    ConditionExpression='not contains(inst_lic_pair, :inst_id) AND not contains(inst_lic_pair, :lic_name)',
+                    ExpressionAttributeValues = {
+                        ":pair": {"SS": [instance_id, lic_name, combine]},
+                        ":inst_id": {"S": instance_id},
+                        ":lic_name": {"S": lic_name},
+                    },
+                )
+        except Exception as e:
+            if _error_code(e) == 'ConditionalCheckFailedException':
+                #the one condition fails alike for a taken license and for an instance
+                #that has one already, tell them apart like the item layout does
+                if None != self.get(instance_id, consistent=True):
+                    return INSTANCE_TAKEN
+                return CONFLICT
+            raise
+        return ASSIGNED
+
+    def release(self, instance_id, lic_name):
+        # remove exactly this pair, False when it is not (or no longer) recorded
+        client = aws_clients.get_client('dynamodb')
+        combine = instance_id + MAGIC_CONCATENATOR + lic_name
+        try:
+            client.update_item(TableName=self.table_name,
+                    Key = {'assigned_records': {'S': LEGACY_KEY}},
+                    UpdateExpression = 'DELETE inst_lic_pair :pair',
+                    ConditionExpression='contains(inst_lic_pair, :combine)',
+                    ExpressionAttributeValues = {
+                        ":pair": {"SS": [instance_id, lic_name, combine]},
+                        ":combine": {"S": combine},
+                    },
+                )
+        except Exception as e:
+            if _error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+class ItemAssignmentStore(object):
+    layout = LAYOUT_ITEM
+    # pairs per transaction, each pair is two of the 100 transaction items
+    batch_limit = 50
+    # licenses checked per taken_licenses call while allocating: keyed reads of a
+    # few candidates, the read cost of an allocation does not grow with the pool
+    read_window = 25
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def get(self, instance_id, consistent=False):
+        client = aws_clients.get_client('dynamodb')
+        resp = client.get_item(TableName=self.table_name,
+                    Key={'assigned_records': {'S': INSTANCE_PREFIX + instance_id}},
+                    ConsistentRead=consistent)
+        if 'Item' not in resp:
+            return None
+        return resp['Item']['lic_name']['S']
+
+    def get_entry(self, instance_id):
+        # (lic_name, version), records written before versions existed use the license name
+        client = aws_clients.get_client('dynamodb')
+        resp = client.get_item(TableName=self.table_name,
+                    Key={'assigned_records': {'S': INSTANCE_PREFIX + instance_id}},
+                    ProjectionExpression='lic_name, version')
+        if 'Item' not in resp:
+            return None
+        item = resp['Item']
+        lic_name = item['lic_name']['S']
+        return (lic_name, item.get('version', {'S': lic_name})['S'])
+
+    def list_assignments(self):
+        client = aws_clients.get_client('dynamodb')
+        paginator = client.get_paginator('scan')
+        pairs = {}
+        for page in paginator.paginate(TableName=self.table_name,
+                FilterExpression='begins_with(assigned_records, :prefix)',
+                ExpressionAttributeValues={':prefix': {'S': INSTANCE_PREFIX}}):
+            for item in page.get('Items', []):
+                pairs[item['instance_id']['S']] = item['lic_name']['S']
+        return pairs
+
+    def assigned_licenses(self):
+        # a full scan, for reports and tools, the allocation uses taken_licenses
+        client = aws_clients.get_client('dynamodb')
+        paginator = client.get_paginator('scan')
+        lic_names = set()
+        for page in paginator.paginate(TableName=self.table_name,
+                FilterExpression='begins_with(assigned_records, :prefix)',
+                ProjectionExpression='lic_name',
+                ExpressionAttributeValues={':prefix': {'S': LICENSE_PREFIX}}):
+            for item in page.get('Items', []):
+                lic_names.add(item['lic_name']['S'])
+        return lic_names
+
+    def assignment_items(self, instance_id, lic_name):
+        attrs = {
+            'instance_id': {'S': instance_id},
+            'lic_name': {'S': lic_name},
+        }
+        inst_item = dict(attrs, assigned_records={'S': INSTANCE_PREFIX + instance_id},
+                version={'S': uuid.uuid4().hex})
+        lic_item = dict(attrs, assigned_records={'S': LICENSE_PREFIX + lic_name})
+        return [inst_item, lic_item]
+
+    def batch_get(self, keys, **kwargs):
+        # the items of keys that exist, in BatchGetItem calls of up to 100 keys
+        client = aws_clients.get_client('dynamodb')
+        for start in range(0, len(keys), 100):
+            request = {self.table_name: dict(kwargs, Keys=[{'assigned_records': {'S': k}} for k in keys[start:start + 100]])}
+            while request:
+                resp = client.batch_get_item(RequestItems=request)
+                for item in resp.get('Responses', {}).get(self.table_name, []):
+                    yield item
+                request = resp.get('UnprocessedKeys')
+
+    def get_many(self, instance_ids):
+        pairs = {}
+        for item in self.batch_get([INSTANCE_PREFIX + i for i in instance_ids]):
+            pairs[item['instance_id']['S']] = item['lic_name']['S']
+        return pairs
+
+    def taken_licenses(self, lic_names):
+        # keyed reads of the license# items, no scan
+        items = self.batch_get([LICENSE_PREFIX + n for n in lic_names], ProjectionExpression='lic_name')
+        return set(item['lic_name']['S'] for item in items)
+
+    def transact_put(self, pairs):
+        client = aws_clients.get_client('dynamodb')
+        transact_items = []
+        for instance_id, lic_name in pairs:
+            for item in self.assignment_items(instance_id, lic_name):
+                transact_items.append({'Put': {
+                    'TableName': self.table_name,
+                    'Item': item,
+                    'ConditionExpression': 'attribute_not_exists(assigned_records)',
+                }})
+        client.transact_write_items(TransactItems=transact_items)
+
+    def put_if_not_exists(self, instance_id, lic_name):
+        try:
+            self.transact_put([(instance_id, lic_name)])
+        except Exception as e:
+            if _error_code(e) == 'TransactionCanceledException':
+                codes = _cancel_codes(e)
+                if len(codes) > 0 and 'ConditionalCheckFailed' == codes[0]:
+                    return INSTANCE_TAKEN
+                if 'ConditionalCheckFailed' in codes or 'TransactionConflict' in codes:
+                    return CONFLICT
+            raise
+        return ASSIGNED
+
+    def put_many_if_not_exists(self, pairs):
+        try:
+            self.transact_put(pairs)
+        except Exception as e:
+            if _error_code(e) == 'TransactionCanceledException':
+                return CONFLICT
+            raise
+        return ASSIGNED
+
+    def release(self, instance_id, lic_name):
+        # remove exactly this pair, False when it is not (or no longer) recorded
+        client = aws_clients.get_client('dynamodb')
+        transact_items = [{'Delete': {
+                'TableName': self.table_name,
+                'Key': {'assigned_records': {'S': INSTANCE_PREFIX + instance_id}},
+                'ConditionExpression': 'lic_name = :lic_name',
+                'ExpressionAttributeValues': {':lic_name': {'S': lic_name}},
+            }}, {'Delete': {
+                'TableName': self.table_name,
+                'Key': {'assigned_records': {'S': LICENSE_PREFIX + lic_name}},
+                'ConditionExpression': 'instance_id = :instance_id',
+                'ExpressionAttributeValues': {':instance_id': {'S': instance_id}},
+            }}]
+        try:
+            client.transact_write_items(TransactItems=transact_items)
+        except Exception as e:
+            if _error_code(e) == 'TransactionCanceledException':
+                return False
+            raise
+        return True
+
+def get_layout():
+    return os.environ.get('LICENSE_RECORD_LAYOUT', LAYOUT_SET)
+
+def get_store(table_name, layout=None):
+    if None == layout:
+        layout = get_layout()
+    if LAYOUT_ITEM == layout:
+        return ItemAssignmentStore(table_name)
+    if LAYOUT_SET == layout:
+        return SetAssignmentStore(table_name)
+    raise Exception('unknown license record layout: %s' % (layout))
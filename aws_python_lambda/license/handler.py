@@ -1,90 +1,128 @@
 import os
-import sys
-import boto3
-import botocore
 import logging
 import json
-from botocore.exceptions import ClientError
-import logging
-import time
 import base64
+import zlib
+import random
+import threading
+import metrics
+import retry
+import license_inventory
+import assignment_store
+import assignment_cache
+import asg_membership
+import pool_counters
+# boto3 is loaded by aws_clients on the first AWS call; license_sweeper,
+# license_preassign, license_release, license_content and concurrent.futures only
+# on the paths that need them
 
-logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(asctime)s: %(message)s')
+#level is set per invocation by metrics.begin, see LOG_LEVEL / LOG_DEBUG_SAMPLE_RATE
+logging.basicConfig(format='[%(levelname)s] %(asctime)s: %(message)s')
 logger = logging.getLogger()
 
-MAGIC_CONCATENATOR = '=|fwb|='
+MAGIC_CONCATENATOR = assignment_store.MAGIC_CONCATENATOR
+
+MAX_BATCH_INSTANCES = 200
+#api route of license_release, the license route is everything else
+RELEASE_RESOURCE = '/lic_release'
+#API Gateway drops the request after 29 s, there is no point in working longer
+API_GATEWAY_TIMEOUT = 28.0
+
+#throttling and 5xx only, access denied or a missing bucket fail at once
+LIST_LICENSES = retry.RetryPolicy('list_licenses', max_attempts=10, base=0.2, cap=2.0)
 
 class NoAvailableLicense(Exception):
     pass
 
-def GetLicenseFileName(bucket_name, lic_dir_path):
-    client = boto3.client('s3')
-    licenses = []
-    response = client.list_objects(Bucket=bucket_name, Prefix=lic_dir_path)
-
-    for item in response['Contents']:
-        if item['Key'].find('.lic') != -1:
-            licenses.append(item['Key'])
-    logger.debug(licenses)
+def GetLicenseFileName(bucket_name, lic_dir_path, force=False):
+    licenses = license_inventory.get_inventory(bucket_name, lic_dir_path).get_names(force)
+    logger.debug('licenses: %s', licenses)
     return licenses
 
-def get_all_lic_names(bucket_name, lic_dir_path):
-    try_count = 10
-    lics = []
-    while try_count > 0:
-        try_count = try_count - 1
-        try:
-            lics = GetLicenseFileName(bucket_name, lic_dir_path)
-            return lics
-        except Exception as e:
-            logger.error('catch exception while get license name from s3, exception: %s' % (str(e)))
-            time.sleep(1)
-    raise Exception('get license name from s3 error!')
+def get_all_lic_names(bucket_name, lic_dir_path, force=False):
+    try:
+        return LIST_LICENSES.call(GetLicenseFileName, bucket_name, lic_dir_path, force)
+    except retry.DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error('catch exception while get license name from s3, exception: %s' % (str(e)))
+        raise Exception('get license name from s3 error!')
 
 def put_record_if_not_exists(table_name, lic_abs_name, instance_id):
     lic_name = os.path.basename(lic_abs_name)
-    client = boto3.client('dynamodb')
+    return assignment_store.get_store(table_name).put_if_not_exists(instance_id, lic_name)
+
+def get_free_lic_names(table_name, lic_names):
+    #the ones of lic_names nobody holds, keyed reads of the store, never a table scan
     try:
-        #just for query
-        combine = instance_id + MAGIC_CONCATENATOR + lic_name
-        client.update_item(TableName=table_name,
-                Key = {'assigned_records': {'S': 'total_records'}},
-                UpdateExpression = 'ADD inst_lic_pair :pair',
-                ConditionExpression='not contains(inst_lic_pair, :inst_id) AND not contains(inst_lic_pair, :lic_name)',
-                ExpressionAttributeValues = {
-                    ":pair": {"SS": [instance_id, lic_name, combine]},
-                    ":inst_id": {"S": instance_id},
-                    ":lic_name": {"S": lic_name},
-                },
-            )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            return 1
-        raise
+        taken = assignment_store.get_store(table_name).taken_licenses([os.path.basename(n) for n in lic_names])
     except Exception as e:
-        raise
-    return 0
+        #can not read the record, let the conditional writes sort it out
+        logger.error('read assigned licenses error: %s' % (str(e)))
+        return list(lic_names)
+    return [n for n in lic_names if os.path.basename(n) not in taken]
+
+def order_candidates(free_lic_names, instance_id):
+    #start at a hashed offset so instances booting together try different licenses
+    if len(free_lic_names) <= 1:
+        return list(free_lic_names)
+    start = zlib.crc32(instance_id.encode()) % len(free_lic_names)
+    return free_lic_names[start:] + free_lic_names[:start]
 
-def assign_license(table_name, all_lic_names, instance_id):
-    lic_index = 0
-    while True:
-        lic_name = all_lic_names[lic_index]
-        logger.debug('try alloc license: %s' % (lic_name))
+def next_window(table_name, unchecked, size):
+    #(free licenses of the next window, the rest), the pool in allocation order is
+    #confirmed free a window at a time, the conditional writes catch what changes after
+    if None == size:
+        size = len(unchecked)
+    return get_free_lic_names(table_name, unchecked[:size]), unchecked[size:]
+
+def assign_license(table_name, all_lic_names, instance_id, stats=None):
+    if None == stats:
+        stats = {}
+    stats['conflicts'] = 0
+    stats['attempts'] = 0
+    stats['assigned'] = 0
+    max_attempts = len(all_lic_names) + 1
+    window = assignment_store.get_store(table_name).read_window
+    unchecked = order_candidates(list(all_lic_names), instance_id)
+    free_lic_names = []
+    while stats['attempts'] < max_attempts:
+        retry.check_deadline('allocate')
+        if len(free_lic_names) <= 0:
+            if len(unchecked) <= 0:
+                raise NoAvailableLicense('no available license!')
+            free_lic_names, unchecked = next_window(table_name, unchecked, window)
+            continue
+        if stats['conflicts'] > 0:
+            #another allocator took our candidate, spread out randomly from now on
+            lic_name = random.choice(free_lic_names)
+        else:
+            lic_name = free_lic_names[0]
+        #the record may lag behind a racing write, never retry the same name
+        free_lic_names.remove(lic_name)
+        logger.debug('try alloc license: %s', lic_name)
+        stats['attempts'] += 1
         ret = put_record_if_not_exists(table_name, lic_name, instance_id)
-        if 0 == ret:
-            logger.info('alloc license finally get: %s' % (lic_name))
+        if assignment_store.ASSIGNED == ret:
+            logger.info('alloc license finally get: %s, conflicts: %d', lic_name, stats['conflicts'])
+            stats['assigned'] = 1
             return lic_name
-        elif 1 == ret:
-            lic_index += 1
-            if lic_index >= len(all_lic_names):
-                raise NoAvailableLicense('no available license!')
-            time.sleep(0.5)
+        elif assignment_store.INSTANCE_TAKEN == ret:
+            #a concurrent request of the same instance won, return its license. Read it
+            #consistently, an eventually consistent read can miss the write that just won
+            winner = assignment_store.get_store(table_name).get(instance_id, consistent=True)
+            if None != winner:
+                return winner
+            #released again in between, the license we tried may still be free
+            logger.info('assignment of %s is gone again, retry the allocation', instance_id)
+            free_lic_names.insert(0, lic_name)
             continue
-        elif -1 == ret:
-            time.sleep(0.5)
+        elif assignment_store.CONFLICT == ret:
+            stats['conflicts'] += 1
             continue
         else:
-            raise
+            raise Exception('unexpected result when put license record: %s' % (ret))
+    raise NoAvailableLicense('no available license after %d attempts!' % (stats['attempts']))
 
 def parse_event(event):
     ret = None
@@ -93,8 +131,19 @@ def parse_event(event):
         body = base64.b64decode(body).decode()
     try:
         body_obj = json.loads(body)
+        if 'instances' in body_obj:
+            #batch mode: {"instances": ["i-1", "i-2", ...]}
+            instance_ids = [str(i) for i in body_obj['instances']]
+            if len(instance_ids) <= 0 or len(instance_ids) > MAX_BATCH_INSTANCES:
+                raise Exception('instances should hold 1 to %d ids' % (MAX_BATCH_INSTANCES))
+            ret = {
+                'instance_ids': list(dict.fromkeys(instance_ids))
+            }
+            return ret
         ret = {
-            'instance_id': body_obj['instance']
+            'instance_id': body_obj['instance'],
+            'mode': body_obj.get('mode'),
+            'accept': accept_header(event),
         }
         return ret
     except Exception as e:
@@ -102,24 +151,22 @@ def parse_event(event):
         return None
 
 def auth_request(instance_id, asgnames):
-    all_instances = []
-    client = boto3.client('autoscaling')
-    try:
-        resp = client.describe_auto_scaling_groups(AutoScalingGroupNames=[asgnames])
-        for grp in resp['AutoScalingGroups']:
-            insts = grp['Instances']
-            for i in insts:
-                all_instances.append(i['InstanceId'])
-    except Exception as e:
-        raise
-    logger.info('all instances: %s' % (all_instances))
-    if instance_id in all_instances:
+    if asg_membership.get_membership(asgnames).is_member(instance_id):
         return True
+    logger.info('instance %s not found in autoscaling group(s) %s', instance_id, asgnames)
     return False
 
-def try_alloc_license(bucket_name, license_dir_path, table_name, instance_id):
+def authorize_instances(instance_ids, asgnames):
+    return asg_membership.get_membership(asgnames).check_many(instance_ids)
+
+def try_alloc_license(bucket_name, license_dir_path, table_name, instance_id, stats=None, prefetch=None):
+    if None == stats:
+        stats = {}
     try:
-        all_lic_names = get_all_lic_names(bucket_name, license_dir_path)
+        if None != prefetch:
+            all_lic_names = prefetch.result('inventory', get_all_lic_names, bucket_name, license_dir_path)
+        else:
+            all_lic_names = get_all_lic_names(bucket_name, license_dir_path)
     except Exception as e:
         raise
 
@@ -128,71 +175,343 @@ def try_alloc_license(bucket_name, license_dir_path, table_name, instance_id):
         #for apigetaway return internal error
         raise NoAvailableLicense('no one license found!')
     try:
-        lic_name = assign_license(table_name, all_lic_names, instance_id)
-        return lic_name
+        lic_name = assign_license(table_name, all_lic_names, instance_id, stats)
+    except NoAvailableLicense:
+        # the cached inventory may miss licenses uploaded since the last listing
+        fresh_lic_names = get_all_lic_names(bucket_name, license_dir_path, force=True)
+        if set(fresh_lic_names) == set(all_lic_names):
+            #nothing assigned, still publish: an empty pool is the reading that matters
+            pool_counters.record_allocation(table_name, 0, len(all_lic_names))
+            raise
+        all_lic_names = fresh_lic_names
+        lic_name = assign_license(table_name, all_lic_names, instance_id, stats)
     except Exception as e:
         raise
+    if stats.get('assigned', 0) > 0:
+        pool_counters.record_allocation(table_name, stats['assigned'], len(all_lic_names))
+    return lic_name
+
+def assign_licenses_batch(table_name, all_lic_names, instance_ids):
+    #returns {instance_id: lic_name or None}, None means no license left for it
+    store = assignment_store.get_store(table_name)
+    results = {}
+    assigned = 0
+    pending = list(instance_ids)
+    window = None if None == store.read_window else max(store.read_window, store.batch_limit)
+    unchecked = order_candidates(list(all_lic_names), pending[0]) if len(pending) > 0 else []
+    free_lic_names = []
+    while len(pending) > 0:
+        if len(free_lic_names) < min(store.batch_limit, len(pending)) and len(unchecked) > 0:
+            more, unchecked = next_window(table_name, unchecked, window)
+            free_lic_names += more
+            continue
+        if len(free_lic_names) <= 0:
+            break
+        chunk_size = min(store.batch_limit, len(pending), len(free_lic_names))
+        chunk = pending[:chunk_size]
+        pending = pending[chunk_size:]
+        candidates = free_lic_names[:chunk_size]
+        free_lic_names = free_lic_names[chunk_size:]
+        pairs = [(i, os.path.basename(n)) for i, n in zip(chunk, candidates)]
+        if assignment_store.ASSIGNED == store.put_many_if_not_exists(pairs):
+            for (instance_id, lic_name), lic_abs_name in zip(pairs, candidates):
+                results[instance_id] = lic_abs_name
+            assigned += len(pairs)
+            continue
+        #somebody raced us inside this chunk, settle it one instance at a time
+        logger.info('batch write conflict, fall back to single allocation for %d instance(s)', len(chunk))
+        for instance_id in chunk:
+            stats = {}
+            try:
+                results[instance_id] = assign_license(table_name, all_lic_names, instance_id, stats)
+            except NoAvailableLicense:
+                results[instance_id] = None
+            assigned += stats.get('assigned', 0)
+        #the single allocations took licenses anywhere in the pool, check it again
+        if len(pending) > 0:
+            unchecked = order_candidates(list(all_lic_names), pending[0])
+            free_lic_names = []
+    for instance_id in pending:
+        results[instance_id] = None
+    pool_counters.record_allocation(table_name, assigned, len(all_lic_names))
+    return results
+
+def handle_batch(instance_ids, config):
+    results = {}
+    authorized = authorize_instances(instance_ids, config['asg_names'])
+    for instance_id in instance_ids:
+        if instance_id not in authorized:
+            results[instance_id] = {'statusCode': 403, 'error': 'instance not in autoscaling group'}
+    todo = [i for i in instance_ids if i in authorized]
+    try:
+        assigned = assignment_store.get_store(config['table_name']).get_many(todo)
+        for instance_id, lic_name in assigned.items():
+            results[instance_id] = {'statusCode': 200, 'body': lic_s3_path(config['bucket_name'], lic_key(config['license_dir_path'], lic_name))}
+        todo = [i for i in todo if i not in assigned]
+        if len(todo) > 0:
+            all_lic_names = get_all_lic_names(config['bucket_name'], config['license_dir_path'])
+            allocated = assign_licenses_batch(config['table_name'], all_lic_names, todo)
+            for instance_id in todo:
+                lic_name = allocated.get(instance_id)
+                if None == lic_name:
+                    results[instance_id] = {'statusCode': 404, 'error': 'no available license'}
+                else:
+                    results[instance_id] = {'statusCode': 200, 'body': lic_s3_path(config['bucket_name'], lic_key(config['license_dir_path'], lic_name))}
+    except Exception as e:
+        logger.error('batch allocation error: %s' % (str(e)))
+        status = 503 if isinstance(e, retry.DeadlineExceeded) else 500
+        for instance_id in todo:
+            if instance_id not in results:
+                results[instance_id] = {'statusCode': status, 'error': str(e)}
+    ret = {
+        'statusCode': 200,
+        'headers': { 'Content-Type': 'application/json' },
+        'body': json.dumps({'results': results})
+    }
+    logger.info('batch of %d instance(s) get return:\r\n%s', len(instance_ids), ret)
+    return ret
+
+# The ASG check, the assignment read and the license listing of one request do
+# not depend on each other, in concurrent mode (LICENSE_PREFETCH, default true)
+# they are started together and the request waits for roughly the slowest one.
+# Reads that turn out not to be needed are cancelled.
+PREFETCH_WORKERS = 6
+
+_prefetch_pool = None
+_prefetch_lock = threading.Lock()
+
+def prefetch_enabled():
+    return os.environ.get('LICENSE_PREFETCH', 'true').lower() != 'false'
+
+def get_prefetch_pool():
+    global _prefetch_pool
+    if None == _prefetch_pool:
+        with _prefetch_lock:
+            if None == _prefetch_pool:
+                from concurrent.futures import ThreadPoolExecutor
+                _prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='lic-prefetch')
+    return _prefetch_pool
+
+class Prefetch(object):
+    def __init__(self, instance_id, config, concurrent=None):
+        self.futures = {}
+        if None == concurrent:
+            concurrent = prefetch_enabled()
+        if not concurrent:
+            return
+        pool = get_prefetch_pool()
+        self.futures['auth'] = pool.submit(metrics.bind(auth_request), instance_id, config['asg_names'])
+        self.futures['lookup'] = pool.submit(metrics.bind(get_assigned_lic_name), config['table_name'], instance_id)
+        self.futures['inventory'] = pool.submit(metrics.bind(get_all_lic_names), config['bucket_name'], config['license_dir_path'])
+
+    def result(self, name, fn, *args):
+        #the prefetched answer if there is one, the plain call otherwise
+        future = self.futures.pop(name, None)
+        if None == future:
+            return fn(*args)
+        return future.result()
+
+    def cancel(self):
+        #calls already running finish in the background, their results warm the caches
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+def lic_key(license_dir_path, lic_name):
+    #records hold the bare file name, fresh allocations the full key
+    return license_dir_path + os.path.basename(lic_name)
+
+def lic_s3_path(bucket_name, lic_name):
+    return 's3://' + bucket_name + '/' + lic_name
+
+# Response modes, picked by the request body "mode" or LICENSE_RESPONSE_MODE:
+#   path    the s3:// path of the license file (default, what older clients expect)
+#   url     a short lived pre-signed GET url, no S3 credentials needed on the instance
+#   inline  the license file itself, base64 encoded
+# The Accept header picks the representation: application/json gets a JSON
+# object, anything else the bare value as text/plain. Inline bytes go out as
+# application/octet-stream only to a client that accepts it: API Gateway turns the
+# base64 body back into bytes (BinaryMediaTypes of the RestApi) only when the
+# request's Accept header names that type, otherwise the client gets the base64
+# text, labeled as such.
+RESPONSE_MODES = ['path', 'url', 'inline']
+
+def accept_header(event):
+    for name, value in (event.get('headers') or {}).items():
+        if 'accept' == name.lower() and None != value:
+            return value.lower()
+    return ''
+
+def response_mode(evt_parsed):
+    mode = evt_parsed.get('mode') or os.environ.get('LICENSE_RESPONSE_MODE', 'path')
+    if mode not in RESPONSE_MODES:
+        logger.info('unknown response mode %s, use path', mode)
+        return 'path'
+    return mode
+
+def wants_json(accept):
+    return accept.find('application/json') != -1
+
+def wants_binary(accept):
+    return accept.find('application/octet-stream') != -1
+
+def reply(statusCode, accept, body=None, error=None):
+    if wants_json(accept):
+        obj = dict(body or {})
+        if None != error:
+            obj['error'] = error
+        return {
+            'statusCode': statusCode,
+            'headers': { 'Content-Type': 'application/json' },
+            'body': json.dumps(obj)
+        }
+    return {
+        'statusCode': statusCode,
+        'headers': { 'Content-Type': 'text/plain' },
+        'body': 'none' if None == body else body
+    }
+
+def license_response(config, lic_name, mode, accept):
+    key = lic_key(config['license_dir_path'], lic_name)
+    s3_path = lic_s3_path(config['bucket_name'], key)
+    if 'url' == mode:
+        import license_content
+        with metrics.span('presign'):
+            url = license_content.presign(config['bucket_name'], key)
+        if wants_json(accept):
+            return reply(200, accept, {'license': s3_path, 'url': url, 'expires_in': license_content.url_expires()})
+        return reply(200, accept, url)
+    if 'inline' == mode:
+        import license_content
+        with metrics.span('license_content'):
+            content, etag = license_content.get_content().get(config['bucket_name'], key)
+        encoded = base64.b64encode(content).decode()
+        if wants_json(accept):
+            return reply(200, accept, {'license': s3_path, 'etag': etag, 'content': encoded})
+        if not wants_binary(accept):
+            return reply(200, accept, encoded)
+        return {
+            'statusCode': 200,
+            'headers': { 'Content-Type': 'application/octet-stream', 'ETag': etag,
+                'Content-Disposition': 'attachment; filename="%s"' % (os.path.basename(key)) },
+            'isBase64Encoded': True,
+            'body': encoded
+        }
+    if wants_json(accept):
+        return reply(200, accept, {'license': s3_path})
+    return reply(200, accept, s3_path)
+
+def get_config():
+    bucket_name = os.environ['S3Bucket']
+    table_name = os.environ['CUSTOM_ID'] + '-FortiWebLic-' + os.environ['UNIQUE_ID']
+    return {
+        #BYOL_ASG_NAME may list several groups separated by ','
+        'asg_names': asg_membership.parse_asg_names([os.environ['BYOL_ASG_NAME'],
+                os.environ.get('ON_DEMAND_ASG_NAME', '')]),
+        'bucket_name': bucket_name,
+        'table_name': table_name,
+        'license_dir_path': license_inventory.license_dir_path(os.environ['S3Prefix']),
+    }
 
 def get_assigned_lic_name(table_name, instance_id):
     try:
-        client = boto3.client('dynamodb')
-        resp = client.get_item(TableName=table_name,
-                    Key={'assigned_records': {'S': 'total_records'}}
-                    )
-        item = resp['Item']
-        all_records = item['inst_lic_pair']['SS']
-        if 0 != len(all_records) % 3:
-            raise Exception('record not paired! manually changed record?')
-        for i in all_records:
-            if i.startswith(instance_id + MAGIC_CONCATENATOR):
-                return i.split(MAGIC_CONCATENATOR)[1]
-        return None
+        return assignment_store.get_store(table_name).get(instance_id)
     except Exception as e:
-        logger.debug('get none from dynamodb. exception: %s' % (str(e)))
+        logger.debug('get none from dynamodb. exception: %s', str(e))
         return None
 
+def lookup_or_allocate(config, instance_id, prefetch, alloc_stats):
+    with metrics.span('lookup'):
+        lic_name = prefetch.result('lookup', get_assigned_lic_name, config['table_name'], instance_id)
+    if None != lic_name:
+        prefetch.cancel()
+        return lic_name
+    #if-then can not avoid concurrency problem, the conditional writes settle it
+    with metrics.span('allocate'):
+        return try_alloc_license(config['bucket_name'], config['license_dir_path'], config['table_name'],
+                instance_id, alloc_stats, prefetch)
+
 def lambda_handler(event, context):
-    logger.debug('event dump:\r\n%s' % (json.dumps(event)))
+    metrics.begin('license_dispatcher')
+    #scheduled sweeps may use the whole lambda timeout, api requests not
+    retry.begin(context, None if 'action' in event else API_GATEWAY_TIMEOUT)
+    outcome = 'exception'
+    try:
+        ret = dispatch(event, context)
+        outcome = str(ret.get('statusCode', 'ok')) if isinstance(ret, dict) else 'ok'
+        return ret
+    finally:
+        metrics.end(outcome)
+
+def dispatch(event, context):
+    logger.debug('event dump:\r\n%s', metrics.lazy_json(event))
+    if 'sweep' == event.get('action'):
+        #scheduled invocation, not an api gateway request
+        import license_sweeper
+        return license_sweeper.sweep_handler(event, context)
+    if 'preassign' == event.get('action'):
+        #launching instances, from the lifecycle hook or the launch event
+        import license_preassign
+        return license_preassign.preassign_handler(event, context)
+    if 'release' == event.get('action'):
+        #terminating instances, from the lifecycle hook or the terminate event
+        import license_release
+        return license_release.release_handler(event, context)
+    if str(event.get('resource') or event.get('path') or '').rstrip('/').endswith(RELEASE_RESOURCE):
+        import license_release
+        return license_release.api_handler(event, context)
     evt_parsed = parse_event(event)
+    config = get_config()
+    if 'instance_ids' in evt_parsed:
+        return handle_batch(evt_parsed['instance_ids'], config)
 
     instance_id = evt_parsed['instance_id']
-    auth_request(instance_id, os.environ['BYOL_ASG_NAME'])
+    mode = response_mode(evt_parsed)
+    accept = evt_parsed.get('accept', '')
+    cache = assignment_cache.get_cache(config['table_name'])
+    with metrics.span('cache'):
+        lic_name = cache.get(instance_id)
+    if None != lic_name:
+        metrics.count('AnswerCacheHits')
+    #a cached answer only needs the (warm) membership check
+    prefetch = Prefetch(instance_id, config, False if None != lic_name else None)
+    with metrics.span('auth'):
+        authorized = prefetch.result('auth', auth_request, instance_id, config['asg_names'])
+    if not authorized:
+        prefetch.cancel()
+        return reply(403, accept, error='instance not in autoscaling group')
 
-    bucket_name = os.environ['S3Bucket']
-    s3_prefix = os.environ['S3Prefix']
-    table_name = os.environ['CUSTOM_ID'] + '-FortiWebLic-' + os.environ['UNIQUE_ID']
-    if s3_prefix.startswith('/'):
-        s3_prefix = s3_prefix[1:]
-    if not s3_prefix.endswith('/'):
-        s3_prefix = s3_prefix + '/'
-    license_dir_path = s3_prefix + 'license/'
-
-    lic_s3_path = 'none'
-    lic_name = None
     statusCode = 200
+    alloc_stats = {}
     try:
-        lic_name = get_assigned_lic_name(table_name, instance_id)
         if None == lic_name:
-            #if-then can not avoid concurrency problem, but our client will try again, finally will get right result
+            #duplicate requests of a booting instance share one lookup / allocation
             try:
-                lic_name = try_alloc_license(bucket_name, license_dir_path, table_name, instance_id)
+                lic_name = cache.coalesce(instance_id, lookup_or_allocate, config, instance_id, prefetch, alloc_stats)
+                cache.put(instance_id, lic_name)
             except NoAvailableLicense as e:
                 statusCode = 404
+            except retry.DeadlineExceeded as e:
+                #answer while the client still listens, it retries anyway
+                logger.error('instance_id(%s) %s', instance_id, str(e))
+                statusCode = 503
             except Exception:
                 statusCode = 500
                 #trigger gateway 500
                 raise
-            else:
-                statusCode = 200
+            finally:
+                prefetch.cancel()
+        metrics.count('AllocationConflicts', alloc_stats.get('conflicts', 0))
+        metrics.count('AllocationAttempts', alloc_stats.get('attempts', 0))
         if 200 == statusCode:
-            lic_s3_path = 's3://' + bucket_name + '/' + lic_name
-        ret = {
-            'statusCode': statusCode,
-            'headers': { 'Content-Type': 'plain/text' },
-            'body': lic_s3_path
-        }
-        logger.info('instance_id(%s) get return:\r\n%s' % (instance_id, ret))
+            ret = license_response(config, lic_name, mode, accept)
+        elif 503 == statusCode:
+            ret = reply(statusCode, accept, error='license service busy, retry later')
+        else:
+            ret = reply(statusCode, accept, error='no available license')
+        #never log the license itself
+        logged = ret if 'inline' != mode else dict(ret, body='<%d base64 chars>' % (len(ret['body'])))
+        logger.info('instance_id(%s) mode(%s) get return:\r\n%s, alloc stats: %s', instance_id, mode, logged, alloc_stats)
         return ret
     except Exception as e:
         raise
-
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# License pool administration for <S3Prefix>/license/.
+#
+#   upload    upload local .lic files (or directories of them) in parallel. Files
+#             whose content is already in the pool, or twice in the input, are
+#             rejected. The content is compared by sha256: every upload stores it
+#             in the object metadata, objects put there another way are hashed
+#             once read. ETags are no content hash under SSE-KMS or for multipart
+#             uploads. A key that exists with other content is never overwritten.
+#   manifest  write the inventory manifest (see license_inventory.py), the
+#             allocator reads it instead of listing when LICENSE_MANIFEST is set.
+#   report    pool utilization: the listing is streamed page by page against
+#             the assignment records, licenses assigned but missing in S3 are
+#             reported too.
+#
+# usage: license_admin.py upload --bucket <bucket> --prefix <S3Prefix> [--jobs 16] [--dry-run] <file or dir>...
+#        license_admin.py manifest --bucket <bucket> --prefix <S3Prefix> [--name manifest.json]
+#        license_admin.py report --bucket <bucket> --prefix <S3Prefix> --table <table> [--verbose]
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import license_inventory
+import assignment_store
+
+logger = logging.getLogger()
+
+DEFAULT_MANIFEST = 'manifest.json'
+DEFAULT_JOBS = 16
+
+def list_pool(bucket_name, lic_dir_path):
+    # yields {'key', 'md5', 'size'} of every license object, one page at a time
+    client = aws_clients.get_client('s3')
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=lic_dir_path):
+        for item in page.get('Contents', []):
+            if not license_inventory.is_license_key(item['Key']):
+                continue
+            etag = item.get('ETag', '').strip('"')
+            yield {
+                'key': item['Key'],
+                # multipart ETags ('<md5>-<parts>') are not a content hash
+                'md5': etag if etag.find('-') == -1 else None,
+                'size': item.get('Size', 0),
+            }
+
+def local_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if license_inventory.is_license_key(name):
+                        files.append(os.path.join(root, name))
+        else:
+            files.append(path)
+    return files
+
+def read_local(path):
+    with open(path, 'rb') as f:
+        body = f.read()
+    return {'path': path, 'name': os.path.basename(path), 'body': body,
+            'md5': hashlib.md5(body).hexdigest(), 'sha256': hashlib.sha256(body).hexdigest()}
+
+def stored_sha256(bucket_name, key):
+    client = aws_clients.get_client('s3')
+    metadata = client.head_object(Bucket=bucket_name, Key=key).get('Metadata', {})
+    if 'sha256' in metadata:
+        return metadata['sha256']
+    body = client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    return hashlib.sha256(body).hexdigest()
+
+def upload_one(bucket_name, key, item):
+    client = aws_clients.get_client('s3')
+    client.put_object(Bucket=bucket_name, Key=key, Body=item['body'],
+            ContentMD5=base64.b64encode(bytes.fromhex(item['md5'])).decode(),
+            Metadata={'sha256': item['sha256']})
+    return key
+
+def upload(bucket_name, lic_dir_path, paths, jobs=DEFAULT_JOBS, dry_run=False):
+    report = {'uploaded': [], 'duplicates': [], 'name_conflicts': [], 'failed': []}
+    existing_keys = set(obj['key'] for obj in list_pool(bucket_name, lic_dir_path))
+    existing_sha256 = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        keys = sorted(existing_keys)
+        for key, sha256 in zip(keys, pool.map(lambda key: stored_sha256(bucket_name, key), keys)):
+            existing_sha256.setdefault(sha256, key)
+        items = list(pool.map(read_local, local_files(paths)))
+        todo = []
+        for item in items:
+            key = lic_dir_path + item['name']
+            if item['sha256'] in existing_sha256:
+                report['duplicates'].append({'path': item['path'], 'same_as': existing_sha256[item['sha256']]})
+                continue
+            if key in existing_keys:
+                report['name_conflicts'].append({'path': item['path'], 'key': key})
+                continue
+            existing_sha256[item['sha256']] = key
+            existing_keys.add(key)
+            todo.append((key, item))
+        if dry_run:
+            report['uploaded'] = [key for key, item in todo]
+            return report
+        futures = [(key, pool.submit(upload_one, bucket_name, key, item)) for key, item in todo]
+        for key, future in futures:
+            try:
+                report['uploaded'].append(future.result())
+            except Exception as e:
+                logger.error('upload %s failed: %s' % (key, str(e)))
+                report['failed'].append(key)
+    return report
+
+def write_manifest(bucket_name, lic_dir_path, name=DEFAULT_MANIFEST):
+    licenses = [{'key': obj['key'], 'md5': obj['md5'], 'size': obj['size']}
+            for obj in list_pool(bucket_name, lic_dir_path)]
+    body = json.dumps({'generated_at': int(time.time()), 'licenses': licenses}, indent=1)
+    client = aws_clients.get_client('s3')
+    client.put_object(Bucket=bucket_name, Key=lic_dir_path + name, Body=body.encode(),
+            ContentType='application/json')
+    return len(licenses)
+
+def utilization(bucket_name, lic_dir_path, table_name):
+    # lic_name -> instance_id, the records hold bare file names
+    assigned = dict((lic_name, instance_id) for instance_id, lic_name in
+            assignment_store.get_store(table_name).list_assignments().items())
+    report = {'total': 0, 'used': 0, 'free': 0, 'licenses': [], 'missing': []}
+    seen = set()
+    for obj in list_pool(bucket_name, lic_dir_path):
+        name = os.path.basename(obj['key'])
+        seen.add(name)
+        instance_id = assigned.get(name)
+        report['total'] += 1
+        if None == instance_id:
+            report['free'] += 1
+        else:
+            report['used'] += 1
+        report['licenses'].append({'key': obj['key'], 'instance_id': instance_id})
+    report['missing'] = [{'license': n, 'instance_id': assigned[n]} for n in sorted(assigned) if n not in seen]
+    return report
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='FortiWeb BYOL license pool administration')
+    sub = parser.add_subparsers(dest='command')
+    for name in ['upload', 'manifest', 'report']:
+        cmd = sub.add_parser(name)
+        cmd.add_argument('--bucket', required=True, help='S3 bucket of the deployment (S3Bucket)')
+        cmd.add_argument('--prefix', required=True, help='key prefix of the deployment (S3Prefix)')
+        if 'upload' == name:
+            cmd.add_argument('paths', nargs='+', help='.lic files or directories holding them')
+            cmd.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help='parallel uploads')
+            cmd.add_argument('--dry-run', action='store_true', help='only report what would be uploaded')
+            cmd.add_argument('--no-manifest', action='store_true', help='do not rewrite the manifest')
+        if name in ['upload', 'manifest']:
+            cmd.add_argument('--name', default=DEFAULT_MANIFEST, help='manifest object name under the license dir')
+        if 'report' == name:
+            cmd.add_argument('--table', required=True, help='license table name')
+            cmd.add_argument('--verbose', action='store_true', help='print every license')
+            cmd.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+    if None == args.command:
+        parser.print_help()
+        return 2
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s')
+    lic_dir_path = license_inventory.license_dir_path(args.prefix)
+    if 'upload' == args.command:
+        report = upload(args.bucket, lic_dir_path, args.paths, args.jobs, args.dry_run)
+        print('uploaded: %d, duplicates: %d, name conflicts: %d, failed: %d' % (len(report['uploaded']),
+                len(report['duplicates']), len(report['name_conflicts']), len(report['failed'])))
+        for dup in report['duplicates']:
+            print('duplicate: %s has the same content as %s' % (dup['path'], dup['same_as']))
+        for conflict in report['name_conflicts']:
+            print('name conflict: %s exists with other content, not overwritten' % (conflict['key']))
+        if not args.dry_run and not args.no_manifest and len(report['uploaded']) > 0:
+            count = write_manifest(args.bucket, lic_dir_path, args.name)
+            print('manifest %s%s lists %d license(s), set LICENSE_MANIFEST=%s to use it' % (lic_dir_path,
+                    args.name, count, args.name))
+        return 1 if len(report['failed']) > 0 else 0
+    if 'manifest' == args.command:
+        count = write_manifest(args.bucket, lic_dir_path, args.name)
+        print('manifest %s%s lists %d license(s)' % (lic_dir_path, args.name, count))
+        return 0
+    report = utilization(args.bucket, lic_dir_path, args.table)
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return 0
+    percent = 100.0 * report['used'] / report['total'] if report['total'] > 0 else 0.0
+    print('total: %d, used: %d, free: %d (%.1f%% used)' % (report['total'], report['used'], report['free'], percent))
+    if args.verbose:
+        for lic in report['licenses']:
+            print('%s %s' % (lic['key'], lic['instance_id'] or '-'))
+    for missing in report['missing']:
+        print('missing: %s is assigned to %s but not in S3' % (missing['license'], missing['instance_id']))
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+##python3
+# License file delivery for the url / inline response modes of the license API.
+# Pre-signed GET urls are signed locally (no AWS call) and are valid for
+# LICENSE_URL_EXPIRES seconds (default 300). Inline license bytes are kept in the
+# warm container by key and ETag: served from memory for LICENSE_CONTENT_TTL
+# seconds (default 300), then revalidated with a conditional GET, so an
+# unchanged file costs a 304 instead of a download.
+import os
+import time
+import logging
+import threading
+import aws_clients
+
+logger = logging.getLogger()
+
+MAX_ENTRIES = 512
+
+def _error_code(e):
+    resp = getattr(e, 'response', None) or {}
+    return str(resp.get('Error', {}).get('Code', ''))
+
+def url_expires():
+    return int(os.environ.get('LICENSE_URL_EXPIRES', 300))
+
+def presign(bucket_name, key, expires=None):
+    if None == expires:
+        expires = url_expires()
+    client = aws_clients.get_client('s3')
+    return client.generate_presigned_url('get_object',
+            Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=expires)
+
+class LicenseContent(object):
+    def __init__(self, ttl=None):
+        if None == ttl:
+            ttl = float(os.environ.get('LICENSE_CONTENT_TTL', 300))
+        self.ttl = ttl
+        # (bucket, key) -> {'body', 'etag', 'checked_at'}
+        self.entries = {}
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def get(self, bucket_name, key):
+        # returns (bytes, etag)
+        cache_key = (bucket_name, key)
+        entry = self.entries.get(cache_key)
+        if None != entry and time.time() - entry['checked_at'] < self.ttl:
+            return entry['body'], entry['etag']
+        client = aws_clients.get_client('s3')
+        kwargs = {'Bucket': bucket_name, 'Key': key}
+        if None != entry:
+            kwargs['IfNoneMatch'] = entry['etag']
+        try:
+            resp = client.get_object(**kwargs)
+        except Exception as e:
+            if None != entry and _error_code(e) in ['304', 'NotModified']:
+                logger.debug('license %s not modified, etag: %s', key, entry['etag'])
+                with self.lock:
+                    entry['checked_at'] = time.time()
+                return entry['body'], entry['etag']
+            raise
+        body = resp['Body'].read()
+        self.downloads += 1
+        entry = {'body': body, 'etag': resp.get('ETag', ''), 'checked_at': time.time()}
+        with self.lock:
+            if cache_key not in self.entries and len(self.entries) >= MAX_ENTRIES:
+                oldest = min(self.entries, key=lambda k: self.entries[k]['checked_at'])
+                self.entries.pop(oldest, None)
+            self.entries[cache_key] = entry
+        return body, entry['etag']
+
+_content = None
+_content_lock = threading.Lock()
+
+def get_content():
+    global _content
+    if None == _content:
+        with _content_lock:
+            if None == _content:
+                _content = LicenseContent()
+    return _content
@@ -0,0 +1,122 @@
+##python3
+# In-memory inventory of the license files stored under <S3Prefix>/license/.
+# The parsed key list is kept in the warm container and only revalidated after
+# LICENSE_INVENTORY_TTL seconds, so a scale-out burst costs one listing instead
+# of one per instance. When LICENSE_MANIFEST names an object under the license
+# dir (for example 'manifest.json'), that precomputed list is loaded instead of
+# listing the prefix and is revalidated by ETag.
+import os
+import json
+import time
+import logging
+import threading
+import aws_clients
+
+logger = logging.getLogger()
+
+DEFAULT_TTL = 60
+
+def is_license_key(key):
+    return key.find('.lic') != -1
+
+def license_dir_path(s3_prefix):
+    # <S3Prefix>/license/ without a leading '/'
+    if s3_prefix.startswith('/'):
+        s3_prefix = s3_prefix[1:]
+    if len(s3_prefix) > 0 and not s3_prefix.endswith('/'):
+        s3_prefix = s3_prefix + '/'
+    return s3_prefix + 'license/'
+
+def _error_code(e):
+    resp = getattr(e, 'response', None) or {}
+    return str(resp.get('Error', {}).get('Code', ''))
+
+class LicenseInventory(object):
+    def __init__(self, bucket_name, lic_dir_path, ttl=None, manifest_name=None):
+        self.bucket_name = bucket_name
+        self.lic_dir_path = lic_dir_path
+        if None == ttl:
+            ttl = float(os.environ.get('LICENSE_INVENTORY_TTL', DEFAULT_TTL))
+        self.ttl = ttl
+        if None == manifest_name:
+            manifest_name = os.environ.get('LICENSE_MANIFEST', '')
+        self.manifest_key = (lic_dir_path + manifest_name) if manifest_name else None
+        self.names = None
+        self.etag = None
+        self.expires_at = 0
+        self.source = None
+        self.list_calls = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+    def get_names(self, force=False):
+        if not force and None != self.names and time.time() < self.expires_at:
+            return self.names
+        with self.lock:
+            # another thread may have refreshed while we waited for the lock
+            if not force and None != self.names and time.time() < self.expires_at:
+                return self.names
+            names = None
+            if None != self.manifest_key:
+                names = self._load_manifest()
+            if None == names:
+                names = self._list_all()
+                self.source = 'listing'
+                self.etag = None
+            self.names = names
+            self.expires_at = time.time() + self.ttl
+            return self.names
+
+    def _load_manifest(self):
+        client = aws_clients.get_client('s3')
+        kwargs = {'Bucket': self.bucket_name, 'Key': self.manifest_key}
+        if 'manifest' == self.source and None != self.etag:
+            kwargs['IfNoneMatch'] = self.etag
+        try:
+            resp = client.get_object(**kwargs)
+        except Exception as e:
+            code = _error_code(e)
+            if code in ['304', 'NotModified'] and None != self.names:
+                logger.debug('license manifest not modified, etag: %s', self.etag)
+                return self.names
+            if code in ['404', 'NoSuchKey']:
+                logger.info('license manifest %s not found, fall back to listing', self.manifest_key)
+                return None
+            raise
+        body = json.loads(resp['Body'].read())
+        names = []
+        for name in body.get('licenses', []):
+            if isinstance(name, dict):
+                name = name['key']
+            if not name.startswith(self.lic_dir_path):
+                name = self.lic_dir_path + name
+            if is_license_key(name):
+                names.append(name)
+        self.etag = resp.get('ETag')
+        self.source = 'manifest'
+        return names
+
+    def _list_all(self):
+        client = aws_clients.get_client('s3')
+        paginator = client.get_paginator('list_objects_v2')
+        names = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.lic_dir_path):
+            self.list_calls += 1
+            for item in page.get('Contents', []):
+                if is_license_key(item['Key']):
+                    names.append(item['Key'])
+        return names
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+def get_inventory(bucket_name, lic_dir_path):
+    key = (bucket_name, lic_dir_path)
+    inventory = _inventories.get(key)
+    if None == inventory:
+        with _inventories_lock:
+            inventory = _inventories.setdefault(key, LicenseInventory(bucket_name, lic_dir_path))
+    return inventory
@@ -0,0 +1,81 @@
+##python3
+# Reserve BYOL licenses while the instances are still launching, so the request a
+# FortiWeb makes at boot finds its assignment with a keyed read (or in the answer
+# cache of a warm container) instead of listing the pool and racing the other
+# booting instances for a license.
+#
+# Invoked through handler.lambda_handler with
+#   {"action": "preassign", "instance_id": "i-..."}       or "instance_ids": [...]
+# and optionally "asg_name", the group the instance launches in (the EventBridge
+# rule of the template, on the launch events of the BYOL group, passes it).
+# Instances of groups that are not license groups (on-demand) are skipped. Without
+# asg_name the instances are checked with describe_auto_scaling_instances.
+#
+# An empty pool is not an error here, the launch goes on and the boot request
+# gets its 404 like before. The allocation itself is the batch allocation of the
+# API, so pre-assigned licenses are counted in the pool counters too.
+import logging
+import metrics
+import assignment_store
+import assignment_cache
+import asg_membership
+
+logger = logging.getLogger()
+
+def event_instances(event):
+    if 'instance_ids' in event:
+        instance_ids = event['instance_ids']
+    else:
+        instance_ids = [event.get('instance_id')]
+    if not isinstance(instance_ids, list):
+        raise Exception('instance_ids must be a list')
+    return [i.strip() for i in instance_ids if isinstance(i, str) and i.strip()]
+
+def license_instances(asg_names, instance_ids, asg_name=None):
+    if None != asg_name:
+        return list(instance_ids) if asg_name in asg_names else []
+    # a fresh checker, a launching instance must not end up in the API's negative cache
+    members = asg_membership.AsgMembership(asg_names, ttl=0).check_many(instance_ids)
+    return [i for i in instance_ids if i in members]
+
+def preassign(config, instance_ids, asg_name=None):
+    import handler
+    table_name = config['table_name']
+    report = {'assigned': {}, 'existing': {}, 'exhausted': [], 'skipped': []}
+    todo = license_instances(config['asg_names'], instance_ids, asg_name)
+    report['skipped'] = [i for i in instance_ids if i not in todo]
+    if len(todo) <= 0:
+        logger.info('preassign skipped %s, not in %s', instance_ids, config['asg_names'])
+        return report
+    cache = assignment_cache.get_cache(table_name)
+    existing = assignment_store.get_store(table_name).get_many(todo)
+    for instance_id, lic_name in existing.items():
+        report['existing'][instance_id] = lic_name
+        cache.put(instance_id, lic_name)
+    todo = [i for i in todo if i not in existing]
+    if len(todo) > 0:
+        with metrics.span('preassign'):
+            all_lic_names = handler.get_all_lic_names(config['bucket_name'], config['license_dir_path'])
+            if len(all_lic_names) <= 0:
+                logger.error('license dir is empty!')
+                allocated = {}
+            else:
+                allocated = handler.assign_licenses_batch(table_name, all_lic_names, todo)
+        for instance_id in todo:
+            lic_name = allocated.get(instance_id)
+            if None == lic_name:
+                report['exhausted'].append(instance_id)
+                continue
+            report['assigned'][instance_id] = lic_name
+            cache.put(instance_id, lic_name)
+    metrics.count('LicensesPreassigned', len(report['assigned']))
+    if len(report['exhausted']) > 0:
+        logger.warning('preassign found no license for %s', report['exhausted'])
+    logger.info('preassign assigned %d, already assigned %d, no license %d, skipped %d',
+            len(report['assigned']), len(report['existing']), len(report['exhausted']), len(report['skipped']))
+    return report
+
+def preassign_handler(event, context):
+    import handler
+    config = handler.get_config()
+    return preassign(config, event_instances(event), event.get('asg_name'))
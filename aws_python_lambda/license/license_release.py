@@ -0,0 +1,123 @@
+##python3
+# Give back the license of an instance that is going away, so a BYOL pool can go
+# through scale-in / scale-out without waiting for the sweeper.
+#
+# Reached two ways through handler.lambda_handler:
+#   {"action": "release", "instance_id": "i-..."}     or "instance_ids": [...]
+#       direct invocation, from the EventBridge rule of the template on the
+#       terminate events of the BYOL group
+#   POST <api>/lic_release  {"instance": "i-..."}     or {"instances": [...]}
+#       the API Gateway route, answered with JSON
+#
+# Only instances that are on their way out are released: members of the license
+# groups in a Terminating state, or instances in none of the groups that EC2 does
+# not report alive (the sweeper's rule). A running member is refused, the API must
+# not let one instance take away another one's license.
+#
+# The release is the store's conditional remove of exactly the pair that was read,
+# so it is atomic, and repeating it is harmless: an instance with no assignment is
+# reported as not_assigned, not as an error. The license is free for the next
+# allocation at once, the allocators read the records on every allocation.
+import json
+import logging
+import metrics
+import assignment_store
+import assignment_cache
+import asg_membership
+import pool_counters
+
+logger = logging.getLogger()
+
+RELEASE_ATTEMPTS = 3
+#describe_auto_scaling_instances LifecycleState prefixes of instances going away
+LEAVING_STATES = ('Terminating', 'Terminated')
+
+RELEASED = 'released'
+NOT_ASSIGNED = 'not_assigned'
+
+def leaving_instances(asg_names, instance_ids):
+    import license_sweeper
+    states = asg_membership.AsgMembership(asg_names, ttl=0).lifecycle_states(instance_ids)
+    leaving = set(i for i, state in states.items() if state.startswith(LEAVING_STATES))
+    outside = [i for i in instance_ids if i not in states]
+    if len(outside) > 0:
+        alive = license_sweeper.live_ec2_instances(outside)
+        leaving.update(i for i in outside if i not in alive)
+    return leaving
+
+def release_instance(store, instance_id):
+    # (RELEASED, lic_name) or (NOT_ASSIGNED, None)
+    for attempt in range(RELEASE_ATTEMPTS):
+        entry = store.get_entry(instance_id)
+        if None == entry:
+            return NOT_ASSIGNED, None
+        if store.release(instance_id, entry[0]):
+            return RELEASED, entry[0]
+        #changed since we read it (a concurrent release), read again
+    raise Exception('release license of %s: record changed %d times' % (instance_id, RELEASE_ATTEMPTS))
+
+def release(config, instance_ids):
+    table_name = config['table_name']
+    report = {'released': {}, 'not_assigned': [], 'refused': [], 'failed': []}
+    leaving = leaving_instances(config['asg_names'], instance_ids)
+    store = assignment_store.get_store(table_name)
+    cache = assignment_cache.get_cache(table_name)
+    for instance_id in instance_ids:
+        if instance_id not in leaving:
+            report['refused'].append(instance_id)
+            continue
+        try:
+            with metrics.span('release'):
+                result, lic_name = release_instance(store, instance_id)
+        except Exception as e:
+            logger.error('release license of %s error: %s' % (instance_id, str(e)))
+            report['failed'].append(instance_id)
+            continue
+        cache.forget(instance_id)
+        if RELEASED == result:
+            report['released'][instance_id] = lic_name
+        else:
+            report['not_assigned'].append(instance_id)
+    released = len(report['released'])
+    if released > 0:
+        pool_counters.record_release(table_name, released)
+    metrics.count('LicensesReleased', released)
+    logger.info('release: %d released, %d not assigned, refused %s, failed %s',
+            released, len(report['not_assigned']), report['refused'], report['failed'])
+    return report
+
+def release_handler(event, context):
+    import handler
+    import license_preassign
+    return release(handler.get_config(), license_preassign.event_instances(event))
+
+def api_handler(event, context):
+    import handler
+    evt_parsed = handler.parse_event(event)
+    if None == evt_parsed:
+        return api_reply(400, {'error': 'bad request'})
+    if 'instance_ids' in evt_parsed:
+        report = release(handler.get_config(), evt_parsed['instance_ids'])
+        return api_reply(500 if len(report['failed']) > 0 else 200, report)
+    instance_id = evt_parsed['instance_id']
+    report = release(handler.get_config(), [instance_id])
+    if instance_id in report['refused']:
+        return api_reply(403, {'error': 'instance still in service'})
+    if instance_id in report['failed']:
+        return api_reply(500, {'error': 'release license error'})
+    if instance_id in report['released']:
+        return api_reply(200, {'status': RELEASED})
+    return api_reply(200, {'status': NOT_ASSIGNED})
+
+def api_reply(statusCode, body):
+    #never echo the license name to the api
+    body = dict(body)
+    if isinstance(body.get('released'), dict):
+        body['released'] = sorted(body['released'].keys())
+    ret = {
+        'statusCode': statusCode,
+        'headers': { 'Content-Type': 'application/json' },
+        'body': json.dumps(body)
+    }
+    logger.info('release api return:\r\n%s', ret)
+    return ret
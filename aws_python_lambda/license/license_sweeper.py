@@ -0,0 +1,90 @@
+##python3
+# Give back the licenses of instances that are gone.
+# Every assignment is checked against the autoscaling groups first (50 ids per
+# describe call). Instances not found there are looked up in EC2 with a paginated
+# instance-id filter, and only the ones EC2 reports as terminated or unknown are
+# released, with a conditional remove of exactly the pair that was read. One
+# sweep is O(records) work and a handful of describe calls.
+#
+# Invoked on a schedule through handler.lambda_handler with {"action": "sweep"},
+# add "dry_run": true (or set SWEEPER_DRY_RUN=true) to only get the report.
+import os
+import logging
+import aws_clients
+import assignment_store
+import assignment_cache
+import pool_counters
+import asg_membership
+
+logger = logging.getLogger()
+
+EC2_FILTER_LIMIT = 100
+ALIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+def live_ec2_instances(instance_ids):
+    client = aws_clients.get_client('ec2')
+    paginator = client.get_paginator('describe_instances')
+    alive = set()
+    for start in range(0, len(instance_ids), EC2_FILTER_LIMIT):
+        chunk = instance_ids[start:start + EC2_FILTER_LIMIT]
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}]):
+            for reservation in page.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    if instance['State']['Name'] in ALIVE_STATES:
+                        alive.add(instance['InstanceId'])
+    return alive
+
+def find_orphans(assignments, asgnames):
+    instance_ids = sorted(assignments.keys())
+    if len(instance_ids) <= 0:
+        return []
+    # a fresh checker, the sweeper must not trust the API's member cache
+    members = asg_membership.AsgMembership(asgnames, ttl=0).check_many(instance_ids)
+    outside = [i for i in instance_ids if i not in members]
+    if len(outside) <= 0:
+        return []
+    alive = live_ec2_instances(outside)
+    return [i for i in outside if i not in alive]
+
+def sweep(table_name, asgnames, dry_run=False):
+    store = assignment_store.get_store(table_name)
+    #read before the listing, see pool_counters.reconcile
+    seen = None if dry_run else pool_counters.snapshot(table_name)
+    assignments = store.list_assignments()
+    orphans = find_orphans(assignments, asgnames)
+    report = {
+        'dry_run': dry_run,
+        'total': len(assignments),
+        'orphans': dict((i, assignments[i]) for i in orphans),
+        'released': [],
+        'failed': [],
+    }
+    if dry_run:
+        logger.info('sweep dry run, %d of %d license(s) would be released: %s', len(orphans), len(assignments), report['orphans'])
+        return report
+    for instance_id in orphans:
+        try:
+            if store.release(instance_id, assignments[instance_id]):
+                assignment_cache.get_cache(table_name).forget(instance_id)
+                report['released'].append(instance_id)
+            else:
+                #record changed since we read it, leave it to the next sweep
+                report['failed'].append(instance_id)
+        except Exception as e:
+            logger.error('release license of %s error: %s' % (instance_id, str(e)))
+            report['failed'].append(instance_id)
+    logger.info('sweep released %d of %d license(s), failed: %s', len(report['released']), len(assignments), report['failed'])
+    released = len(report['released'])
+    if released > 0:
+        pool_counters.record_release(table_name, released)
+    if None != seen:
+        pool_counters.reconcile(table_name, seen['used'] - released, len(assignments) - released)
+    return report
+
+def sweep_handler(event, context):
+    import handler
+    config = handler.get_config()
+    dry_run = os.environ.get('SWEEPER_DRY_RUN', 'false').lower() == 'true'
+    if isinstance(event, dict) and 'dry_run' in event:
+        dry_run = str(event['dry_run']).lower() == 'true'
+    return sweep(config['table_name'], config['asg_names'], dry_run)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Convert the license assignments of the 'set' layout (inst_lic_pair of the
+# total_records item) into the per instance / per license items of the 'item'
+# layout, see assignment_store.py. Assignments that already exist in the new
+# layout are skipped, so the tool can be run again after a partial run.
+# Switch the lambda to the new layout (LICENSE_RECORD_LAYOUT=item) afterwards.
+#
+# usage: migrate_license_records.py --table <CUSTOM_ID>-FortiWebLic-<UNIQUE_ID> [--dry-run] [--remove-legacy]
+import sys
+import argparse
+import logging
+import assignment_store
+
+logger = logging.getLogger()
+
+def migrate(table_name, dry_run=False, remove_legacy=False):
+    legacy = assignment_store.SetAssignmentStore(table_name)
+    store = assignment_store.ItemAssignmentStore(table_name)
+    records = legacy.read_records()
+    pairs = assignment_store.parse_pairs(records)
+    report = {'total': len(pairs), 'migrated': [], 'skipped': [], 'conflicts': []}
+    for instance_id, lic_name in sorted(pairs.items()):
+        if dry_run:
+            current = store.get(instance_id, consistent=True)
+            if None == current:
+                report['migrated'].append(instance_id)
+            elif current == lic_name:
+                report['skipped'].append(instance_id)
+            else:
+                report['conflicts'].append(instance_id)
+            continue
+        ret = store.put_if_not_exists(instance_id, lic_name)
+        if assignment_store.ASSIGNED == ret:
+            report['migrated'].append(instance_id)
+        elif store.get(instance_id, consistent=True) == lic_name:
+            report['skipped'].append(instance_id)
+        else:
+            report['conflicts'].append(instance_id)
+    if remove_legacy and not dry_run and 0 == len(report['conflicts']) and len(records) > 0:
+        client = assignment_store.aws_clients.get_client('dynamodb')
+        client.update_item(TableName=table_name,
+                Key={'assigned_records': {'S': assignment_store.LEGACY_KEY}},
+                UpdateExpression='DELETE inst_lic_pair :records',
+                ExpressionAttributeValues={':records': {'SS': records}})
+    return report
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='migrate FortiWeb license records to per instance items')
+    parser.add_argument('--table', required=True, help='license table name')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be migrated')
+    parser.add_argument('--remove-legacy', action='store_true',
+            help='delete the migrated pairs from total_records when there is no conflict')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s')
+    report = migrate(args.table, args.dry_run, args.remove_legacy)
+    print('total: %d, migrated: %d, skipped: %d, conflicts: %d' % (report['total'],
+            len(report['migrated']), len(report['skipped']), len(report['conflicts'])))
+    for instance_id in report['conflicts']:
+        print('conflict: %s already holds a different license in the new layout' % (instance_id))
+    return 1 if len(report['conflicts']) > 0 else 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
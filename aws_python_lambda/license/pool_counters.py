@@ -0,0 +1,157 @@
+##python3
+# Incremental license pool utilization, so capacity is known without listing S3 or
+# reading every assignment.
+#
+# One item of the license table (assigned_records = pool#counters) holds 'used' and
+# 'total'. Every allocation adds to used and every release subtracts, with an
+# unconditional ADD: it never conflicts with the assignment writes and answers with
+# the new values, so publishing costs no extra read. total is the size of the
+# license inventory the allocator has just read, stored by the same update so a
+# release can tell the free count too.
+#
+# The counter is written after the assignment, a lambda that dies in between leaves
+# it off by one. The sweeper reads every assignment anyway and sets used to the real
+# count, unless an allocation raced it (then the next sweep does).
+#
+# Every update is published as LicensesTotal / LicensesUsed / LicensesFree and
+# LicensePoolLow (1 when free is at or below the watermark) in an EMF record of its
+# own, with a LicenseTable dimension so each deployment can alarm on its pool.
+#
+# Environment variables:
+#   LICENSE_LOW_WATERMARK   free licenses at or below which LicensePoolLow is 1, a
+#                           count ('2') or a share of total ('10%', default)
+#   LICENSE_POOL_COUNTERS   'false' to skip the counter updates
+import os
+import logging
+import aws_clients
+import metrics
+
+logger = logging.getLogger()
+
+COUNTERS_KEY = 'pool#counters'
+DEFAULT_LOW_WATERMARK = '10%'
+
+def enabled():
+    return os.environ.get('LICENSE_POOL_COUNTERS', 'true').lower() != 'false'
+
+def low_watermark(total):
+    value = os.environ.get('LICENSE_LOW_WATERMARK', DEFAULT_LOW_WATERMARK).strip()
+    try:
+        if value.endswith('%'):
+            return total * float(value[:-1]) / 100.0
+        return float(value)
+    except ValueError:
+        logger.error('bad LICENSE_LOW_WATERMARK: %s' % (value))
+        return total * float(DEFAULT_LOW_WATERMARK[:-1]) / 100.0
+
+def _error_code(e):
+    resp = getattr(e, 'response', None) or {}
+    return str(resp.get('Error', {}).get('Code', ''))
+
+def _counts(item):
+    total = int(item.get('total', {'N': '0'})['N'])
+    used = int(item.get('used', {'N': '0'})['N'])
+    return {'total': total, 'used': used, 'free': max(0, total - used)}
+
+class PoolCounters(object):
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def read(self):
+        client = aws_clients.get_client('dynamodb')
+        resp = client.get_item(TableName=self.table_name,
+                    Key={'assigned_records': {'S': COUNTERS_KEY}},
+                    ConsistentRead=True)
+        return _counts(resp.get('Item', {}))
+
+    def add(self, used_delta, total=None):
+        client = aws_clients.get_client('dynamodb')
+        expression = 'ADD used :delta'
+        values = {':delta': {'N': str(used_delta)}}
+        if None != total:
+            expression += ' SET total = :total'
+            values[':total'] = {'N': str(total)}
+        resp = client.update_item(TableName=self.table_name,
+                    Key={'assigned_records': {'S': COUNTERS_KEY}},
+                    UpdateExpression=expression,
+                    ExpressionAttributeValues=values,
+                    ReturnValues='ALL_NEW')
+        return _counts(resp.get('Attributes', {}))
+
+    def reset(self, used, seen):
+        # used = <real count> only if nobody moved the counter since it read 'seen'
+        client = aws_clients.get_client('dynamodb')
+        condition = 'used = :seen'
+        if 0 == seen:
+            # tables from before the counters have no item yet
+            condition = 'attribute_not_exists(used) OR ' + condition
+        try:
+            resp = client.update_item(TableName=self.table_name,
+                        Key={'assigned_records': {'S': COUNTERS_KEY}},
+                        UpdateExpression='SET used = :used',
+                        ConditionExpression=condition,
+                        ExpressionAttributeValues={':used': {'N': str(used)}, ':seen': {'N': str(seen)}},
+                        ReturnValues='ALL_NEW')
+        except Exception as e:
+            if _error_code(e) == 'ConditionalCheckFailedException':
+                return None
+            raise
+        return _counts(resp.get('Attributes', {}))
+
+def publish(table_name, counts):
+    low = 1 if counts['total'] > 0 and counts['free'] <= low_watermark(counts['total']) else 0
+    if low:
+        logger.warning('license pool low: %d of %d license(s) free', counts['free'], counts['total'])
+    metrics.emit({
+        'LicensesTotal': counts['total'],
+        'LicensesUsed': counts['used'],
+        'LicensesFree': counts['free'],
+        'LicensePoolLow': low,
+    }, {'LicenseTable': table_name})
+    return low
+
+def record(table_name, used_delta, total=None):
+    # never fails the request, a missed update is repaired by the next sweep
+    if not enabled() or (0 == used_delta and None == total):
+        return None
+    try:
+        with metrics.span('pool_counters'):
+            counts = PoolCounters(table_name).add(used_delta, total)
+        publish(table_name, counts)
+        return counts
+    except Exception as e:
+        logger.error('update license pool counters error: %s' % (str(e)))
+        return None
+
+def record_allocation(table_name, count, total):
+    return record(table_name, count, total)
+
+def record_release(table_name, count):
+    return record(table_name, -count)
+
+def snapshot(table_name):
+    if not enabled():
+        return None
+    try:
+        return PoolCounters(table_name).read()
+    except Exception as e:
+        logger.error('read license pool counters error: %s' % (str(e)))
+        return None
+
+def reconcile(table_name, expected, used):
+    # expected: what the counter holds if nothing raced the sweep, used: the real count
+    if not enabled():
+        return None
+    try:
+        counters = PoolCounters(table_name)
+        counts = counters.read()
+        if counts['used'] != expected:
+            logger.info('license pool counters moved during the sweep, reconcile skipped')
+        elif counts['used'] != used:
+            logger.warning('license pool counter drifted: %d recorded, %d assigned', counts['used'], used)
+            counts = counters.reset(used, counts['used']) or counts
+        publish(table_name, counts)
+        return counts
+    except Exception as e:
+        logger.error('reconcile license pool counters error: %s' % (str(e)))
+        return None
@@ -0,0 +1,208 @@
+##python3
+# Lightweight per-invocation timing for the python lambdas.
+#
+#   inv = metrics.begin('find_ami')
+#   with metrics.span('cfn_send'):
+#       ...
+#   metrics.end('SUCCESS')
+#
+# Every AWS API call made through aws_clients is timed automatically (botocore
+# before-call / after-call hooks), including the retries botocore did. end()
+# prints one CloudWatch Embedded Metric Format record per invocation, so the
+# durations become metrics without any PutMetricData call. emit() prints a
+# standalone record for values that are not about one invocation (pool gauges).
+#
+# Environment variables:
+#   METRICS_NAMESPACE       EMF namespace (default FortiWebAutoscale)
+#   METRICS_DISABLED        'true' to skip the EMF record
+#   LOG_LEVEL               level of the root logger (default INFO)
+#   LOG_DEBUG_SAMPLE_RATE   share of invocations logged at DEBUG (default 0)
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+DEFAULT_NAMESPACE = 'FortiWebAutoscale'
+
+_current = contextvars.ContextVar('fwb_metrics_invocation', default=None)
+
+class lazy_json(object):
+    # only serialized when a log record is really formatted
+    def __init__(self, obj):
+        self.obj = obj
+    def __str__(self):
+        try:
+            return json.dumps(self.obj)
+        except Exception:
+            return str(self.obj)
+
+class Invocation(object):
+    def __init__(self, function_name, dimensions=None):
+        self.function_name = function_name
+        self.dimensions = dict(dimensions or {})
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+        self.retries = {}
+        self.counters = {}
+        self.properties = {}
+        self.outcome = None
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed_ms, retries=0):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed_ms
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if retries > 0:
+                self.retries[name] = self.retries.get(name, 0) + retries
+
+    def add_retry(self, name, count=1):
+        with self.lock:
+            self.retries[name] = self.retries.get(name, 0) + count
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def to_emf(self, namespace):
+        total_ms = (time.perf_counter() - self.started) * 1000.0
+        record = dict(self.properties)
+        record.update(self.dimensions)
+        record['Function'] = self.function_name
+        record['Outcome'] = str(self.outcome)
+        metrics = [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+        record['Duration'] = round(total_ms, 3)
+        for name, value in self.durations.items():
+            record[name + '.Duration'] = round(value, 3)
+            record[name + '.Calls'] = self.counts[name]
+            metrics.append({'Name': name + '.Duration', 'Unit': 'Milliseconds'})
+            metrics.append({'Name': name + '.Calls', 'Unit': 'Count'})
+        record['Retries'] = sum(self.retries.values())
+        metrics.append({'Name': 'Retries', 'Unit': 'Count'})
+        for name, value in self.retries.items():
+            record[name + '.Retries'] = value
+            metrics.append({'Name': name + '.Retries', 'Unit': 'Count'})
+        for name, value in self.counters.items():
+            record[name] = value
+            metrics.append({'Name': name, 'Unit': 'Count'})
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['Function'] + sorted(self.dimensions.keys())],
+                'Metrics': metrics,
+            }],
+        }
+        return record
+
+def current():
+    return _current.get()
+
+def begin(function_name, dimensions=None):
+    inv = Invocation(function_name, dimensions)
+    _current.set(inv)
+    sample_debug()
+    return inv
+
+def end(outcome=None, inv=None):
+    if None == inv:
+        inv = current()
+    if None == inv:
+        return None
+    if None != outcome:
+        inv.outcome = outcome
+    _current.set(None)
+    if os.environ.get('METRICS_DISABLED', 'false').lower() == 'true':
+        return None
+    record = inv.to_emf(os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE))
+    sys.stdout.write(json.dumps(record) + '\n')
+    sys.stdout.flush()
+    return record
+
+def emit(values, dimensions, unit='Count'):
+    # a record of its own for gauges that are not about one invocation
+    if os.environ.get('METRICS_DISABLED', 'false').lower() == 'true':
+        return None
+    record = dict(values)
+    record.update(dimensions)
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE),
+            'Dimensions': [sorted(dimensions.keys())],
+            'Metrics': [{'Name': name, 'Unit': unit} for name in sorted(values.keys())],
+        }],
+    }
+    sys.stdout.write(json.dumps(record) + '\n')
+    sys.stdout.flush()
+    return record
+
+def bind(fn):
+    # run fn in a worker thread inside the current invocation
+    ctx = contextvars.copy_context()
+    def bound(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+    return bound
+
+@contextmanager
+def span(name):
+    inv = current()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if None != inv:
+            inv.record(name, (time.perf_counter() - start) * 1000.0)
+
+def count(name, value=1):
+    inv = current()
+    if None != inv:
+        inv.count(name, value)
+
+def sleep(name, seconds):
+    # retry sleeps are spans as well, so slow boots can be told apart from slow calls
+    inv = current()
+    if None != inv:
+        inv.add_retry(name)
+    with span('sleep.' + name):
+        time.sleep(seconds)
+
+def sample_debug():
+    # the root logger runs at LOG_LEVEL, a sampled share of invocations at DEBUG
+    level = getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    try:
+        rate = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0))
+    except ValueError:
+        rate = 0
+    if rate > 0 and random.random() < rate:
+        level = logging.DEBUG
+    logging.getLogger().setLevel(level)
+
+def _before_call(model=None, context=None, **kwargs):
+    if None != context and None != model:
+        context['fwb_metrics'] = ('%s.%s' % (model.service_model.service_name, model.name), time.perf_counter())
+
+def _after_call(context=None, parsed=None, **kwargs):
+    inv = current()
+    if None == inv or None == context or 'fwb_metrics' not in context:
+        return
+    name, start = context.pop('fwb_metrics')
+    retries = 0
+    if isinstance(parsed, dict):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    inv.record(name, (time.perf_counter() - start) * 1000.0, retries)
+
+def instrument_client(client):
+    events = client.meta.events
+    events.register('before-call.*.*', _before_call, unique_id='fwb-metrics-before-call')
+    events.register('after-call.*.*', _after_call, unique_id='fwb-metrics-after-call')
+    events.register('after-call-error.*.*', _after_call, unique_id='fwb-metrics-after-call-error')
+    return client
@@ -0,0 +1,180 @@
+##python3
+# Shared retry policy and invocation deadline for the python lambdas.
+#
+#   retry.begin(context)                    # once per invocation
+#   names = LIST_POLICY.call(list_names, bucket)
+#   retry.check_deadline('allocate')        # between steps of a loop
+#   data = retry.run_until(resolve, rpt)    # cloudformation custom resources
+#
+# Errors are sorted in three classes:
+#   THROTTLE  throttling, 5xx, timeouts and connection errors: retried with full
+#             jitter exponential backoff (sleep uniform(0, min(cap, base * 2^n)))
+#   CONFLICT  conditional check / transaction conflicts: never retried here, the
+#             caller has to re-read and try with other input (see assign_license)
+#   FATAL     access denied, validation errors, missing resources and anything not
+#             known to be transient: raised at once
+#
+# The deadline is the lambda's remaining time (context.get_remaining_time_in_millis)
+# minus a safety margin, optionally capped (API Gateway gives up after 29 s). It is
+# kept in a context variable like the metrics invocation, so worker threads started
+# through metrics.bind see it too. A retry whose backoff would end past the deadline
+# is not made, DeadlineExceeded is raised instead and the handler answers (5xx,
+# CloudFormation FAILED) while it still can.
+import time
+import random
+import logging
+import threading
+import contextvars
+import metrics
+
+logger = logging.getLogger()
+
+THROTTLE = 'throttle'
+CONFLICT = 'conflict'
+FATAL = 'fatal'
+
+SAFETY_MARGIN = 0.5
+
+THROTTLE_CODES = set([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'SlowDown',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'TransactionInProgressException', 'LimitExceededException', 'EC2ThrottledException',
+    'BandwidthLimitExceeded', 'PriorRequestNotComplete', 'RequestTimeout',
+    'RequestTimeoutException', 'InternalError', 'InternalFailure', 'InternalServerError',
+    'ServiceUnavailable', 'ServiceUnavailableException',
+])
+CONFLICT_CODES = set([
+    'ConditionalCheckFailedException', 'TransactionConflictException',
+    'TransactionCanceledException', 'OptimisticLockException', 'PreconditionFailed',
+])
+
+class DeadlineExceeded(Exception):
+    pass
+
+_deadline = contextvars.ContextVar('fwb_retry_deadline', default=None)
+
+class Deadline(object):
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context, limit=None, margin=SAFETY_MARGIN):
+        # no (real) lambda context, e.g. a local run: only the limit applies
+        try:
+            seconds = context.get_remaining_time_in_millis() / 1000.0 - margin
+        except Exception:
+            seconds = None
+        if None != limit and (None == seconds or limit < seconds):
+            seconds = limit
+        if None == seconds:
+            return None
+        return cls(seconds)
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+def begin(context, limit=None, margin=SAFETY_MARGIN):
+    deadline = Deadline.from_context(context, limit, margin)
+    _deadline.set(deadline)
+    return deadline
+
+def current():
+    return _deadline.get()
+
+def remaining(default=None):
+    deadline = current()
+    return default if None == deadline else deadline.remaining()
+
+def check_deadline(name):
+    deadline = current()
+    if None != deadline and deadline.expired():
+        metrics.count('DeadlineExceeded')
+        raise DeadlineExceeded('%s: no time left in this invocation' % (name))
+
+def error_code(e):
+    resp = getattr(e, 'response', None) or {}
+    return str(resp.get('Error', {}).get('Code', ''))
+
+def http_status(e):
+    resp = getattr(e, 'response', None) or {}
+    try:
+        return int(resp.get('ResponseMetadata', {}).get('HTTPStatusCode', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def classify(e):
+    if isinstance(e, DeadlineExceeded):
+        return FATAL
+    code = error_code(e)
+    if code in CONFLICT_CODES:
+        return CONFLICT
+    if code in THROTTLE_CODES:
+        return THROTTLE
+    status = http_status(e)
+    if 429 == status or status >= 500:
+        return THROTTLE
+    if len(code) <= 0:
+        # no service answer: connection reset, read timeout, endpoint not reachable
+        name = type(e).__name__
+        if isinstance(e, (ConnectionError, TimeoutError)) or name.endswith('TimeoutError') \
+                or name in ['EndpointConnectionError', 'ConnectionClosedError', 'ProtocolError']:
+            return THROTTLE
+    return FATAL
+
+def full_jitter(attempt, base, cap):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class RetryPolicy(object):
+    def __init__(self, name, max_attempts=5, base=0.1, cap=2.0, retry_on=(THROTTLE,)):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.retry_on = retry_on
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            check_deadline(self.name)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                attempt += 1
+                if kind not in self.retry_on or attempt >= self.max_attempts:
+                    raise
+                delay = full_jitter(attempt - 1, self.base, self.cap)
+                left = remaining()
+                if None != left and left - delay <= 0:
+                    metrics.count('DeadlineExceeded')
+                    raise DeadlineExceeded('%s: %s, no time left to retry' % (self.name, str(e)))
+                logger.warning('%s failed (%s, attempt %d), retry in %.2fs: %s', self.name, kind, attempt, delay, str(e))
+                metrics.sleep(self.name, delay)
+
+def run_until(fn, *args, **kwargs):
+    # fn in a worker thread, given up on at the deadline (the thread is left behind,
+    # the invocation is about to end anyway)
+    deadline = current()
+    if None == deadline:
+        return fn(*args, **kwargs)
+    result = {}
+    done = threading.Event()
+    def work():
+        try:
+            result['value'] = fn(*args, **kwargs)
+        except BaseException as e:
+            result['error'] = e
+        finally:
+            done.set()
+    worker = threading.Thread(target=metrics.bind(work), daemon=True)
+    worker.start()
+    if not done.wait(max(0, deadline.remaining())):
+        metrics.count('DeadlineExceeded')
+        raise DeadlineExceeded('%s did not finish before the lambda timeout' % (getattr(fn, '__name__', 'work')))
+    if 'error' in result:
+        raise result['error']
+    return result['value']
@@ -396,8 +396,15 @@ async function makeDistAwsCloudFormation(options = {excludeList: [], quickstart:
         FindAMILambdaZipFilePath;
 
     let rTempDirSrcPythonLambda = path.resolve(rTempDir, 'aws_python_lambda'),
-        rDirSrcPythonLambda = path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/license/handler.py'),
+        rDirSrcPythonLambda = path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/license/*.py'),
         PythonLambdaZipFilePath;
+    // python modules shared by every python lambda package
+    let rDirSrcPythonShared = [
+        path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/aws_clients.py'),
+        path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/metrics.py'),
+        path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/cfn_response.py'),
+        path.resolve(REAL_PROJECT_ROOT, './aws_python_lambda/retry.py')
+    ];
 
 
     let excludeList = ['local*', '.gitignore', 'autoscale_params.txt'];
@@ -427,18 +434,27 @@ async function makeDistAwsCloudFormation(options = {excludeList: [], quickstart:
     //copy and move validate lambda
     await makeDir(rTempDirSrcValidateLambda);
     await copy(rDirSrcValidateLambda, rTempDirSrcValidateLambda);
+    for (let sharedFile of rDirSrcPythonShared) {
+        await copy(sharedFile, rTempDirSrcValidateLambda);
+    }
     validateLambdaZipFilePath = await zipSafe('validate_lambda.zip', rTempDirSrcValidateLambda);
     await moveSafe(validateLambdaZipFilePath, rTempDirFunctionPackages);
 
     //copy and move python lambda
     await makeDir(rTempDirSrcPythonLambda);
     await copy(rDirSrcPythonLambda, rTempDirSrcPythonLambda);
+    for (let sharedFile of rDirSrcPythonShared) {
+        await copy(sharedFile, rTempDirSrcPythonLambda);
+    }
     PythonLambdaZipFilePath = await zipSafe('lic_lambda.zip', rTempDirSrcPythonLambda);
     await moveSafe(PythonLambdaZipFilePath, rTempDirFunctionPackages);
 
     //copy and move find ami lambda
     await makeDir(rTempDirSrcFindAMILambda);
     await copy(rDirSrcFindAMILambda, rTempDirSrcFindAMILambda);
+    for (let sharedFile of rDirSrcPythonShared) {
+        await copy(sharedFile, rTempDirSrcFindAMILambda);
+    }
     FindAMILambdaZipFilePath = await zipSafe('find_ami.zip', rTempDirSrcFindAMILambda);
     await moveSafe(FindAMILambdaZipFilePath, rTempDirFunctionPackages);
 
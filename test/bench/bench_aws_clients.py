@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Per-call latency of building AWS clients / http pools on every call (old
+# behaviour) versus reusing them through aws_clients (warm container behaviour).
+# Everything talks to a local stand-in endpoint, no AWS account is needed.
+#
+# usage: PYTHONPATH=aws_python_lambda python3 test/bench/bench_aws_clients.py [-n 200]
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import urllib3
+import aws_clients
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a reused pool really reuses its connection
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        length = int(self.headers.get('content-length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = _reply
+    do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+def start_stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % (server.server_address[1])
+
+def measure(fn, count):
+    fn()  # first call pays the cold path for both variants, leave it out
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 3),
+        'p99_ms': round(samples[int(len(samples) * 0.99) - 1], 3),
+        'mean_ms': round(statistics.mean(samples), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    server, url = start_stand_in()
+    key = {'assigned_records': {'S': 'total_records'}}
+
+    def ddb_per_call():
+        client = boto3.client('dynamodb', endpoint_url=url)
+        client.get_item(TableName='bench', Key=key)
+
+    def ddb_registry():
+        client = aws_clients.get_client('dynamodb', endpoint_url=url)
+        client.get_item(TableName='bench', Key=key)
+
+    def http_per_call():
+        urllib3.PoolManager().request('PUT', url, body='{}')
+
+    def http_registry():
+        aws_clients.get_http().request('PUT', url, body='{}')
+
+    results = {
+        'dynamodb_get_item': {
+            'before': measure(ddb_per_call, args.count),
+            'after': measure(ddb_registry, args.count),
+        },
+        'cfn_send_put': {
+            'before': measure(http_per_call, args.count),
+            'after': measure(http_registry, args.count),
+        },
+    }
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# Microbenchmarks of the pure python hot paths, no AWS calls:
+#   lookup.<n>         get_assigned_lic_name on a set layout record of n pairs
+#                      (the scan over inst_lic_pair, instance not assigned yet)
+#   parse_event.*      parse_event of base64 single / batch bodies
+#   catalog.<n>        find_latest over n synthetic image names (parse + pick)
+#   mycmp_sort.<n>     the sort find_latest did before the catalog (mycmp /
+#                      my_version below), the baseline catalog.<n> is measured against
+#   validate.<n>       validate_properties over a batch of n parameter sets
+#   calibration        a fixed python loop, an anchor for the machine speed
+#
+# Every benchmark reports the best and the median time per operation of --repeat
+# timed runs. With --baseline the run fails (exit code 1) when the best time of a
+# benchmark of the baseline got slower than --threshold (default 0.5 = 50%)
+# after scaling by the machine speed ratio (median of the per benchmark ratios,
+# so a baseline taken on another machine still compares).
+#
+# The best of several runs is the number least disturbed by the rest of the
+# machine, but on a small VM it still moves by up to 2x from one process to the
+# next (hash seed, memory layout), and re-running inside the same process does not
+# draw again. So a flagged benchmark is run again in --confirm fresh processes and
+# only counts as a regression when it stays slow in all of them, and a baseline
+# is the median of the best times of --processes fresh processes.
+#
+# The --quick suite has other inputs, it has its own baseline: comparing a quick
+# run to a full baseline (or the other way round) is refused with exit code 2.
+#
+# usage: python3 test/bench/bench_hot.py [--quick] [--only lookup,catalog]
+#            [--output result.json] [--baseline test/bench/baseline_hot.json] [--threshold 0.5]
+#            [--save-baseline test/bench/baseline_hot.json] [--processes 5]
+#        python3 test/bench/bench_hot.py --quick --baseline test/bench/baseline_hot_quick.json
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import functools
+import statistics
+import subprocess
+import tempfile
+import gc
+from unittest.mock import patch
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+for p in ['aws_python_lambda', 'aws_python_lambda/license', 'aws_cloudformation/templates']:
+    sys.path.insert(0, os.path.join(ROOT, p))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('METRICS_DISABLED', 'true')
+
+import logging
+import assignment_store
+import handler
+import find_ami
+import validate_lambda
+
+DEFAULT_THRESHOLD = 0.5
+# the smallest time one timed run should take, short runs are mostly noise
+MIN_RUN_SECONDS = 0.1
+MIN_SCALE_SAMPLES = 5
+DEFAULT_CONFIRM = 3
+DEFAULT_PROCESSES = 5
+
+def timed(fn, repeat):
+    # calibrate the loop count once, then time 'repeat' runs of it, like timeit
+    # without the garbage collector kicking in at random points
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _timed(fn, repeat)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def _timed(fn, repeat):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_RUN_SECONDS or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(MIN_RUN_SECONDS / elapsed) + 1))
+    samples = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number * 1e9)
+    return {'ns_per_op': round(statistics.median(samples), 1), 'best_ns': round(min(samples), 1),
+            'number': number, 'repeat': repeat}
+
+def calibration():
+    total = 0
+    for i in range(10000):
+        total += i * i
+    return total
+
+# --- workloads ---------------------------------------------------------------
+
+def lookup_bench(pairs):
+    records = []
+    for i in range(pairs):
+        instance_id = 'i-%017x' % (i)
+        lic_name = 'lic%06d.lic' % (i)
+        records += [instance_id, lic_name, instance_id + assignment_store.MAGIC_CONCATENATOR + lic_name]
+    def run():
+        handler.get_assigned_lic_name('table', 'i-not-assigned')
+    run.patches = [patch.object(assignment_store.SetAssignmentStore, 'read_records', new=lambda self, consistent=False: records)]
+    return run
+
+def parse_event_bench(instances):
+    if instances <= 0:
+        body = json.dumps({'instance': 'i-0123456789abcdef0', 'mode': 'url'})
+    else:
+        body = json.dumps({'instances': ['i-%017x' % (i) for i in range(instances)]})
+    event = {'isBase64Encoded': True, 'body': base64.b64encode(body.encode()).decode(),
+            'headers': {'Accept': 'application/json'}}
+    return lambda: handler.parse_event(event)
+
+def image_names(count, pay_type='_BYOL'):
+    rand = random.Random(count)
+    images = []
+    for i in range(count):
+        version = '%d.%d.%d' % (rand.randint(5, 7), rand.randint(0, 9), rand.randint(0, 20))
+        if 0 == i % 3:
+            version += '.build%04d' % (rand.randint(0, 2000))
+        images.append({'name': 'FortiWeb-AWS-%s%s-%d' % (version, pay_type, i), 'ami_id': 'ami-%08x' % (i)})
+    return images
+
+def catalog_bench(count):
+    images = image_names(count)
+    def run():
+        find_ami.g_catalogs.clear()
+        find_ami.find_latest('_BYOL', None, 'us-east-1')
+    run.patches = [patch('find_ami.find_amis', new=lambda filters, region=None: [dict(i) for i in images]),
+            patch('find_ami.print', new=lambda *args, **kwargs: None, create=True)]
+    return run
+
+# the comparator find_ami sorted with before AmiCatalog, the baseline of catalog.<n>
+
+class my_version(str):
+    def __init__(self, str_version):
+        version = str_version.split('.')
+        self.major = self.minor = self.patch = 0
+        if len(version) >= 1:
+            self.major = int(version[0])
+        if len(version) >= 2:
+            self.minor = int(version[1])
+        if len(version) >= 3:
+            self.patch = int(version[2])
+
+#input: {'name': 'xx', 'ami_id': 'xx', 'version': 'x.y.z'}
+def mycmp(x, y):
+    xv = my_version(x['version'])
+    yv = my_version(y['version'])
+    ret = xv.major - yv.major
+    if 0 != ret:
+        return ret
+    ret = xv.minor - yv.minor
+    if 0 != ret:
+        return ret
+    ret = xv.patch - yv.patch
+    return ret
+
+def mycmp_sort_bench(count):
+    images = image_names(count)
+    for image in images:
+        image['version'] = image['name'].split('FortiWeb-AWS-')[1].split('_BYOL')[0].split('.build')[0]
+    return lambda: sorted(images, key=functools.cmp_to_key(mycmp), reverse=True)[0]
+
+def validate_bench(count):
+    rand = random.Random(count)
+    records = []
+    for i in range(count):
+        asgmin = rand.randint(0, 4)
+        records.append({'FortiWebAsgCapacityBYOL': str(rand.randint(0, 4)),
+            'FortiWebAsgMinSizeOnDemand': str(asgmin),
+            'FortiWebAsgDesiredCapacityOnDemand': str(asgmin + rand.randint(0, 2)),
+            'FortiWebAsgMaxSizeOnDemand': str(asgmin + rand.randint(0, 6)),
+            'FortiWebAsgScaleInThreshold': str(rand.randint(10, 40)),
+            'FortiWebAsgScaleOutThreshold': str(rand.randint(30, 90)),
+            'AddNewElasticIPorNot': rand.choice(['yes', 'no']),
+            'FortiWebElasticIP': rand.choice(['10.0.0.%d' % (i % 256), 'eip-name', ''])})
+    def run():
+        for record in records:
+            validate_lambda.validate_properties(record)
+    return run
+
+def benchmarks(quick):
+    lookup_sizes = [10, 1000, 10000] if quick else [10, 1000, 10000, 100000]
+    image_sizes = [100, 1000] if quick else [100, 1000, 5000]
+    validate_sizes = [100] if quick else [100, 10000]
+    benches = [('calibration', lambda: calibration)]
+    benches += [('lookup.%d' % (n), functools.partial(lookup_bench, n)) for n in lookup_sizes]
+    benches += [('parse_event.single', functools.partial(parse_event_bench, 0)),
+                ('parse_event.batch200', functools.partial(parse_event_bench, 200))]
+    benches += [('catalog.%d' % (n), functools.partial(catalog_bench, n)) for n in image_sizes]
+    benches += [('mycmp_sort.%d' % (n), functools.partial(mycmp_sort_bench, n)) for n in image_sizes]
+    benches += [('validate.%d' % (n), functools.partial(validate_bench, n)) for n in validate_sizes]
+    return benches
+
+# --- run / compare -------------------------------------------------------------
+
+def selected(name, only):
+    # 'lookup' selects every lookup.<n>, 'lookup.1000' only that one
+    return None == only or any(name == o or name.startswith(o + '.') for o in only)
+
+def run(only=None, quick=False, repeat=7):
+    results = {}
+    for name, setup in benchmarks(quick):
+        if not selected(name, only):
+            continue
+        fn = setup()
+        # stand-ins for the AWS reads stay out of the timed loop
+        patches = getattr(fn, 'patches', [])
+        for p in patches:
+            p.start()
+        try:
+            results[name] = timed(fn, repeat)
+        finally:
+            for p in patches:
+                p.stop()
+    return {
+        'meta': {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                 'machine': platform.machine(), 'quick': quick, 'created_at': int(time.time())},
+        'results': results,
+    }
+
+def run_fresh(only=None, quick=False, repeat=7):
+    # the same run in a new python process, it draws a new hash seed and memory layout
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'report.json')
+        argv = [sys.executable, os.path.abspath(__file__), '--repeat', str(repeat),
+                '--min-time', str(MIN_RUN_SECONDS), '--output', output]
+        if quick:
+            argv.append('--quick')
+        if None != only:
+            argv += ['--only', ','.join(only)]
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            return json.load(f)
+
+def run_baseline(only, quick, repeat, processes):
+    # per benchmark the median over the processes of their best time
+    reports = [run_fresh(only, quick, repeat) for i in range(processes)]
+    results = {}
+    for name in reports[0]['results'].keys():
+        samples = [r['results'][name] for r in reports if name in r['results']]
+        results[name] = {'ns_per_op': round(statistics.median(s['ns_per_op'] for s in samples), 1),
+                'best_ns': round(statistics.median(s['best_ns'] for s in samples), 1),
+                'number': samples[0]['number'], 'repeat': samples[0]['repeat']}
+    meta = dict(reports[0]['meta'])
+    meta['processes'] = processes
+    return {'meta': meta, 'results': results}
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    # [(name, baseline ns scaled to this machine, ns now, change)], change > threshold is a regression
+    base = baseline.get('results', {})
+    now = report['results']
+    names = sorted(n for n in now.keys() if n in base and base[n]['best_ns'] > 0)
+    # machine speed: the median ratio over every shared benchmark, one benchmark
+    # getting slower does not move it. A handful (--only) says nothing, then the
+    # calibration loop alone is used.
+    ratios = [now[n]['best_ns'] / base[n]['best_ns'] for n in names]
+    scale = 1.0
+    if len(ratios) >= MIN_SCALE_SAMPLES:
+        scale = statistics.median(ratios)
+    elif 'calibration' in names:
+        scale = now['calibration']['best_ns'] / base['calibration']['best_ns']
+    rows = []
+    for name in names:
+        if 'calibration' == name:
+            continue
+        expected = base[name]['best_ns'] * scale
+        change = (now[name]['best_ns'] - expected) / expected
+        rows.append((name, expected, now[name]['best_ns'], change))
+    regressions = [row for row in rows if row[3] > threshold]
+    return rows, regressions, scale
+
+def confirm(report, baseline, threshold, quick, repeat, rounds):
+    # a flagged benchmark is run again in a fresh process, a regression only
+    # counts when it stays. The calibration loop goes along for the --only scale.
+    rows, regressions, scale = compare(report, baseline, threshold)
+    for i in range(rounds):
+        if len(regressions) <= 0:
+            break
+        again = run_fresh([name for name, expected, now, change in regressions] + ['calibration'], quick, repeat)
+        # the best calibration of the same process as the best benchmark time
+        # would mix processes, the scale stays the one of the first run
+        del again['results']['calibration']
+        for name, result in again['results'].items():
+            if result['best_ns'] < report['results'][name]['best_ns']:
+                report['results'][name] = result
+        rows, regressions, scale = compare(report, baseline, threshold)
+    return rows, regressions, scale
+
+def main(argv):
+    global MIN_RUN_SECONDS
+    parser = argparse.ArgumentParser(description='microbenchmarks of the pure python hot paths')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for CI smoke runs')
+    parser.add_argument('--only', default=None, help='comma separated benchmark name prefixes')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    parser.add_argument('--baseline', default=None, help='fail on regressions against this report')
+    parser.add_argument('--min-time', type=float, default=MIN_RUN_SECONDS, help='seconds of one timed run')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--confirm', type=int, default=DEFAULT_CONFIRM,
+            help='re-runs of a flagged benchmark in fresh processes before it fails')
+    parser.add_argument('--save-baseline', default=None, help='write a new baseline from --processes runs')
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES)
+    args = parser.parse_args(argv)
+    MIN_RUN_SECONDS = args.min_time
+    baseline = None
+    if None != args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        modes = {True: 'quick', False: 'full'}
+        base_quick = bool(baseline.get('meta', {}).get('quick'))
+        if base_quick != args.quick:
+            print('%s is a %s baseline, it cannot gate a %s run' % (args.baseline, modes[base_quick], modes[args.quick]))
+            return 2
+    #the error paths log on every call, that is not what is measured
+    logging.disable(logging.CRITICAL)
+    only = args.only.split(',') + ['calibration'] if None != args.only else None
+    if None != args.save_baseline:
+        report = run_baseline(only, args.quick, args.repeat, args.processes)
+    else:
+        report = run(only, args.quick, args.repeat)
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if None != args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    if None != args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(content + '\n')
+    if None == baseline:
+        print(content)
+        return 0
+    rows, regressions, scale = confirm(report, baseline, args.threshold, args.quick, args.repeat, args.confirm)
+    print('machine speed ratio: %.2f, threshold: %+.0f%%' % (scale, args.threshold * 100))
+    for name, expected, now, change in rows:
+        mark = 'REGRESSION' if change > args.threshold else 'ok'
+        print('%-22s %14.1f ns %14.1f ns %+7.1f%% %s' % (name, expected, now, change * 100, mark))
+    if len(regressions) > 0:
+        print('%d benchmark(s) regressed beyond %.0f%%' % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Cold start cost of the three python lambdas: module import time and first
+# invocation latency, each measured in a fresh interpreter like a new lambda
+# container. Nothing talks to AWS: CloudFormation responses go to a local
+# stand-in and the license handler runs on test/mock/fake_aws.py (so its first
+# call does not include building real boto3 clients).
+#
+# usage: python3 test/bench/bench_startup.py [--runs 5] [--output startup.json]
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+PYTHONPATH = os.pathsep.join(os.path.join(ROOT, p) for p in [
+    'aws_python_lambda', 'aws_python_lambda/license', 'aws_cloudformation/templates', 'test/mock'])
+
+# runs in the child interpreter, prints one JSON line
+PROBE = r'''
+import sys, time, json, threading
+start = time.perf_counter()
+module = __import__(MODULE)
+import_ms = (time.perf_counter() - start) * 1000.0
+loaded = {'boto3': 'boto3' in sys.modules, 'botocore': 'botocore' in sys.modules,
+          'urllib3': 'urllib3' in sys.modules, 'modules': len(sys.modules)}
+from unittest.mock import Mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(('127.0.0.1', 0), StandIn)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+context = Mock()
+context.get_remaining_time_in_millis.return_value = 30 * 1000
+context.log_group_name = 'log_group'
+context.log_stream_name = 'log_stream'
+cfn_event = {'ResponseURL': 'http://127.0.0.1:%d/' % (server.server_address[1]), 'StackId': 'StackId',
+    'RequestId': 'RequestId', 'LogicalResourceId': 'LogicalResourceId'}
+
+start = time.perf_counter()
+if 'validate_lambda' == MODULE:
+    cfn_event['RequestType'] = 'Create'
+    cfn_event['ResourceProperties'] = {'FortiWebAsgCapacityBYOL': '2', 'FortiWebAsgMinSizeOnDemand': '1',
+        'FortiWebAsgDesiredCapacityOnDemand': '2', 'FortiWebAsgMaxSizeOnDemand': '4',
+        'FortiWebAsgScaleInThreshold': '25', 'FortiWebAsgScaleOutThreshold': '80',
+        'FortiWebVersionShow': 'LATEST', 'AddNewElasticIPorNot': 'no', 'FortiWebElasticIP': '1.1.1.1'}
+    module.handler(cfn_event, context)
+elif 'find_ami' == MODULE:
+    cfn_event['RequestType'] = 'Delete'
+    cfn_event['ResourceProperties'] = {}
+    module.handler(cfn_event, context)
+else:
+    from unittest.mock import patch
+    import fake_aws
+    aws = fake_aws.FakeAws()
+    aws.add_licenses('prefix/license/', 4)
+    aws.add_instances('asg-byol', ['i-1'])
+    with patch('aws_clients.get_client', aws.get_client):
+        ret = module.lambda_handler({'isBase64Encoded': False, 'body': '{"instance": "i-1"}'}, {})
+    assert(200 == ret['statusCode'])
+first_call_ms = (time.perf_counter() - start) * 1000.0
+server.server_close()
+loaded.update({'import_ms': import_ms, 'first_call_ms': first_call_ms})
+sys.stdout.write('STARTUP ' + json.dumps(loaded) + '\n')
+'''
+
+HANDLERS = ['handler', 'find_ami', 'validate_lambda']
+
+def probe(module):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = PYTHONPATH
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.update({'BYOL_ASG_NAME': 'asg-byol', 'S3Bucket': 'fake-S3Bucket', 'S3Prefix': 'prefix',
+        'CUSTOM_ID': 'c', 'UNIQUE_ID': 'u', 'METRICS_DISABLED': 'true', 'LOG_LEVEL': 'ERROR',
+        'PYTHONDONTWRITEBYTECODE': '1'})
+    code = 'MODULE = %r\n%s' % (module, PROBE)
+    out = subprocess.run([sys.executable, '-c', code], env=env, cwd=ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+    for line in out.stdout.splitlines():
+        if line.startswith('STARTUP '):
+            return json.loads(line[len('STARTUP '):])
+    raise Exception('startup probe of %s failed:\n%s' % (module, out.stderr[-2000:]))
+
+def measure(module, runs=3):
+    samples = [probe(module) for i in range(runs)]
+    result = dict(samples[-1])
+    for name in ['import_ms', 'first_call_ms']:
+        result[name] = round(statistics.median(s[name] for s in samples), 2)
+    result['runs'] = runs
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='python lambda cold start benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    args = parser.parse_args()
+    report = dict((module, measure(module, args.runs)) for module in HANDLERS)
+    content = json.dumps(report, indent=2, sort_keys=True)
+    print(content)
+    if None != args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Concurrent load harness for the license API, runs offline on test/mock/fake_aws.py.
+# Every simulated FortiWeb keeps calling handler.lambda_handler until it gets a
+# license (like the real boot client does), then the harness reports throughput,
+# time-to-license percentiles, write conflicts and any double assignment.
+#
+# usage: PYTHONPATH=aws_python_lambda:aws_python_lambda/license:test/mock \
+#        python3 test/bench/license_load.py --instances 200 --licenses 200 --concurrency 200
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import fake_aws
+
+TABLE = 'fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID'
+LIC_DIR = 'fake-S3Prefix/license/'
+
+def setup_env(layout):
+    os.environ['BYOL_ASG_NAME'] = 'fake-BYOL_ASG_NAME'
+    os.environ['S3Bucket'] = 'fake-S3Bucket'
+    os.environ['S3Prefix'] = 'fake-S3Prefix'
+    os.environ['CUSTOM_ID'] = 'fake-CUSTOM_ID'
+    os.environ['UNIQUE_ID'] = 'fake-UNIQUE_ID'
+    os.environ['LICENSE_RECORD_LAYOUT'] = layout
+    os.environ['LOG_LEVEL'] = 'WARNING'
+    os.environ['METRICS_DISABLED'] = 'true'
+
+def cold_start():
+    # every run starts like a fresh lambda container
+    import license_inventory
+    import asg_membership
+    import assignment_cache
+    license_inventory._inventories.clear()
+    asg_membership._checkers.clear()
+    assignment_cache._caches.clear()
+
+def make_event(instance_id):
+    return {'isBase64Encoded': False, 'body': json.dumps({'instance': instance_id})}
+
+def percentile(samples, pct):
+    if len(samples) <= 0:
+        return 0.0
+    samples = sorted(samples)
+    index = min(len(samples) - 1, max(0, int(round(len(samples) * pct / 100.0)) - 1))
+    return samples[index]
+
+def boot(handler, instance_id, max_tries, retry_interval):
+    start = time.perf_counter()
+    for tries in range(1, max_tries + 1):
+        try:
+            ret = handler.lambda_handler(make_event(instance_id), {})
+            if 200 == ret['statusCode']:
+                return {'instance_id': instance_id, 'body': ret['body'], 'tries': tries,
+                        'seconds': time.perf_counter() - start}
+        except Exception:
+            #the boot client just asks again
+            pass
+        time.sleep(retry_interval)
+    return {'instance_id': instance_id, 'body': None, 'tries': max_tries,
+            'seconds': time.perf_counter() - start}
+
+def run(instances=100, licenses=100, concurrency=100, latency_ms=5, jitter_ms=5,
+        layout='set', max_tries=20, retry_interval=0.05):
+    setup_env(layout)
+    aws = fake_aws.FakeAws(latency_ms=latency_ms, jitter_ms=jitter_ms)
+    aws.add_licenses(LIC_DIR, licenses)
+    instance_ids = ['i-%08d' % (i) for i in range(instances)]
+    aws.add_instances('fake-BYOL_ASG_NAME', instance_ids)
+    with patch('aws_clients.get_client', aws.get_client):
+        import handler
+        cold_start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda i: boot(handler, i, max_tries, retry_interval), instance_ids))
+        elapsed = time.perf_counter() - start
+    granted = [r for r in results if None != r['body']]
+    seconds = [r['seconds'] * 1000.0 for r in granted]
+    pairs, double = aws.assignments(TABLE)
+    answered = {}
+    for r in granted:
+        answered.setdefault(r['body'], []).append(r['instance_id'])
+    double_answers = dict((k, v) for k, v in answered.items() if len(v) > 1)
+    return {
+        'layout': layout,
+        'instances': instances,
+        'licenses': licenses,
+        'concurrency': concurrency,
+        'latency_ms': latency_ms,
+        'licensed': len(granted),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(granted) / elapsed, 1) if elapsed > 0 else 0,
+        'p50_ms': round(percentile(seconds, 50), 1),
+        'p99_ms': round(percentile(seconds, 99), 1),
+        'requests': sum(r['tries'] for r in results),
+        'conflicts': aws.conflicts,
+        'aws_calls': aws.calls,
+        'double_assigned_records': double,
+        'double_assigned_answers': double_answers,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='license API load harness')
+    parser.add_argument('--instances', type=int, default=100)
+    parser.add_argument('--licenses', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--layout', choices=['set', 'item'], default='set')
+    parser.add_argument('--max-tries', type=int, default=20)
+    args = parser.parse_args(argv)
+    report = run(args.instances, args.licenses, args.concurrency, args.latency_ms,
+            args.jitter_ms, args.layout, args.max_tries)
+    print(json.dumps(report, indent=2))
+    if report['double_assigned_records'] or report['double_assigned_answers']:
+        return 1
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+from unittest.mock import Mock
+from unittest.mock import patch
+import asg_membership
+
+GROUPS = {'i-byol': 'asg-byol', 'i-ondemand': 'asg-ondemand', 'i-other': 'asg-other'}
+
+def describe_auto_scaling_instances(InstanceIds):
+    return {
+        'AutoScalingInstances': [{'InstanceId': i, 'AutoScalingGroupName': GROUPS[i]}
+            for i in InstanceIds if i in GROUPS]
+    }
+
+def make_client():
+    mock_client = Mock()
+    mock_client.describe_auto_scaling_instances = Mock(side_effect=describe_auto_scaling_instances)
+    return mock_client
+
+@patch('aws_clients.get_client')
+def test_members_cached(mock_get_client):
+    print('Test: positive answers are served from the warm cache, several groups supported')
+    mock_client = make_client()
+    mock_get_client.return_value = mock_client
+    checker = asg_membership.AsgMembership('asg-byol, asg-ondemand', ttl=60)
+    assert(checker.is_member('i-byol'))
+    assert(checker.is_member('i-ondemand'))
+    assert(not checker.is_member('i-other'))
+    for i in range(10):
+        assert(checker.is_member('i-byol'))
+    assert(3 == mock_client.describe_auto_scaling_instances.call_count)
+    print()
+
+@patch('asg_membership.time')
+@patch('aws_clients.get_client')
+def test_negative_backoff(mock_get_client, mock_time):
+    print('Test: negative answers are refreshed only after a growing backoff')
+    mock_client = make_client()
+    mock_get_client.return_value = mock_client
+    mock_time.time.return_value = 1000.0
+    checker = asg_membership.AsgMembership(['asg-byol'], ttl=60, negative_backoff=2, negative_backoff_max=30)
+    assert(not checker.is_member('i-late'))
+    assert(not checker.is_member('i-late'))
+    assert(1 == mock_client.describe_auto_scaling_instances.call_count)
+    mock_time.time.return_value = 1002.5
+    assert(not checker.is_member('i-late'))
+    assert(2 == mock_client.describe_auto_scaling_instances.call_count)
+    # second miss doubles the backoff to 4 seconds
+    mock_time.time.return_value = 1005.0
+    assert(not checker.is_member('i-late'))
+    assert(2 == mock_client.describe_auto_scaling_instances.call_count)
+    GROUPS['i-late'] = 'asg-byol'
+    mock_time.time.return_value = 1007.0
+    assert(checker.is_member('i-late'))
+    assert(3 == mock_client.describe_auto_scaling_instances.call_count)
+    print()
+
+@patch('aws_clients.get_client')
+def test_check_many(mock_get_client):
+    print('Test: batch check describes 50 ids per call')
+    mock_client = make_client()
+    mock_get_client.return_value = mock_client
+    checker = asg_membership.AsgMembership(['asg-byol'])
+    ids = ['i-%d' % (i) for i in range(120)] + ['i-byol']
+    assert(set(['i-byol']) == checker.check_many(ids))
+    assert(3 == mock_client.describe_auto_scaling_instances.call_count)
+    print()
+
+
+if '__main__' == __name__:
+    test_members_cached()
+    test_negative_backoff()
+    test_check_many()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+from unittest.mock import patch
+import botocore.exceptions
+import assignment_store
+import migrate_license_records
+
+MAGIC = assignment_store.MAGIC_CONCATENATOR
+
+class fake_ddb(object):
+    # just enough of get_item / transact_write_items / update_item for the stores
+    def __init__(self, legacy_records=None):
+        self.items = {}
+        if legacy_records:
+            self.items['total_records'] = {
+                'assigned_records': {'S': 'total_records'},
+                'inst_lic_pair': {'SS': list(legacy_records)},
+            }
+    def get_item(self, TableName, Key, ConsistentRead=False, **kwargs):
+        item = self.items.get(Key['assigned_records']['S'])
+        if None == item:
+            return {}
+        return {'Item': item}
+    def transact_write_items(self, TransactItems):
+        reasons = []
+        for t in TransactItems:
+            key = t['Put']['Item']['assigned_records']['S']
+            reasons.append({'Code': 'ConditionalCheckFailed' if key in self.items else 'None'})
+        if any('None' != r['Code'] for r in reasons):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'TransactionCanceledException'},
+                    'CancellationReasons': reasons}, 'TransactWriteItems')
+        for t in TransactItems:
+            self.items[t['Put']['Item']['assigned_records']['S']] = t['Put']['Item']
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table, request in RequestItems.items():
+            responses[table] = [self.items[k['assigned_records']['S']] for k in request['Keys']
+                if k['assigned_records']['S'] in self.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        item = self.items[Key['assigned_records']['S']]
+        removed = set(ExpressionAttributeValues[':records']['SS'])
+        item['inst_lic_pair']['SS'] = [r for r in item['inst_lic_pair']['SS'] if r not in removed]
+
+def legacy_records(pairs):
+    records = []
+    for instance_id, lic_name in pairs:
+        records += [instance_id, lic_name, instance_id + MAGIC + lic_name]
+    return records
+
+@patch('aws_clients.get_client')
+def test_item_store_unique(mock_get_client):
+    print('Test: item layout keeps instance and license unique')
+    ddb = fake_ddb()
+    mock_get_client.return_value = ddb
+    store = assignment_store.get_store('table', assignment_store.LAYOUT_ITEM)
+    assert(assignment_store.ASSIGNED == store.put_if_not_exists('i-1', 'lic1.lic'))
+    assert(assignment_store.INSTANCE_TAKEN == store.put_if_not_exists('i-1', 'lic2.lic'))
+    assert(assignment_store.CONFLICT == store.put_if_not_exists('i-2', 'lic1.lic'))
+    assert('lic1.lic' == store.get('i-1'))
+    assert(None == store.get('i-2'))
+    lic_name, version = store.get_entry('i-1')
+    assert('lic1.lic' == lic_name and 32 == len(version))
+    assert(None == store.get_entry('i-2'))
+    print()
+
+@patch('aws_clients.get_client')
+def test_item_store_batch(mock_get_client):
+    print('Test: item layout batch write is all or nothing')
+    ddb = fake_ddb()
+    mock_get_client.return_value = ddb
+    store = assignment_store.ItemAssignmentStore('table')
+    assert(assignment_store.ASSIGNED == store.put_many_if_not_exists([('i-1', 'lic1.lic'), ('i-2', 'lic2.lic')]))
+    assert(assignment_store.CONFLICT == store.put_many_if_not_exists([('i-3', 'lic3.lic'), ('i-4', 'lic2.lic')]))
+    assert({'i-1': 'lic1.lic', 'i-2': 'lic2.lic'} == store.get_many(['i-1', 'i-2', 'i-3']))
+    assert({'lic2.lic'} == store.taken_licenses(['lic2.lic', 'lic3.lic']))
+    print()
+
+@patch('aws_clients.get_client')
+def test_set_store_lookup(mock_get_client):
+    print('Test: set layout lookup')
+    mock_get_client.return_value = fake_ddb(legacy_records([('i-1', 'lic1.lic'), ('i-2', 'lic2.lic')]))
+    store = assignment_store.get_store('table', assignment_store.LAYOUT_SET)
+    assert('lic2.lic' == store.get('i-2'))
+    assert({'i-1': 'lic1.lic', 'i-2': 'lic2.lic'} == store.list_assignments())
+    assert({'lic2.lic'} == store.taken_licenses(['lic2.lic', 'lic3.lic']))
+    print()
+
+@patch('aws_clients.get_client')
+def test_migrate(mock_get_client):
+    print('Test: migrate set layout into item layout')
+    ddb = fake_ddb(legacy_records([('i-1', 'lic1.lic'), ('i-2', 'lic2.lic'), ('i-3', 'lic3.lic')]))
+    mock_get_client.return_value = ddb
+    report = migrate_license_records.migrate('table', dry_run=True)
+    assert(3 == len(report['migrated']))
+    assert(0 == len(ddb.items) - 1)
+    report = migrate_license_records.migrate('table')
+    assert(3 == len(report['migrated']))
+    store = assignment_store.ItemAssignmentStore('table')
+    assert('lic3.lic' == store.get('i-3'))
+    # run again: every pair is already there
+    report = migrate_license_records.migrate('table', remove_legacy=True)
+    assert(3 == len(report['skipped']))
+    assert([] == ddb.items['total_records']['inst_lic_pair']['SS'])
+    print()
+
+
+if '__main__' == __name__:
+    test_item_store_unique()
+    test_item_store_batch()
+    test_set_store_lookup()
+    test_migrate()
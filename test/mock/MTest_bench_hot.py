@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import bench_hot
+
+def result(best_ns):
+    return {'ns_per_op': best_ns, 'best_ns': best_ns, 'number': 1, 'repeat': 1}
+
+def report(values):
+    return {'meta': {}, 'results': dict((name, result(ns)) for name, ns in values.items())}
+
+def test_compare_scales_by_machine_speed():
+    print('Test: a uniformly slower machine is no regression, one slower benchmark is')
+    names = ['a', 'b', 'c', 'd', 'e', 'f']
+    baseline = report(dict((n, 1000.0) for n in names + ['calibration']))
+    slower_machine = report(dict((n, 2000.0) for n in names + ['calibration']))
+    rows, regressions, scale = bench_hot.compare(slower_machine, baseline, 0.3)
+    assert(2.0 == scale)
+    assert([] == regressions)
+    assert(len(names) == len(rows))
+    values = dict((n, 2000.0) for n in names + ['calibration'])
+    values['c'] = 3000.0
+    rows, regressions, scale = bench_hot.compare(report(values), baseline, 0.3)
+    assert(['c'] == [row[0] for row in regressions])
+    # few benchmarks (--only): the calibration loop gives the scale
+    values = {'calibration': 2000.0, 'a': 2000.0, 'b': 2600.0}
+    rows, regressions, scale = bench_hot.compare(report(values), baseline, 0.3)
+    assert(2.0 == scale)
+    assert([] == regressions)
+    print()
+
+def test_smoke_run_and_gate():
+    print('Test: a quick run writes a JSON report and fails against a much faster baseline, in a fresh process too')
+    bench_hot.MIN_RUN_SECONDS = 0.01
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'now.json')
+        assert(0 == bench_hot.main(['--quick', '--only', 'parse_event', '--repeat', '1', '--output', output]))
+        with open(output) as f:
+            now = json.load(f)
+        assert(['calibration', 'parse_event.batch200', 'parse_event.single'] == sorted(now['results'].keys()))
+        assert(now['results']['parse_event.single']['ns_per_op'] > 0)
+        baseline = json.loads(json.dumps(now))
+        for name in ['parse_event.batch200', 'parse_event.single']:
+            baseline['results'][name]['best_ns'] /= 100.0
+        path = os.path.join(directory, 'baseline.json')
+        with open(path, 'w') as f:
+            json.dump(baseline, f)
+        assert(1 == bench_hot.main(['--quick', '--only', 'parse_event', '--repeat', '1', '--confirm', '0',
+                '--baseline', path]))
+        assert(1 == bench_hot.main(['--quick', '--only', 'parse_event.single', '--repeat', '1', '--confirm', '1',
+                '--baseline', path]))
+        # a quick baseline does not gate a full run
+        assert(2 == bench_hot.main(['--only', 'parse_event', '--baseline', path]))
+    print()
+
+
+if '__main__' == __name__:
+    test_compare_scales_by_machine_speed()
+    test_smoke_run_and_gate()
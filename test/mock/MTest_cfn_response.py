@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import json
+import time
+import threading
+from unittest.mock import Mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import aws_clients
+import cfn_response
+
+class StandIn(BaseHTTPRequestHandler):
+    # pre-signed ResponseURL stand-in: answers the queued status codes, then 200
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    statuses = []
+    bodies = []
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        StandIn.bodies.append(body)
+        status = StandIn.statuses.pop(0) if len(StandIn.statuses) > 0 else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def start_stand_in(statuses):
+    StandIn.statuses = list(statuses)
+    StandIn.bodies = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_event(server):
+    event = {}
+    event['ResponseURL'] = 'http://127.0.0.1:%d/presigned' % (server.server_address[1])
+    event['StackId'] = 'fake_StackId'
+    event['RequestId'] = 'fake_RequestId'
+    event['LogicalResourceId'] = 'fake_LogicalResourceId'
+    return event
+
+def get_context(remaining_ms=10*1000):
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = remaining_ms
+    context.log_group_name = 'fake_log_group_name'
+    context.log_stream_name = 'fake_log_stream_name'
+    return context
+
+def test_retry_then_success():
+    print('Test: 5xx answers are retried on the pooled connection')
+    aws_clients.reset()
+    server = start_stand_in([503, 500])
+    ok = cfn_response.send(get_event(server), get_context(), cfn_response.SUCCESS, {'a': 'b'}, 'no error')
+    server.shutdown()
+    assert(ok)
+    assert(3 == len(StandIn.bodies))
+    body = json.loads(StandIn.bodies[-1])
+    assert('SUCCESS' == body['Status'])
+    assert({'a': 'b'} == body['Data'])
+    assert(body['Reason'].startswith('no error'))
+    print()
+
+def test_client_error_not_retried():
+    print('Test: a 403 (expired url) is not retried')
+    aws_clients.reset()
+    server = start_stand_in([403])
+    ok = cfn_response.send(get_event(server), get_context(), cfn_response.FAILED, {}, 'bad')
+    server.shutdown()
+    assert(not ok)
+    assert(1 == len(StandIn.bodies))
+    print()
+
+def test_deadline():
+    print('Test: retries stop when the lambda is about to time out')
+    aws_clients.reset()
+    server = start_stand_in([500] * 10)
+    start = time.time()
+    ok = cfn_response.send(get_event(server), get_context(1200), cfn_response.SUCCESS, {}, '')
+    server.shutdown()
+    assert(not ok)
+    assert(1 == len(StandIn.bodies))
+    assert(time.time() - start < 1.0)
+    print()
+
+def test_reason_truncated():
+    print('Test: a long Reason is cut to fit the 4096 bytes limit')
+    aws_clients.reset()
+    server = start_stand_in([])
+    reason = 'parameter "x" is not valid\n' * 400
+    ok = cfn_response.send(get_event(server), get_context(), cfn_response.FAILED, {'k': 'v'}, reason)
+    server.shutdown()
+    assert(ok)
+    assert(len(StandIn.bodies[0]) <= cfn_response.MAX_RESPONSE_BYTES)
+    body = json.loads(StandIn.bodies[0])
+    assert(body['Reason'].startswith('parameter "x"'))
+    assert(cfn_response.TRUNCATED_MARK in body['Reason'])
+    assert(body['Reason'].endswith('fake_log_stream_name'))
+    print()
+
+
+if '__main__' == __name__:
+    test_retry_then_success()
+    test_client_error_not_retried()
+    test_deadline()
+    test_reason_truncated()
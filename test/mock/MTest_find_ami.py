@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import time
+from unittest.mock import Mock
+from unittest.mock import patch
+import find_ami
+
+def get_default_event():
+    event = {}
+    event['RequestType'] = 'Create'
+    event['ResponseURL'] = 'http://127.0.0.1:3000'
+    event['StackId'] = 'fake_StackId'
+    event['RequestId'] = 'fake_RequestId'
+    event['LogicalResourceId'] = 'fake_LogicalResourceId'
+    event['ResourceProperties'] = {'ServiceToken': 'arn', 'BYOLAMIName': '', 'OnDemandAMIName': ''}
+    return event
+
+def get_default_context():
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 10*1000
+    context.log_group_name = 'fake_log_group_name'
+    context.log_stream_name = 'fake_log_stream_name'
+    return context
+
+def slow_find_latest(pay_type, ami_name=None, region=None, version=None):
+    time.sleep(0.3)
+    return {'name': 'FortiWeb-AWS-7.4.1%s' % (pay_type), 'ami_id': 'ami-%s' % (pay_type.strip('_').lower()), 'version': '7.4.1'}
+
+@patch('find_ami.cfn_send')
+@patch('find_ami.find_latest')
+def test_parallel_and_cached(mock_find_latest, mock_cfn_send):
+    print('Test: BYOL and OnDemand are resolved together, then served from cache')
+    find_ami.g_ami_cache.clear()
+    stamps = {}
+    def stamped_find_latest(pay_type, ami_name=None, region=None, version=None):
+        start = time.monotonic()
+        image = slow_find_latest(pay_type, ami_name, region, version)
+        stamps[pay_type] = (start, time.monotonic())
+        return image
+    mock_find_latest.side_effect = stamped_find_latest
+    find_ami.handler(get_default_event(), get_default_context())
+    # the two lookups overlap: each one started before the other finished
+    assert(['_BYOL', '_OnDemand'] == sorted(stamps.keys()))
+    assert(max(s[0] for s in stamps.values()) < min(s[1] for s in stamps.values()))
+    args = mock_cfn_send.call_args[0]
+    assert('SUCCESS' == args[2])
+    assert('ami-byol' == args[3]['LatestBYOLAmiId'])
+    assert('ami-ondemand' == args[3]['LatestOnDemandAmiId'])
+    find_ami.handler(get_default_event(), get_default_context())
+    assert(2 == mock_find_latest.call_count)
+    print()
+
+@patch('find_ami.cfn_send')
+@patch('find_ami.find_latest')
+def test_update_same_properties(mock_find_latest, mock_cfn_send):
+    print('Test: an Update with unchanged properties returns the previous answer without EC2')
+    find_ami.g_ami_cache.clear()
+    mock_find_latest.side_effect = slow_find_latest
+    find_ami.handler(get_default_event(), get_default_context())
+    assert(2 == mock_find_latest.call_count)
+    #expire the warm cache
+    for entry in find_ami.g_ami_cache.values():
+        entry['cached_at'] -= 10 * find_ami.ami_cache_ttl()
+    event = get_default_event()
+    event['RequestType'] = 'Update'
+    event['OldResourceProperties'] = dict(event['ResourceProperties'], ServiceToken='old-arn')
+    find_ami.handler(event, get_default_context())
+    assert(2 == mock_find_latest.call_count)
+    assert('ami-byol' == mock_cfn_send.call_args[0][3]['LatestBYOLAmiId'])
+    event['ResourceProperties']['BYOLAMIName'] = 'my-image'
+    find_ami.handler(event, get_default_context())
+    assert(4 == mock_find_latest.call_count)
+    print()
+
+def regional_find_latest(pay_type, ami_name=None, region=None, version=None):
+    time.sleep(0.1)
+    if 'ap-east-1' == region:
+        raise Exception('AuthFailure')
+    return {'name': 'FortiWeb-AWS-7.4.1%s' % (pay_type), 'ami_id': 'ami-%s-%s' % (region, pay_type.strip('_').lower()), 'version': '7.4.1'}
+
+@patch('find_ami.find_latest')
+def test_build_ami_map(mock_find_latest):
+    print('Test: regions are scanned concurrently, a failing region is reported and left out')
+    mock_find_latest.side_effect = regional_find_latest
+    regions = ['us-east-1', 'eu-west-1', 'ap-east-1', 'us-west-2']
+    start = time.time()
+    ami_map, errors = find_ami.build_ami_map(regions, concurrency=8)
+    assert(time.time() - start < 0.3)
+    assert(['eu-west-1', 'us-east-1', 'us-west-2'] == sorted(ami_map.keys()))
+    assert('ami-eu-west-1-byol' == ami_map['eu-west-1']['LatestBYOLAmiId'])
+    assert('7.4.1' == ami_map['us-west-2']['LatestOnDemandAmiVersion'])
+    assert(['ap-east-1'] == list(errors.keys()))
+    print()
+
+@patch('find_ami.cfn_send')
+@patch('find_ami.find_latest')
+@patch('find_ami.load_ami_map')
+def test_handler_reads_map(mock_load_ami_map, mock_find_latest, mock_cfn_send):
+    print('Test: with AMIMapUrl the custom resource answers from the map without EC2')
+    find_ami.g_ami_cache.clear()
+    mock_find_latest.side_effect = slow_find_latest
+    mock_load_ami_map.return_value = {find_ami.current_region(): {
+        'LatestBYOLAmiId': 'ami-mapped-byol', 'LatestBYOLAmiVersion': '7.4.2',
+        'LatestOnDemandAmiId': 'ami-mapped-ondemand', 'LatestOnDemandAmiVersion': '7.4.2'}}
+    event = get_default_event()
+    event['ResourceProperties']['AMIMapUrl'] = 's3://bucket/ami-map.json'
+    find_ami.handler(event, get_default_context())
+    assert(0 == mock_find_latest.call_count)
+    args = mock_cfn_send.call_args[0]
+    assert('ami-mapped-byol' == args[3]['LatestBYOLAmiId'])
+    assert('ami-mapped-ondemand' == args[3]['LatestOnDemandAmiId'])
+    #a custom image name still goes to EC2
+    event['ResourceProperties']['BYOLAMIName'] = 'my-image'
+    find_ami.handler(event, get_default_context())
+    assert(1 == mock_find_latest.call_count)
+    print()
+
+def marketplace_images(filters, region=None):
+    pay_type = filters[-1]['Values'][0].split('*')[-2]
+    versions = ['6.3.9', '7.2.3', '7.2.10', '7.4.1', '7.4.1.build0456', '7.4.0', 'beta']
+    return [{'name': 'FortiWeb-AWS-%s%s-abc' % (v, pay_type), 'ami_id': 'ami-%s' % (v)} for v in versions]
+
+def test_catalog_constraints():
+    print('Test: versions are parsed once, LATEST / 7.x / pinned queries need one scan')
+    catalog = find_ami.AmiCatalog([{'name': v, 'version': v, 'ami_id': 'ami-%s' % (v)}
+        for v in ['7.2.9', '7.2.10', '7.4.1', '7.4.1.build0456', 'beta']])
+    assert('7.4.1.build0456' == catalog.best()['version'])
+    assert('7.2.10' == catalog.best('7.2.x')['version'])
+    assert('7.2.9' == catalog.best('7.2.9')['version'])
+    assert('7.2.10' == catalog.best('72x')['version'])
+    assert(None == catalog.best('6.x'))
+    assert((7, 4) == find_ami.parse_constraint('7.4.x'))
+    assert(() == find_ami.parse_constraint('LATEST'))
+    assert((10, 1, 2) == find_ami.parse_constraint('10.1.2'))
+    assert((7, 2, 3) == find_ami.parse_constraint('723'))
+    for constraint in ['seven', '7101', '101x', '7']:
+        try:
+            find_ami.parse_constraint(constraint)
+            assert(False)
+        except Exception as e:
+            assert('constraint' in str(e))
+    with patch('find_ami.find_amis') as mock_find_amis:
+        mock_find_amis.side_effect = marketplace_images
+        find_ami.g_catalogs.clear()
+        assert('ami-7.4.1.build0456' == find_ami.find_latest('_BYOL')['ami_id'])
+        assert('ami-7.2.3' == find_ami.find_latest('_BYOL', version='7.2.3')['ami_id'])
+        assert('ami-6.3.9' == find_ami.find_latest('_BYOL', version='6.3.x')['ami_id'])
+        assert(1 == mock_find_amis.call_count)
+        try:
+            find_ami.find_latest('_BYOL', version='7.3.x')
+            assert(False)
+        except Exception as e:
+            assert('7.3.x' in str(e))
+    print()
+
+@patch('find_ami.cfn_send')
+@patch('find_ami.find_latest')
+def test_handler_pinned_version(mock_find_latest, mock_cfn_send):
+    print('Test: FortiWebVersion reaches the lookup and gets its own cache entry')
+    find_ami.g_ami_cache.clear()
+    mock_find_latest.side_effect = slow_find_latest
+    event = get_default_event()
+    event['ResourceProperties']['FortiWebVersion'] = '7.2.3'
+    find_ami.handler(event, get_default_context())
+    assert('7.2.3' == mock_find_latest.call_args[0][3])
+    event['ResourceProperties']['FortiWebVersion'] = 'LATEST'
+    find_ami.handler(event, get_default_context())
+    assert(4 == mock_find_latest.call_count)
+    print()
+
+def image_pages(pages):
+    # describe_images answers: pages of FortiWeb images chained by NextToken
+    resps = []
+    for i, versions in enumerate(pages):
+        resp = {'Images': [{'Name': 'FortiWeb-AWS-%s_BYOL-abc' % (v), 'ImageId': 'ami-%s' % (v),
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1'}], 'Description': 'x' * 256} for v in versions]}
+        if i + 1 < len(pages):
+            resp['NextToken'] = 'token-%d' % (i + 1)
+        resps.append(resp)
+    return resps
+
+@patch('aws_clients.get_client')
+def test_find_amis_pages(mock_get_client):
+    print('Test: every describe_images page is read, images are cut down to name and id')
+    client = Mock()
+    client.describe_images.side_effect = image_pages([['7.2.3', '7.4.0'], [], ['7.4.1', '7.4.1'], ['6.3.9']])
+    mock_get_client.return_value = client
+    find_ami.g_catalogs.clear()
+    catalog = find_ami.get_catalog('_BYOL', 'us-east-1')
+    assert(4 == client.describe_images.call_count)
+    calls = client.describe_images.call_args_list
+    assert(find_ami.AMI_PAGE_SIZE == calls[0][1]['MaxResults'] and 'NextToken' not in calls[0][1])
+    assert(['token-1', 'token-2', 'token-3'] == [c[1]['NextToken'] for c in calls[1:]])
+    assert(['6.3.9', '7.2.3', '7.4.0', '7.4.1'] == catalog.versions())
+    assert({'name': 'FortiWeb-AWS-7.4.1_BYOL-abc', 'ami_id': 'ami-7.4.1', 'version': '7.4.1'} == catalog.best())
+    assert('ami-7.2.3' == catalog.best('7.2.x')['ami_id'])
+    print()
+
+@patch('aws_clients.get_client')
+def test_custom_ami_first_match(mock_get_client):
+    print('Test: a custom AMI name stops at the first match, no more pages are asked for')
+    client = Mock()
+    client.describe_images.side_effect = image_pages([[], ['7.4.1'], ['7.4.0']])
+    mock_get_client.return_value = client
+    image = find_ami.find_latest('_BYOL', 'FortiWeb-AWS-7.4.1_BYOL-abc', 'us-east-1')
+    assert('ami-7.4.1' == image['ami_id'] and 'x.x.x' == image['version'])
+    assert(2 == client.describe_images.call_count)
+    client.describe_images.side_effect = image_pages([[], []])
+    try:
+        find_ami.find_latest('_BYOL', 'no-such-ami', 'us-east-1')
+        assert(False)
+    except Exception as e:
+        assert('no-such-ami' in str(e))
+    print()
+
+
+if '__main__' == __name__:
+    #a region in the environment, no boto3 session is built for current_region()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    test_parallel_and_cached()
+    test_update_same_properties()
+    test_build_ami_map()
+    test_handler_reads_map()
+    test_catalog_constraints()
+    test_handler_pinned_version()
+    test_find_amis_pages()
+    test_custom_ami_first_match()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import json
+import tempfile
+from unittest.mock import patch
+import fake_aws
+import assignment_store
+import license_inventory
+import license_admin
+
+BUCKET = 'fake-S3Bucket'
+LIC_DIR = 'prefix/license/'
+
+def write_files(directory, contents):
+    for name, body in contents.items():
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(body)
+
+def test_upload_rejects_duplicates():
+    print('Test: upload skips content already in the pool, duplicated input and name conflicts')
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, 2)
+    with tempfile.TemporaryDirectory() as directory:
+        write_files(directory, {
+            'new1.lic': b'new license 1',
+            'new2.lic': b'new license 2',
+            'copy.lic': b'new license 1',     # same content as new1.lic
+            'old.lic': b'license 0',          # already in the pool as lic0.lic
+            'lic1.lic': b'other content',     # key exists with other content
+            'readme.txt': b'not a license',
+        })
+        with patch('aws_clients.get_client', aws.get_client):
+            report = license_admin.upload(BUCKET, LIC_DIR, [directory], jobs=4)
+            assert(2 == len(report['uploaded']))
+            assert(2 == len(report['duplicates']))
+            assert([LIC_DIR + 'lic1.lic'] == [c['key'] for c in report['name_conflicts']])
+            assert(b'license 1' == aws.objects[(BUCKET, LIC_DIR + 'lic1.lic')])
+            assert(4 == len(list(license_admin.list_pool(BUCKET, LIC_DIR))))
+            # a second run changes nothing
+            again = license_admin.upload(BUCKET, LIC_DIR, [directory], jobs=4)
+            assert([] == again['uploaded'])
+    assert(2 == aws.calls['s3.put_object'])
+    print()
+
+def test_upload_duplicates_under_sse_kms():
+    print('Test: SSE-KMS ETags are no content MD5, duplicates are still found by sha256')
+    aws = fake_aws.FakeAws()
+    aws.sse_kms = True
+    aws.add_licenses(LIC_DIR, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        write_files(directory, {'new1.lic': b'new license 1', 'old.lic': b'license 0'})
+        with patch('aws_clients.get_client', aws.get_client):
+            report = license_admin.upload(BUCKET, LIC_DIR, [directory], jobs=2)
+            assert([LIC_DIR + 'new1.lic'] == report['uploaded'])
+            # lic0.lic has no sha256 metadata and is read once
+            assert([LIC_DIR + 'lic0.lic'] == [d['same_as'] for d in report['duplicates']])
+            again = license_admin.upload(BUCKET, LIC_DIR, [directory], jobs=2)
+            assert([] == again['uploaded'] and 2 == len(again['duplicates']))
+    assert(1 == aws.calls['s3.put_object'])
+    print()
+
+def test_manifest_read_by_inventory():
+    print('Test: the written manifest is what the allocator loads')
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, 5)
+    with patch('aws_clients.get_client', aws.get_client):
+        assert(5 == license_admin.write_manifest(BUCKET, LIC_DIR))
+        body = json.loads(aws.objects[(BUCKET, LIC_DIR + 'manifest.json')])
+        assert(5 == len(body['licenses']))
+        inventory = license_inventory.LicenseInventory(BUCKET, LIC_DIR, ttl=60, manifest_name='manifest.json')
+        assert(sorted(o['key'] for o in body['licenses']) == sorted(inventory.get_names()))
+        assert('manifest' == inventory.source)
+    # only write_manifest listed the pool
+    assert(1 == aws.calls['s3.list_objects_v2'])
+    print()
+
+def test_utilization_report():
+    print('Test: report joins the listing with the assignments')
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, 4)
+    with patch('aws_clients.get_client', aws.get_client):
+        store = assignment_store.get_store('table')
+        store.put_if_not_exists('i-1', 'lic0.lic')
+        store.put_if_not_exists('i-2', 'lic3.lic')
+        store.put_if_not_exists('i-3', 'gone.lic')
+        report = license_admin.utilization(BUCKET, LIC_DIR, 'table')
+    assert(4 == report['total'])
+    assert(2 == report['used'])
+    assert(2 == report['free'])
+    assert([{'license': 'gone.lic', 'instance_id': 'i-3'}] == report['missing'])
+    print()
+
+def test_license_dir_path():
+    print('Test: <S3Prefix>/license/ for every prefix spelling')
+    assert('prefix/license/' == license_inventory.license_dir_path('prefix'))
+    assert('prefix/license/' == license_inventory.license_dir_path('/prefix/'))
+    assert('license/' == license_inventory.license_dir_path(''))
+    print()
+
+
+if '__main__' == __name__:
+    test_upload_rejects_duplicates()
+    test_upload_duplicates_under_sse_kms()
+    test_manifest_read_by_inventory()
+    test_utilization_report()
+    test_license_dir_path()
@@ -1,38 +1,37 @@
 #!/usr/bin/env python3
 import os
+import time
 from unittest.mock import Mock
 from unittest.mock import patch
+import botocore.exceptions
+import fake_aws
 import handler
 
-def describe_auto_scaling_groups(*args, **kwargs):
+def describe_auto_scaling_instances(InstanceIds):
     return {
-        'AutoScalingGroups': [{
-            'Instances':[
-                {'InstanceId': 'i-fakeid1'},
-                {'InstanceId': 'i-fakeid2'}
-            ]
-        }]
+        'AutoScalingInstances': [{'InstanceId': i, 'AutoScalingGroupName': 'fake-BYOL_ASG_NAME'}
+            for i in InstanceIds if i != 'i-stranger']
     }
 
 def try2_update_item(**kwargs):
     assert(kwargs['TableName'] == 'fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID')
     lic_name = kwargs['ExpressionAttributeValues'][':lic_name']['S']
     if 'lic2.lic' != lic_name:
-        raise handler.botocore.exceptions.ClientError({'Error':{'Code': 'ConditionalCheckFailedException'}}, {})
+        raise botocore.exceptions.ClientError({'Error':{'Code': 'ConditionalCheckFailedException'}}, {})
 
 def update_item_condi_exception(**kwargs):
-    raise handler.botocore.exceptions.ClientError({'Error':{'Code': 'ConditionalCheckFailedException'}}, {})
+    raise botocore.exceptions.ClientError({'Error':{'Code': 'ConditionalCheckFailedException'}}, {})
 
-@patch('handler.boto3')
+@patch('aws_clients.get_client')
 @patch('handler.GetLicenseFileName')
-def test_get_exists_lic(mock_GetLicenseFileName, mock_boto3):
+def test_get_exists_lic(mock_GetLicenseFileName, mock_get_client):
     print('Test: license already assigned，just return license')
     mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic']
-    mock_boto3_client = Mock()
-    mock_boto3.client.return_value = mock_boto3_client
-    mock_boto3_client.describe_auto_scaling_groups = describe_auto_scaling_groups
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
     lic_name = 'licX.lic'
-    mock_boto3_client.get_item.return_value = {
+    mock_client.get_item.return_value = {
         'Item': {
             'inst_lic_pair': {
                 "SS": [
@@ -50,60 +49,301 @@ def test_get_exists_lic(mock_GetLicenseFileName, mock_boto3):
     assert(lic_name in ret['body'])
     print()
 
-@patch('handler.boto3')
+@patch('aws_clients.get_client')
 @patch('handler.GetLicenseFileName')
-def test_alloc_lic_try1(mock_GetLicenseFileName, mock_boto3):
+def test_alloc_lic_try1(mock_GetLicenseFileName, mock_get_client):
     print('Test: new request for license，succed in first request')
     mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic']
-    mock_boto3_client = Mock()
-    mock_boto3.client.return_value = mock_boto3_client
-    mock_boto3_client.describe_auto_scaling_groups = describe_auto_scaling_groups
-    mock_boto3_client.get_item.return_value = {}
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {}
     ret = handler.lambda_handler(event, context)
-    assert('lic1.lic' in ret['body'])
+    assert(ret['body'].endswith('lic1.lic') or ret['body'].endswith('lic2.lic'))
+    assert(1 == mock_client.update_item.call_count)
     print()
 
-@patch('handler.boto3')
+@patch('aws_clients.get_client')
 @patch('handler.GetLicenseFileName')
-def test_alloc_lic_try2(mock_GetLicenseFileName, mock_boto3):
+def test_alloc_lic_try2(mock_GetLicenseFileName, mock_get_client):
     print('Test: new request for license，failed at first time, succed in second request')
     mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic']
-    mock_boto3_client = Mock()
-    mock_boto3.client.return_value = mock_boto3_client
-    mock_boto3_client.describe_auto_scaling_groups = describe_auto_scaling_groups
-    mock_boto3_client.get_item.return_value = {}
-    mock_boto3_client.update_item = try2_update_item
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {}
+    mock_client.update_item = try2_update_item
     ret = handler.lambda_handler(event, context)
     assert('lic2.lic' in ret['body'])
     print()
 
-@patch('handler.boto3')
+@patch('aws_clients.get_client')
 @patch('handler.GetLicenseFileName')
-def test_no_lic(mock_GetLicenseFileName, mock_boto3):
+def test_no_lic(mock_GetLicenseFileName, mock_get_client):
     print('Test: no license，should return 404')
     mock_GetLicenseFileName.return_value = []
-    mock_boto3_client = Mock()
-    mock_boto3.client.return_value = mock_boto3_client
-    mock_boto3_client.describe_auto_scaling_groups = describe_auto_scaling_groups
-    mock_boto3_client.get_item.return_value = {}
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {}
     ret = handler.lambda_handler(event, context)
     assert(404 == ret['statusCode'])
     print()
 
-@patch('handler.boto3')
+@patch('aws_clients.get_client')
 @patch('handler.GetLicenseFileName')
-def test_no_enough_lic(mock_GetLicenseFileName, mock_boto3):
+def test_no_enough_lic(mock_GetLicenseFileName, mock_get_client):
     print('Test: no enough license，should return 404')
     mock_GetLicenseFileName.return_value = []
-    mock_boto3_client = Mock()
-    mock_boto3.client.return_value = mock_boto3_client
-    mock_boto3_client.describe_auto_scaling_groups = describe_auto_scaling_groups
-    mock_boto3_client.get_item.return_value = {}
-    mock_boto3_client.update_item = update_item_condi_exception
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {}
+    mock_client.update_item = update_item_condi_exception
     ret = handler.lambda_handler(event, context)
     assert(404 == ret['statusCode'])
     print()
 
+@patch('aws_clients.get_client')
+def test_alloc_skips_assigned(mock_get_client):
+    print('Test: allocator only tries licenses free in the record and counts conflicts')
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.get_item.return_value = {
+        'Item': {
+            'inst_lic_pair': {
+                "SS": ['i-fakeid2', 'lic1.lic', 'i-fakeid2'+handler.MAGIC_CONCATENATOR+'lic1.lic']
+            }
+        }
+    }
+    tried = []
+    def update_item(**kwargs):
+        lic_name = kwargs['ExpressionAttributeValues'][':lic_name']['S']
+        tried.append(lic_name)
+        if 1 == len(tried):
+            raise botocore.exceptions.ClientError({'Error':{'Code': 'ConditionalCheckFailedException'}}, {})
+    mock_client.update_item = update_item
+    stats = {}
+    lic_name = handler.assign_license('table', ['lic1.lic', 'lic2.lic', 'lic3.lic'], 'i-fakeid1', stats)
+    assert('lic1.lic' not in tried)
+    assert(2 == len(tried) and tried[0] != tried[1])
+    assert(lic_name == tried[1])
+    assert(1 == stats['conflicts'])
+    print()
+
+@patch('aws_clients.get_client')
+@patch('handler.GetLicenseFileName')
+def test_batch_alloc(mock_GetLicenseFileName, mock_get_client):
+    print('Test: batch request, one describe, one write, per instance results')
+    mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic', 'lic3.lic']
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = Mock(side_effect=describe_auto_scaling_instances)
+    mock_client.get_item.return_value = {
+        'Item': {
+            'inst_lic_pair': {
+                "SS": ['i-fakeid1', 'lic1.lic', 'i-fakeid1'+handler.MAGIC_CONCATENATOR+'lic1.lic']
+            }
+        }
+    }
+    batch_event = {'isBase64Encoded': False,
+        'body': '{"instances": ["i-fakeid1", "i-fakeid2", "i-fakeid3", "i-fakeid4", "i-stranger"]}'}
+    ret = handler.lambda_handler(batch_event, context)
+    results = handler.json.loads(ret['body'])['results']
+    assert(1 == mock_client.describe_auto_scaling_instances.call_count)
+    assert(1 == mock_client.update_item.call_count)
+    assert(results['i-fakeid1']['body'].endswith('lic1.lic'))
+    assert(403 == results['i-stranger']['statusCode'])
+    statuses = sorted(results[i]['statusCode'] for i in ['i-fakeid2', 'i-fakeid3', 'i-fakeid4'])
+    assert([200, 200, 404] == statuses)
+    granted = [results[i]['body'] for i in ['i-fakeid2', 'i-fakeid3', 'i-fakeid4'] if 200 == results[i]['statusCode']]
+    assert(2 == len(set(granted)) and not any(g.endswith('lic1.lic') for g in granted))
+    print()
+
+def slow(value, seconds=0.2):
+    def call(*args):
+        time.sleep(seconds)
+        return value
+    return call
+
+@patch('handler.assign_license')
+@patch('handler.get_all_lic_names')
+@patch('handler.get_assigned_lic_name')
+@patch('handler.auth_request')
+def test_concurrent_prefetch(mock_auth, mock_lookup, mock_list, mock_assign):
+    print('Test: auth, lookup and listing run together, unneeded reads are cancelled')
+    mock_auth.side_effect = slow(True)
+    mock_lookup.side_effect = slow(None)
+    mock_list.side_effect = slow(['lic1.lic', 'lic2.lic'])
+    mock_assign.return_value = 'lic2.lic'
+    os.environ['LICENSE_PREFETCH'] = 'false'
+    start = time.time()
+    ret = handler.lambda_handler(event, context)
+    sequential = time.time() - start
+    assert(ret['body'].endswith('lic2.lic'))
+    os.environ['LICENSE_PREFETCH'] = 'true'
+    start = time.time()
+    ret = handler.lambda_handler(event, context)
+    concurrent = time.time() - start
+    assert(ret['body'].endswith('lic2.lic'))
+    assert(sequential > 0.55 and concurrent < 0.35)
+    assert(['lic1.lic', 'lic2.lic'] == mock_assign.call_args[0][1])
+    #already assigned: the listing is not waited for
+    mock_lookup.side_effect = slow('lic1.lic', 0)
+    mock_list.side_effect = slow(['lic1.lic'], 1.0)
+    start = time.time()
+    ret = handler.lambda_handler(event, context)
+    assert(time.time() - start < 0.5)
+    assert(ret['body'].endswith('lic1.lic'))
+    time.sleep(1.0)
+    print()
+
+@patch('aws_clients.get_client')
+@patch('handler.GetLicenseFileName')
+def test_answer_cache_and_coalescing(mock_GetLicenseFileName, mock_get_client):
+    print('Test: repeat calls skip DynamoDB, concurrent duplicates share one allocation')
+    import threading
+    import assignment_cache
+    os.environ['LICENSE_ANSWER_TTL'] = '300'
+    assignment_cache._caches.clear()
+    mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic']
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {}
+    def update_item(**kwargs):
+        time.sleep(0.2)
+    mock_client.update_item = Mock(side_effect=update_item)
+    dup_event = {'isBase64Encoded': False, 'body': '{"instance": "i-fakeid9"}'}
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(handler.lambda_handler(dup_event, context)['body']))
+        for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(1 == mock_client.update_item.call_count)
+    assert(5 == len(answers) and 1 == len(set(answers)))
+    cache = assignment_cache.get_cache('fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID')
+    assert(cache.coalesced >= 1)
+    get_calls = mock_client.get_item.call_count
+    ret = handler.lambda_handler(dup_event, context)
+    assert(answers[0] == ret['body'])
+    assert(get_calls == mock_client.get_item.call_count)
+    #expired entry: checked against the record, a released instance is not answered from memory
+    for instance_id, entry in list(cache.answers.items()):
+        cache.answers[instance_id] = (entry[0], entry[1], entry[2] - 1000)
+    mock_client.get_item.return_value = {}
+    mock_client.update_item = Mock()
+    ret = handler.lambda_handler(dup_event, context)
+    assert(1 == mock_client.update_item.call_count)
+    os.environ['LICENSE_ANSWER_TTL'] = '0'
+    assignment_cache._caches.clear()
+    print()
+
+@patch('aws_clients.get_client')
+def test_response_modes(mock_get_client):
+    print('Test: path / url / inline responses, negotiated by Accept')
+    import io
+    import license_content
+    license_content._content = None
+    mock_client = Mock()
+    mock_get_client.return_value = mock_client
+    mock_client.describe_auto_scaling_instances = describe_auto_scaling_instances
+    mock_client.get_item.return_value = {
+        'Item': {'inst_lic_pair': {"SS": ['i-fakeid1', 'licX.lic', 'i-fakeid1'+handler.MAGIC_CONCATENATOR+'licX.lic']}}
+    }
+    mock_client.generate_presigned_url.return_value = 'https://fake-S3Bucket.s3.amazonaws.com/licX.lic?X-Amz-Signature=x'
+    mock_client.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(b'LICENSE-BYTES'), 'ETag': '"e1"'}
+    def request(mode=None, accept=None):
+        body = {'instance': 'i-fakeid1'}
+        if None != mode:
+            body['mode'] = mode
+        evt = {'isBase64Encoded': False, 'body': handler.json.dumps(body)}
+        if None != accept:
+            evt['headers'] = {'Accept': accept}
+        return handler.lambda_handler(evt, context)
+    #the stored name is a bare file name, the path must still carry the license dir
+    ret = request()
+    assert('s3://fake-S3Bucket/fake-S3Prefix/license/licX.lic' == ret['body'])
+    assert('text/plain' == ret['headers']['Content-Type'])
+    ret = request(accept='application/json')
+    assert('s3://fake-S3Bucket/fake-S3Prefix/license/licX.lic' == handler.json.loads(ret['body'])['license'])
+    ret = request('url')
+    assert(ret['body'].startswith('https://'))
+    assert('fake-S3Prefix/license/licX.lic' == mock_client.generate_presigned_url.call_args[1]['Params']['Key'])
+    ret = request('inline', 'application/octet-stream')
+    assert(ret['isBase64Encoded'] and 'application/octet-stream' == ret['headers']['Content-Type'])
+    assert(b'LICENSE-BYTES' == handler.base64.b64decode(ret['body']))
+    #API Gateway only decodes for an octet-stream Accept, others get the base64 as text
+    ret = request('inline', '*/*')
+    assert(not ret.get('isBase64Encoded') and 'text/plain' == ret['headers']['Content-Type'])
+    assert(b'LICENSE-BYTES' == handler.base64.b64decode(ret['body']))
+    ret = request('inline', 'application/json')
+    assert('"e1"' == handler.json.loads(ret['body'])['etag'])
+    assert(1 == mock_client.get_object.call_count)
+    #expired: revalidated by ETag, a 304 keeps the cached bytes
+    for entry in license_content.get_content().entries.values():
+        entry['checked_at'] -= 10000
+    def not_modified(**kwargs):
+        assert('"e1"' == kwargs['IfNoneMatch'])
+        raise botocore.exceptions.ClientError({'Error':{'Code': '304'}}, 'GetObject')
+    mock_client.get_object.side_effect = not_modified
+    ret = request('inline')
+    assert(b'LICENSE-BYTES' == handler.base64.b64decode(ret['body']))
+    ret = handler.lambda_handler({'isBase64Encoded': False, 'body': '{"instance": "i-stranger"}',
+        'headers': {'accept': 'application/json'}}, context)
+    assert(403 == ret['statusCode'] and 'error' in handler.json.loads(ret['body']))
+    print()
+
+@patch('handler.GetLicenseFileName')
+def test_instance_taken_reads_consistently(mock_GetLicenseFileName):
+    print('Test: a concurrent winner is read with a consistent read, a vanished one is allocated again')
+    mock_GetLicenseFileName.return_value = ['lic1.lic', 'lic2.lic']
+    store = handler.assignment_store.ItemAssignmentStore
+    # the eventually consistent read lags behind the winning write
+    lagging = lambda self, instance_id, consistent=False: 'licW.lic' if consistent else None
+    with patch.object(store, 'read_window', None), patch.object(store, 'taken_licenses', return_value=set()), \
+            patch.object(store, 'put_if_not_exists', return_value=handler.assignment_store.INSTANCE_TAKEN), \
+            patch.object(store, 'get', new=lagging):
+        assert('licW.lic' == handler.assign_license('table', ['lic1.lic', 'lic2.lic'], 'i-fakeid1'))
+    # the winner released it again: the next put gets the license
+    results = [handler.assignment_store.INSTANCE_TAKEN, handler.assignment_store.ASSIGNED]
+    with patch.object(store, 'read_window', None), patch.object(store, 'taken_licenses', return_value=set()), \
+            patch.object(store, 'put_if_not_exists', side_effect=results) as mock_put, \
+            patch.object(store, 'get', return_value=None):
+        stats = {}
+        lic_name = handler.assign_license('table', ['lic1.lic', 'lic2.lic'], 'i-fakeid1', stats)
+    assert(lic_name in ['lic1.lic', 'lic2.lic'] and 1 == stats['assigned'])
+    assert(mock_put.call_args_list[0] == mock_put.call_args_list[1])
+    print()
+
+def test_set_layout_duplicate_request():
+    print('Test: set layout, a request of an instance that holds a license gets it back with one write')
+    aws = fake_aws.FakeAws()
+    aws.add_licenses('fake-S3Prefix/license/', 50)
+    aws.add_instances('fake-BYOL_ASG_NAME', ['i-fakeid1', 'i-fakeid2'])
+    handler.license_inventory._inventories.clear()
+    with patch('aws_clients.get_client', aws.get_client):
+        first = handler.lambda_handler(event, context)
+        assert(200 == first['statusCode'])
+        before = aws.calls.get('dynamodb.update_item', 0)
+        # another container whose lookup missed the write
+        with patch('handler.get_assigned_lic_name', return_value=None):
+            again = handler.lambda_handler(event, context)
+        assert(200 == again['statusCode'])
+        assert(os.path.basename(first['body']) == os.path.basename(again['body']))
+        assert(before + 1 == aws.calls.get('dynamodb.update_item', 0))
+        # the batch fallback answers the same way
+        with patch('handler.get_assigned_lic_name', return_value=None):
+            results = handler.assign_licenses_batch('fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID',
+                    handler.get_all_lic_names('fake-S3Bucket', 'fake-S3Prefix/license/'), ['i-fakeid1', 'i-fakeid2'])
+    assert(os.path.basename(first['body']) == os.path.basename(results['i-fakeid1']))
+    assert(None != results['i-fakeid2'])
+    pairs, double = aws.assignments('fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID')
+    assert(2 == len(pairs) and [] == double)
+    print()
+
 
 if '__main__' == __name__:
     os.environ['BYOL_ASG_NAME'] = 'fake-BYOL_ASG_NAME'
@@ -111,6 +351,10 @@ if '__main__' == __name__:
     os.environ['S3Prefix'] = 'fake-S3Prefix'
     os.environ['CUSTOM_ID'] = 'fake-CUSTOM_ID'
     os.environ['UNIQUE_ID'] = 'fake-UNIQUE_ID'
+    #every test is a different table state, do not carry answers over
+    os.environ['LICENSE_ANSWER_TTL'] = '0'
+    #update_item counts below are assignment writes, counters: MTest_pool_counters.py
+    os.environ['LICENSE_POOL_COUNTERS'] = 'false'
     event = {}
     event['isBase64Encoded'] = False
     event['body'] = '{"instance": "i-fakeid1"}'
@@ -120,5 +364,14 @@ if '__main__' == __name__:
     test_alloc_lic_try2()
     test_no_lic()
     test_no_enough_lic()
+    test_alloc_skips_assigned()
+    test_batch_alloc()
+    test_concurrent_prefetch()
+    test_answer_cache_and_coalescing()
+    test_response_modes()
+    test_set_layout_duplicate_request()
+    os.environ['LICENSE_RECORD_LAYOUT'] = 'item'
+    test_instance_taken_reads_consistently()
+    os.environ['LICENSE_RECORD_LAYOUT'] = 'set'
 
 
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import io
+import json
+from unittest.mock import Mock
+from unittest.mock import patch
+import botocore.exceptions
+import license_inventory
+
+class fake_paginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = 0
+    def paginate(self, **kwargs):
+        self.calls += 1
+        return iter(self.pages)
+
+def make_pages():
+    # two pages, the first one full, like list_objects_v2 returns for > 1000 keys
+    first = [{'Key': 'p/license/lic%d.lic' % (i)} for i in range(1000)]
+    second = [{'Key': 'p/license/lic1000.lic'}, {'Key': 'p/license/readme.txt'}]
+    return [{'Contents': first}, {'Contents': second}]
+
+@patch('license_inventory.aws_clients')
+def test_paginated_listing(mock_aws_clients):
+    print('Test: listing follows every page and keeps only .lic keys')
+    paginator = fake_paginator(make_pages())
+    mock_client = Mock()
+    mock_client.get_paginator.return_value = paginator
+    mock_aws_clients.get_client.return_value = mock_client
+    inventory = license_inventory.LicenseInventory('bucket', 'p/license/', ttl=60, manifest_name='')
+    names = inventory.get_names()
+    assert(1001 == len(names))
+    assert('p/license/lic1000.lic' in names)
+    mock_client.get_paginator.assert_called_with('list_objects_v2')
+    print()
+
+@patch('license_inventory.aws_clients')
+def test_cached_until_ttl(mock_aws_clients):
+    print('Test: a burst of lookups costs one listing')
+    paginator = fake_paginator(make_pages())
+    mock_client = Mock()
+    mock_client.get_paginator.return_value = paginator
+    mock_aws_clients.get_client.return_value = mock_client
+    inventory = license_inventory.LicenseInventory('bucket', 'p/license/', ttl=60, manifest_name='')
+    for i in range(16):
+        inventory.get_names()
+    assert(1 == paginator.calls)
+    inventory.invalidate()
+    inventory.get_names()
+    assert(2 == paginator.calls)
+    print()
+
+@patch('license_inventory.aws_clients')
+def test_manifest_etag_revalidation(mock_aws_clients):
+    print('Test: manifest is loaded once and revalidated by etag')
+    calls = []
+    def get_object(**kwargs):
+        calls.append(kwargs)
+        if 'IfNoneMatch' in kwargs:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        body = json.dumps({'licenses': ['lic1.lic', 'p/license/lic2.lic']}).encode()
+        return {'Body': io.BytesIO(body), 'ETag': '"etag1"'}
+    mock_client = Mock()
+    mock_client.get_object = get_object
+    mock_aws_clients.get_client.return_value = mock_client
+    inventory = license_inventory.LicenseInventory('bucket', 'p/license/', ttl=0, manifest_name='manifest.json')
+    assert(['p/license/lic1.lic', 'p/license/lic2.lic'] == inventory.get_names())
+    assert(['p/license/lic1.lic', 'p/license/lic2.lic'] == inventory.get_names())
+    assert('"etag1"' == calls[1]['IfNoneMatch'])
+    assert('p/license/manifest.json' == calls[0]['Key'])
+    mock_client.get_paginator.assert_not_called()
+    print()
+
+@patch('license_inventory.aws_clients')
+def test_missing_manifest_falls_back(mock_aws_clients):
+    print('Test: missing manifest falls back to listing')
+    def get_object(**kwargs):
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    paginator = fake_paginator(make_pages())
+    mock_client = Mock()
+    mock_client.get_object = get_object
+    mock_client.get_paginator.return_value = paginator
+    mock_aws_clients.get_client.return_value = mock_client
+    inventory = license_inventory.LicenseInventory('bucket', 'p/license/', ttl=60, manifest_name='manifest.json')
+    assert(1001 == len(inventory.get_names()))
+    print()
+
+
+if '__main__' == __name__:
+    test_paginated_listing()
+    test_cached_until_ttl()
+    test_manifest_etag_revalidation()
+    test_missing_manifest_falls_back()
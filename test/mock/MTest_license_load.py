@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import license_load
+
+def test_concurrent_set_layout():
+    print('Test: concurrent boots on the set layout never share a license')
+    report = license_load.run(instances=60, licenses=60, concurrency=60, latency_ms=1, jitter_ms=2, layout='set')
+    assert(60 == report['licensed'])
+    assert([] == report['double_assigned_records'])
+    assert({} == report['double_assigned_answers'])
+    print()
+
+def test_concurrent_item_layout():
+    print('Test: concurrent boots on the item layout never share a license')
+    report = license_load.run(instances=60, licenses=60, concurrency=60, latency_ms=1, jitter_ms=2, layout='item')
+    assert(60 == report['licensed'])
+    assert([] == report['double_assigned_records'])
+    assert({} == report['double_assigned_answers'])
+    # candidates are checked with keyed reads, never a scan of the table
+    assert(0 == report['aws_calls'].get('dynamodb.scan', 0))
+    print()
+
+def test_pool_exhausted():
+    print('Test: more instances than licenses, the rest keeps getting 404')
+    for layout in ['set', 'item']:
+        report = license_load.run(instances=30, licenses=20, concurrency=30, latency_ms=1, jitter_ms=1,
+                layout=layout, max_tries=3)
+        assert(20 == report['licensed'])
+        assert([] == report['double_assigned_records'])
+        assert(0 == report['aws_calls'].get('dynamodb.scan', 0))
+    print()
+
+
+if '__main__' == __name__:
+    test_concurrent_set_layout()
+    test_concurrent_item_layout()
+    test_pool_exhausted()
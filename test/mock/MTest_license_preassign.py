@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import os
+import json
+from unittest.mock import patch
+import fake_aws
+import handler
+import assignment_cache
+
+BYOL_ASG = 'fake-BYOL_ASG_NAME'
+LIC_DIR = 'fake-S3Prefix/license/'
+TABLE = 'fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID'
+
+def new_aws(licenses, instances):
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, licenses)
+    aws.add_instances(BYOL_ASG, instances)
+    aws.add_instances('fake-OnDemand', ['i-od'])
+    handler.license_inventory._inventories.clear()
+    assignment_cache._caches.clear()
+    return aws
+
+def api_event(instance_id):
+    return {'isBase64Encoded': False, 'body': json.dumps({'instance': instance_id})}
+
+def test_preassign_then_keyed_read():
+    print('Test: a pre-assigned instance gets its license at boot without an allocation')
+    aws = new_aws(4, ['i-1', 'i-2'])
+    with patch('aws_clients.get_client', aws.get_client):
+        report = handler.lambda_handler({'action': 'preassign', 'instance_ids': ['i-1', 'i-2'], 'asg_name': BYOL_ASG}, {})
+        assert(['i-1', 'i-2'] == sorted(report['assigned'].keys()))
+        assert(2 == len(set(report['assigned'].values())))
+        assigned, double = aws.assignments(TABLE)
+        assert(2 == len(assigned) and [] == double)
+        # the boot request of another container: a keyed read, no conditional write
+        assignment_cache._caches.clear()
+        handler.license_inventory._inventories.clear()
+        before = dict(aws.calls)
+        with patch('handler.try_alloc_license', side_effect=Exception('allocation at boot')):
+            ret = handler.lambda_handler(api_event('i-1'), {})
+    assert(200 == ret['statusCode'])
+    assert(ret['body'].endswith(LIC_DIR + assigned['i-1']))
+    writes = ['dynamodb.update_item', 'dynamodb.transact_write_items']
+    assert([before.get(w, 0) for w in writes] == [aws.calls.get(w, 0) for w in writes])
+    print()
+
+def test_preassign_is_idempotent():
+    print('Test: a repeated launch event keeps the license it got the first time')
+    aws = new_aws(4, ['i-1'])
+    with patch('aws_clients.get_client', aws.get_client):
+        first = handler.lambda_handler({'action': 'preassign', 'instance_id': 'i-1'}, {})
+        again = handler.lambda_handler({'action': 'preassign', 'instance_id': 'i-1'}, {})
+    assert(1 == len(first['assigned']) and {} == again['assigned'])
+    assert(os.path.basename(first['assigned']['i-1']) == os.path.basename(again['existing']['i-1']))
+    assert(1 == len(aws.assignments(TABLE)[0]))
+    print()
+
+def test_preassign_skips_and_exhausts():
+    print('Test: other groups and strangers are skipped, an empty pool is not an error')
+    aws = new_aws(1, ['i-1', 'i-2'])
+    with patch('aws_clients.get_client', aws.get_client):
+        report = handler.lambda_handler({'action': 'preassign', 'instance_id': 'i-od', 'asg_name': 'fake-OnDemand'}, {})
+        assert(['i-od'] == report['skipped'])
+        report = handler.lambda_handler({'action': 'preassign', 'instance_ids': ['i-1', 'i-2', 'i-x']}, {})
+    assert(['i-x'] == report['skipped'])
+    assert(1 == len(report['assigned']) and 1 == len(report['exhausted']))
+    assert(1 == len(aws.assignments(TABLE)[0]))
+    print()
+
+
+if '__main__' == __name__:
+    os.environ['BYOL_ASG_NAME'] = BYOL_ASG
+    os.environ['S3Bucket'] = 'fake-S3Bucket'
+    os.environ['S3Prefix'] = 'fake-S3Prefix'
+    os.environ['CUSTOM_ID'] = 'fake-CUSTOM_ID'
+    os.environ['UNIQUE_ID'] = 'fake-UNIQUE_ID'
+    os.environ['LICENSE_MANIFEST'] = ''
+    os.environ['METRICS_DISABLED'] = 'true'
+    test_preassign_then_keyed_read()
+    test_preassign_is_idempotent()
+    test_preassign_skips_and_exhausts()
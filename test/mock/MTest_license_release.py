@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import json
+from unittest.mock import patch
+import fake_aws
+import handler
+import assignment_cache
+import pool_counters
+
+BYOL_ASG = 'fake-BYOL_ASG_NAME'
+LIC_DIR = 'fake-S3Prefix/license/'
+TABLE = 'fake-CUSTOM_ID-FortiWebLic-fake-UNIQUE_ID'
+
+def new_aws(licenses, instances):
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, licenses)
+    aws.add_instances(BYOL_ASG, instances)
+    handler.license_inventory._inventories.clear()
+    assignment_cache._caches.clear()
+    return aws
+
+def boot(instance_id):
+    return handler.lambda_handler({'isBase64Encoded': False, 'body': json.dumps({'instance': instance_id})}, {})
+
+def release_api(body):
+    ret = handler.lambda_handler({'resource': '/lic_release', 'path': '/lic_release',
+        'isBase64Encoded': False, 'body': json.dumps(body)}, {})
+    return ret['statusCode'], json.loads(ret['body'])
+
+def used(aws):
+    item = aws.tables.get(TABLE, {}).get(pool_counters.COUNTERS_KEY, {})
+    return int(item.get('used', {'N': '0'})['N'])
+
+def test_release_cycles_the_pool():
+    print('Test: scale-in releases, scale-out gets the same licenses again')
+    for layout in ['set', 'item']:
+        os.environ['LICENSE_RECORD_LAYOUT'] = layout
+        aws = new_aws(2, ['i-1', 'i-2'])
+        with patch('aws_clients.get_client', aws.get_client):
+            licenses = set(boot(i)['body'] for i in ['i-1', 'i-2'])
+            for instance_id in ['i-1', 'i-2']:
+                aws.lifecycle_states[instance_id] = 'Terminating:Wait'
+            report = handler.lambda_handler({'action': 'release', 'instance_ids': ['i-1', 'i-2']}, {})
+            assert(['i-1', 'i-2'] == sorted(report['released'].keys()))
+            assert({} == aws.assignments(TABLE)[0])
+            assert(0 == used(aws))
+            # the freed licenses go to the next instances at once
+            aws.terminate('i-1')
+            aws.terminate('i-2')
+            aws.add_instances(BYOL_ASG, ['i-3', 'i-4'])
+            assert(licenses == set(boot(i)['body'] for i in ['i-3', 'i-4']))
+            assert(2 == used(aws))
+    os.environ['LICENSE_RECORD_LAYOUT'] = 'set'
+    print()
+
+def test_release_is_idempotent():
+    print('Test: a repeated release answers not_assigned and changes nothing')
+    aws = new_aws(2, ['i-1', 'i-2'])
+    with patch('aws_clients.get_client', aws.get_client):
+        boot('i-1')
+        boot('i-2')
+        aws.terminate('i-1')
+        first = handler.lambda_handler({'action': 'release', 'instance_id': 'i-1'}, {})
+        again = handler.lambda_handler({'action': 'release', 'instance_id': 'i-1'}, {})
+    assert(['i-1'] == list(first['released'].keys()))
+    assert({} == again['released'] and ['i-1'] == again['not_assigned'])
+    assert(['i-2'] == list(aws.assignments(TABLE)[0].keys()))
+    assert(1 == used(aws))
+    print()
+
+def test_release_api():
+    print('Test: the api route refuses running instances and releases leaving ones')
+    aws = new_aws(2, ['i-1', 'i-2'])
+    with patch('aws_clients.get_client', aws.get_client):
+        boot('i-1')
+        boot('i-2')
+        assert((403, {'error': 'instance still in service'}) == release_api({'instance': 'i-1'}))
+        aws.lifecycle_states['i-1'] = 'Terminating:Proceed'
+        assert((200, {'status': 'released'}) == release_api({'instance': 'i-1'}))
+        assert((200, {'status': 'not_assigned'}) == release_api({'instance': 'i-1'}))
+        status, body = release_api({'instances': ['i-1', 'i-2']})
+    assert(200 == status and ['i-2'] == body['refused'] and ['i-1'] == body['not_assigned'])
+    assert(['i-2'] == list(aws.assignments(TABLE)[0].keys()))
+    print()
+
+
+if '__main__' == __name__:
+    os.environ['BYOL_ASG_NAME'] = BYOL_ASG
+    os.environ['S3Bucket'] = 'fake-S3Bucket'
+    os.environ['S3Prefix'] = 'fake-S3Prefix'
+    os.environ['CUSTOM_ID'] = 'fake-CUSTOM_ID'
+    os.environ['UNIQUE_ID'] = 'fake-UNIQUE_ID'
+    os.environ['LICENSE_MANIFEST'] = ''
+    os.environ['METRICS_DISABLED'] = 'true'
+    os.environ['LICENSE_ANSWER_TTL'] = '0'
+    test_release_cycles_the_pool()
+    test_release_is_idempotent()
+    test_release_api()
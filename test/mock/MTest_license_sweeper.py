@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+from unittest.mock import Mock
+from unittest.mock import patch
+import assignment_store
+import license_sweeper
+
+MAGIC = assignment_store.MAGIC_CONCATENATOR
+
+def legacy_item(pairs):
+    records = []
+    for instance_id, lic_name in pairs:
+        records += [instance_id, lic_name, instance_id + MAGIC + lic_name]
+    return {'Item': {'inst_lic_pair': {'SS': records}}}
+
+class fake_ec2_paginator(object):
+    def paginate(self, Filters):
+        states = {'i-2': 'running', 'i-3': 'terminated'}
+        instances = [{'InstanceId': i, 'State': {'Name': states[i]}} for i in Filters[0]['Values'] if i in states]
+        return iter([{'Reservations': [{'Instances': instances}]}])
+
+def make_clients():
+    ddb = Mock()
+    ddb.get_item.return_value = legacy_item([('i-1', 'lic1.lic'), ('i-2', 'lic2.lic'),
+        ('i-3', 'lic3.lic'), ('i-4', 'lic4.lic')])
+    asg = Mock()
+    asg.describe_auto_scaling_instances.return_value = {
+        'AutoScalingInstances': [{'InstanceId': 'i-1', 'AutoScalingGroupName': 'asg-byol'}]
+    }
+    ec2 = Mock()
+    ec2.get_paginator.return_value = fake_ec2_paginator()
+    clients = {'dynamodb': ddb, 'autoscaling': asg, 'ec2': ec2}
+    return clients
+
+@patch('aws_clients.get_client')
+def test_sweep_dry_run(mock_get_client):
+    print('Test: dry run reports terminated and unknown instances only')
+    clients = make_clients()
+    mock_get_client.side_effect = lambda name: clients[name]
+    report = license_sweeper.sweep('table', 'asg-byol', dry_run=True)
+    assert({'i-3': 'lic3.lic', 'i-4': 'lic4.lic'} == report['orphans'])
+    assert(4 == report['total'])
+    clients['dynamodb'].update_item.assert_not_called()
+    print()
+
+@patch('aws_clients.get_client')
+def test_sweep_release(mock_get_client):
+    print('Test: sweep releases orphans with conditional removes')
+    clients = make_clients()
+    mock_get_client.side_effect = lambda name: clients[name]
+    report = license_sweeper.sweep('table', 'asg-byol')
+    assert(['i-3', 'i-4'] == report['released'])
+    calls = [c[1] for c in clients['dynamodb'].update_item.call_args_list]
+    removes = [c for c in calls if c['UpdateExpression'].startswith('DELETE')]
+    assert(2 == len(removes))
+    assert('i-3' + MAGIC + 'lic3.lic' == removes[0]['ExpressionAttributeValues'][':combine']['S'])
+    # one counter update for both releases
+    counters = [c for c in calls if c['Key']['assigned_records']['S'] == 'pool#counters']
+    assert(1 == len(counters))
+    assert('-2' == counters[0]['ExpressionAttributeValues'][':delta']['N'])
+    print()
+
+@patch('handler.get_config', return_value={'table_name': 'table', 'asg_names': 'asg-byol'})
+@patch('license_sweeper.sweep')
+def test_sweep_handler_dry_run_flag(mock_sweep, mock_get_config):
+    print('Test: the dry_run of the event is read as a flag, "false" is false')
+    for value, dry_run in [(True, True), ('true', True), ('True', True), (False, False), ('false', False), ('no', False)]:
+        license_sweeper.sweep_handler({'dry_run': value}, {})
+        assert(dry_run == mock_sweep.call_args[0][2])
+    print()
+
+
+if '__main__' == __name__:
+    test_sweep_dry_run()
+    test_sweep_release()
+    test_sweep_handler_dry_run_flag()
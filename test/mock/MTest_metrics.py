@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import os
+import logging
+from botocore.stub import Stubber
+import aws_clients
+import metrics
+
+def test_spans_and_emf():
+    print('Test: spans, counters and retry sleeps end up in one EMF record')
+    metrics.begin('unit', {'Stage': 'test'})
+    with metrics.span('step'):
+        pass
+    with metrics.span('step'):
+        pass
+    metrics.count('AllocationConflicts', 3)
+    metrics.sleep('list_licenses', 0)
+    record = metrics.end('200')
+    assert(2 == record['step.Calls'])
+    assert(3 == record['AllocationConflicts'])
+    assert(1 == record['Retries'])
+    assert('200' == record['Outcome'])
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert([['Function', 'Stage']] == directive['Dimensions'])
+    assert('step.Duration' in [m['Name'] for m in directive['Metrics']])
+    assert(None == metrics.current())
+    print()
+
+def test_aws_calls_timed():
+    print('Test: calls through aws_clients are timed without touching the call sites')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    aws_clients.reset()
+    client = aws_clients.get_client('dynamodb', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        stubber.add_response('get_item', {}, {'TableName': 't', 'Key': {'assigned_records': {'S': 'k'}}})
+        metrics.begin('unit')
+        client.get_item(TableName='t', Key={'assigned_records': {'S': 'k'}})
+        record = metrics.end('ok')
+    assert(1 == record['dynamodb.GetItem.Calls'])
+    aws_clients.reset()
+    print()
+
+def test_lazy_debug():
+    print('Test: debug payloads are not serialized when debug is off')
+    class counting(metrics.lazy_json):
+        calls = 0
+        def __str__(self):
+            counting.calls += 1
+            return metrics.lazy_json.__str__(self)
+    os.environ['LOG_LEVEL'] = 'INFO'
+    os.environ['LOG_DEBUG_SAMPLE_RATE'] = '0'
+    metrics.begin('unit')
+    logging.getLogger().debug('event dump: %s', counting({'body': 'x' * 1000}))
+    metrics.end('ok')
+    assert(0 == counting.calls)
+    os.environ['LOG_DEBUG_SAMPLE_RATE'] = '1'
+    metrics.begin('unit')
+    assert(logging.getLogger().isEnabledFor(logging.DEBUG))
+    metrics.end('ok')
+    os.environ['LOG_DEBUG_SAMPLE_RATE'] = '0'
+    print()
+
+
+if '__main__' == __name__:
+    test_spans_and_emf()
+    test_aws_calls_timed()
+    test_lazy_debug()
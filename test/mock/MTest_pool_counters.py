@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import os
+from unittest.mock import patch
+import fake_aws
+import handler
+import license_sweeper
+import pool_counters
+
+LIC_DIR = 'prefix/license/'
+
+def new_aws(licenses, instances):
+    aws = fake_aws.FakeAws()
+    aws.add_licenses(LIC_DIR, licenses)
+    aws.add_instances('asg-byol', instances)
+    handler.license_inventory._inventories.clear()
+    return aws
+
+def counter_item(aws, table):
+    item = aws.tables.get(table, {}).get(pool_counters.COUNTERS_KEY, {})
+    return int(item.get('used', {'N': '0'})['N']), int(item.get('total', {'N': '0'})['N'])
+
+@patch('metrics.emit')
+def test_allocations_counted(mock_emit):
+    print('Test: single and batch allocations move the counter, repeats do not')
+    aws = new_aws(10, ['i-%d' % (i) for i in range(6)])
+    with patch('aws_clients.get_client', aws.get_client):
+        for instance_id in ['i-0', 'i-1', 'i-2']:
+            handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', instance_id)
+        # already assigned: the concurrent winner's license, no new allocation
+        with patch('assignment_store.SetAssignmentStore.put_if_not_exists', return_value=2):
+            handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', 'i-0')
+        handler.assign_licenses_batch('table', handler.get_all_lic_names('fake-S3Bucket', LIC_DIR), ['i-3', 'i-4'])
+    assert((5, 10) == counter_item(aws, 'table'))
+    values, dimensions = mock_emit.call_args[0]
+    assert({'LicenseTable': 'table'} == dimensions)
+    assert({'LicensesTotal': 10, 'LicensesUsed': 5, 'LicensesFree': 5, 'LicensePoolLow': 0} == values)
+    print()
+
+@patch('metrics.emit')
+def test_low_watermark(mock_emit):
+    print('Test: LicensePoolLow turns on at the watermark and on an empty pool')
+    aws = new_aws(4, ['i-1', 'i-2', 'i-3', 'i-4', 'i-5'])
+    with patch.dict(os.environ, {'LICENSE_LOW_WATERMARK': '1'}):
+        with patch('aws_clients.get_client', aws.get_client):
+            lows = []
+            for instance_id in ['i-1', 'i-2', 'i-3', 'i-4']:
+                handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', instance_id)
+                lows.append(mock_emit.call_args[0][0]['LicensePoolLow'])
+            assert([0, 0, 1, 1] == lows)
+            try:
+                handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', 'i-5')
+                assert(False)
+            except handler.NoAvailableLicense:
+                pass
+    values = mock_emit.call_args[0][0]
+    assert(0 == values['LicensesFree'] and 1 == values['LicensePoolLow'])
+    with patch.dict(os.environ, {'LICENSE_LOW_WATERMARK': '50%'}):
+        assert(5.0 == pool_counters.low_watermark(10))
+    print()
+
+@patch('metrics.emit')
+def test_sweep_release_and_reconcile(mock_emit):
+    print('Test: the sweeper counts its releases and repairs a drifted counter')
+    aws = new_aws(6, ['i-1', 'i-2', 'i-3'])
+    with patch('aws_clients.get_client', aws.get_client):
+        for instance_id in ['i-1', 'i-2', 'i-3']:
+            handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', instance_id)
+        assert((3, 6) == counter_item(aws, 'table'))
+        # a lambda died between the assignment and the counter update
+        aws.tables['table'][pool_counters.COUNTERS_KEY]['used'] = {'N': '2'}
+        aws.terminate('i-3')
+        report = license_sweeper.sweep('table', ['asg-byol'])
+    assert(['i-3'] == report['released'])
+    assert((2, 6) == counter_item(aws, 'table'))
+    assert(2 == mock_emit.call_args[0][0]['LicensesUsed'])
+    print()
+
+def test_counter_failure_does_not_fail_allocation():
+    print('Test: a failing counter update leaves the allocation alone')
+    aws = new_aws(2, ['i-1'])
+    with patch('aws_clients.get_client', aws.get_client):
+        with patch('pool_counters.PoolCounters.add', side_effect=Exception('throttled')):
+            lic_name = handler.try_alloc_license('fake-S3Bucket', LIC_DIR, 'table', 'i-1')
+    assert(lic_name.startswith(LIC_DIR))
+    print()
+
+
+if '__main__' == __name__:
+    test_allocations_counted()
+    test_low_watermark()
+    test_sweep_release_and_reconcile()
+    test_counter_failure_does_not_fail_allocation()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import time
+from unittest.mock import Mock
+from unittest.mock import patch
+import botocore.exceptions
+import retry
+
+def client_error(code, status=400):
+    return botocore.exceptions.ClientError({'Error': {'Code': code},
+        'ResponseMetadata': {'HTTPStatusCode': status}}, 'Operation')
+
+def lambda_context(remaining_ms):
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = remaining_ms
+    context.log_group_name = 'fake_log_group_name'
+    context.log_stream_name = 'fake_log_stream_name'
+    return context
+
+class flaky(object):
+    # raises the given errors in turn, then returns 'ok'
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+    def __call__(self):
+        self.calls += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return 'ok'
+
+def test_classify():
+    print('Test: throttling, conflicts and fatal errors are told apart')
+    assert(retry.THROTTLE == retry.classify(client_error('ThrottlingException')))
+    assert(retry.THROTTLE == retry.classify(client_error('SlowDown', 503)))
+    assert(retry.THROTTLE == retry.classify(client_error('Whatever', 500)))
+    assert(retry.THROTTLE == retry.classify(ConnectionResetError()))
+    assert(retry.CONFLICT == retry.classify(client_error('ConditionalCheckFailedException')))
+    assert(retry.CONFLICT == retry.classify(client_error('TransactionCanceledException')))
+    assert(retry.FATAL == retry.classify(client_error('AccessDenied', 403)))
+    assert(retry.FATAL == retry.classify(client_error('NoSuchBucket', 404)))
+    assert(retry.FATAL == retry.classify(Exception('bug')))
+    for attempt in range(10):
+        assert(0 <= retry.full_jitter(attempt, 0.1, 2.0) <= min(2.0, 0.1 * 2 ** attempt))
+    print()
+
+@patch('metrics.sleep')
+def test_policy(mock_sleep):
+    print('Test: throttling is retried with backoff, fatal errors and conflicts are not')
+    retry.begin(None)
+    policy = retry.RetryPolicy('op', max_attempts=4, base=0.1, cap=1.0)
+    fn = flaky([client_error('ThrottlingException'), client_error('InternalError', 500)])
+    assert('ok' == policy.call(fn))
+    assert(3 == fn.calls and 2 == mock_sleep.call_count)
+    for error in [client_error('AccessDenied', 403), client_error('ConditionalCheckFailedException')]:
+        fn = flaky([error])
+        try:
+            policy.call(fn)
+            assert(False)
+        except botocore.exceptions.ClientError:
+            pass
+        assert(1 == fn.calls)
+    fn = flaky([client_error('SlowDown', 503)] * 10)
+    try:
+        policy.call(fn)
+        assert(False)
+    except botocore.exceptions.ClientError:
+        pass
+    assert(4 == fn.calls)
+    print()
+
+def test_deadline_stops_retries():
+    print('Test: no retry is started that would end after the deadline')
+    retry.begin(lambda_context(1000), margin=0.5)
+    policy = retry.RetryPolicy('op', max_attempts=100, base=1.0, cap=1.0)
+    fn = flaky([client_error('ThrottlingException')] * 100)
+    start = time.time()
+    try:
+        policy.call(fn)
+        assert(False)
+    except retry.DeadlineExceeded:
+        pass
+    assert(time.time() - start < 0.6)
+    # the api gateway cap wins over a long lambda timeout
+    deadline = retry.begin(lambda_context(300 * 1000), limit=28.0)
+    assert(deadline.remaining() <= 28.0)
+    retry.begin(None)
+    print()
+
+def test_run_until():
+    print('Test: run_until gives up on slow work at the deadline')
+    retry.begin(lambda_context(800), margin=0.5)
+    assert(3 == retry.run_until(lambda a, b: a + b, 1, 2))
+    start = time.time()
+    try:
+        retry.run_until(time.sleep, 5)
+        assert(False)
+    except retry.DeadlineExceeded:
+        pass
+    assert(time.time() - start < 1.0)
+    retry.begin(None)
+    print()
+
+@patch('find_ami.cfn_send')
+@patch('find_ami.resolve_images')
+def test_find_ami_fails_before_timeout(mock_resolve, mock_cfn_send):
+    print('Test: find_ami answers FAILED before the lambda timeout, once')
+    import find_ami
+    import cfn_response
+    mock_resolve.side_effect = lambda rpt, allow_stale=False: time.sleep(5)
+    event = {'RequestType': 'Create', 'ResponseURL': 'http://127.0.0.1:3000', 'StackId': 'StackId',
+        'RequestId': 'RequestId', 'LogicalResourceId': 'LogicalResourceId', 'ResourceProperties': {}}
+    start = time.time()
+    find_ami.handler(event, lambda_context(int((cfn_response.RESPONSE_TIME + 0.5) * 1000)))
+    assert(time.time() - start < 1.5)
+    assert(1 == mock_cfn_send.call_count)
+    args = mock_cfn_send.call_args[0]
+    assert('FAILED' == args[2])
+    assert(args[4].startswith('fwb lambda timeout'))
+    print()
+
+@patch('aws_clients.get_client')
+def test_license_listing_fatal_fails_fast(mock_get_client):
+    print('Test: access denied on the license listing is not retried')
+    import handler
+    handler.license_inventory._inventories.clear()
+    client = Mock()
+    client.get_paginator.return_value.paginate.side_effect = client_error('AccessDenied', 403)
+    mock_get_client.return_value = client
+    retry.begin(None)
+    start = time.time()
+    try:
+        handler.get_all_lic_names('bucket', 'prefix/license/')
+        assert(False)
+    except retry.DeadlineExceeded:
+        assert(False)
+    except Exception as e:
+        assert('get license name from s3 error!' == str(e))
+    assert(time.time() - start < 0.5)
+    assert(1 == client.get_paginator.return_value.paginate.call_count)
+    print()
+
+
+if '__main__' == __name__:
+    os.environ['LICENSE_MANIFEST'] = ''
+    test_classify()
+    test_policy()
+    test_deadline_stops_retries()
+    test_run_until()
+    test_find_ami_fails_before_timeout()
+    test_license_listing_fatal_fails_fast()
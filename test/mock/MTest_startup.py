@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import bench_startup
+
+# budgets for one cold start, a few times what a laptop measures so slow CI
+# machines pass while a module level boto3 import (~200ms) does not
+IMPORT_BUDGET_MS = 120
+FIRST_CALL_BUDGET_MS = 1000
+
+def check(module):
+    result = bench_startup.measure(module, runs=1)
+    print('%s: %s' % (module, result))
+    assert(not result['boto3'] and not result['botocore'])
+    assert(result['import_ms'] < IMPORT_BUDGET_MS)
+    assert(result['first_call_ms'] < FIRST_CALL_BUDGET_MS)
+
+def test_license_handler_startup():
+    print('Test: license handler imports without boto3 and within budget')
+    check('handler')
+    print()
+
+def test_find_ami_startup():
+    print('Test: find_ami imports without boto3, a Delete never loads it')
+    check('find_ami')
+    print()
+
+def test_validate_lambda_startup():
+    print('Test: validate_lambda needs neither boto3 nor botocore.vendored.requests')
+    check('validate_lambda')
+    print()
+
+
+if '__main__' == __name__:
+    test_license_handler_startup()
+    test_find_ami_startup()
+    test_validate_lambda_startup()
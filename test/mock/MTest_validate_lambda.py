@@ -35,27 +35,72 @@ def get_default_context():
     context.log_stream_name = 'fake_log_stream_name'
     return context
 
-def mock_requests_put(*args, **kvargs):
-    print('hello mock requests put')
-    print(args, kvargs)
-    mock = Mock()
-    mock.reason = 'no error'
-    return mock
-
-@patch('validate_lambda.requests')
-def test_byol_cnt(mock_requests):
+@patch('cfn_response.send')
+def test_byol_cnt(mock_send):
     print('Test: BYOL Count should >= 0')
-    mock_requests.put = mock_requests_put
     event = get_default_event()
     context = get_default_context()
     rpt = get_default_rpt()
     event['ResourceProperties'] = rpt
     rpt['FortiWebAsgCapacityBYOL'] = -1
     ret = validate_lambda.handler(event, context)
+    assert('FAILED' == mock_send.call_args[0][2])
+    print()
+
+@patch('cfn_response.send')
+def test_valid_and_rules(mock_send):
+    print('Test: a valid set passes, each broken rule is reported by id')
+    event = get_default_event()
+    event['ResourceProperties'] = get_default_rpt()
+    validate_lambda.handler(event, get_default_context())
+    assert('SUCCESS' == mock_send.call_args[0][2])
+    assert('LATEST' == mock_send.call_args[0][3]['FortiWebVersionInternal'])
+    rpt = get_default_rpt()
+    rpt['FortiWebAsgMaxSizeOnDemand'] = 15
+    rpt['FortiWebAsgScaleInThreshold'] = 90
+    rpt['FortiWebElasticIP'] = '1.1.1.300'
+    errors = validate_lambda.validate_properties(rpt)
+    assert(['instance_cap', 'threshold_order', 'existing_eip_is_ip'] == [e['rule'] for e in errors])
+    rpt = get_default_rpt()
+    rpt['FortiWebAsgMinSizeOnDemand'] = 'one'
+    del rpt['FortiWebElasticIP']
+    errors = validate_lambda.validate_properties(rpt)
+    assert(['type', 'required'] == [e['rule'] for e in errors])
+    #the old positional api keeps its message format
+    msg = validate_lambda.validate_parameters(0, 1, 1, 1, 25, 80, 'yes', 'my-eip')
+    assert('no error' == msg)
+    print()
+
+def test_lint_batch():
+    print('Test: lint validates JSONL parameter sets in worker processes')
+    import json
+    import tempfile
+    good = get_default_rpt()
+    bad = dict(good, FortiWebAsgCapacityBYOL=20)
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+        for i in range(200):
+            f.write(json.dumps(bad if 0 == i % 50 else good) + '\n')
+        f.write('{not json\n')
+        path = f.name
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump([{'ParameterKey': k, 'ParameterValue': str(v)} for k, v in good.items()], f)
+        cfn_path = f.name
+    results = validate_lambda.lint([path, cfn_path], jobs=2)
+    os.unlink(path)
+    os.unlink(cfn_path)
+    assert(202 == len(results))
+    invalid = [r for r in results if not r['valid']]
+    assert(5 == len(invalid))
+    assert('%s:1' % (path) == invalid[0]['source'])
+    assert('instance_cap' == invalid[0]['errors'][0]['rule'])
+    assert('parse' == invalid[-1]['errors'][0]['rule'])
+    assert(results[-1]['valid'])
     print()
 
 
 if '__main__' == __name__:
     test_byol_cnt()
+    test_valid_and_rules()
+    test_lint_batch()
 
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# In-process stand-in for the AWS calls made by the license lambda: the S3
+# license listing, the DynamoDB conditional writes / reads of both record
+# layouts and the autoscaling / EC2 describes. Every call can be slowed down by a
+# configurable latency so allocation changes can be measured offline.
+#
+#   aws = fake_aws.FakeAws(latency_ms=5)
+#   aws.add_licenses('prefix/license/', 100)
+#   aws.add_instances('asg-byol', ['i-1', 'i-2'])
+#   with patch('aws_clients.get_client', aws.get_client): ...
+import io
+import re
+import json
+import hashlib
+import time
+import random
+import threading
+from botocore.exceptions import ClientError
+
+def client_error(code, operation, **extra):
+    response = {'Error': {'Code': code, 'Message': code}}
+    response.update(extra)
+    return ClientError(response, operation)
+
+def etag(body, sse_kms=False):
+    # single part S3 objects: quoted content MD5, under SSE-KMS no content hash
+    if sse_kms:
+        return '"%s"' % (hashlib.md5(b'kms:' + body).hexdigest())
+    return '"%s"' % (hashlib.md5(body).hexdigest())
+
+class FakePaginator(object):
+    def __init__(self, fn):
+        self.fn = fn
+    def paginate(self, **kwargs):
+        return self.fn(**kwargs)
+
+class FakeService(object):
+    def __init__(self, aws):
+        self.aws = aws
+    def get_paginator(self, name):
+        return FakePaginator(getattr(self, 'paginate_' + name))
+
+class FakeS3(FakeService):
+    def paginate_list_objects_v2(self, Bucket, Prefix='', PageSize=1000, **kwargs):
+        self.aws.call('s3', 'list_objects_v2')
+        keys = sorted(k for (b, k) in self.aws.objects if b == Bucket and k.startswith(Prefix))
+        if len(keys) <= 0:
+            yield {'KeyCount': 0}
+        for start in range(0, len(keys), PageSize):
+            if start > 0:
+                self.aws.call('s3', 'list_objects_v2')
+            yield {'Contents': [{'Key': k, 'ETag': etag(self.aws.objects[(Bucket, k)], self.aws.sse_kms),
+                'Size': len(self.aws.objects[(Bucket, k)])} for k in keys[start:start + PageSize]]}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.aws.call('s3', 'get_object')
+        if (Bucket, Key) not in self.aws.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        body = self.aws.objects[(Bucket, Key)]
+        if None != IfNoneMatch and IfNoneMatch == etag(body):
+            raise client_error('304', 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag(body), 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.aws.call('s3', 'head_object')
+        if (Bucket, Key) not in self.aws.objects:
+            raise client_error('404', 'HeadObject')
+        body = self.aws.objects[(Bucket, Key)]
+        return {'ETag': etag(body, self.aws.sse_kms), 'ContentLength': len(body),
+            'Metadata': dict(self.aws.metadata.get((Bucket, Key), {}))}
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        self.aws.call('s3', 'put_object')
+        if isinstance(Body, str):
+            Body = Body.encode()
+        self.aws.objects[(Bucket, Key)] = bytes(Body)
+        self.aws.metadata[(Bucket, Key)] = dict(Metadata or {})
+        return {'ETag': etag(Body, self.aws.sse_kms)}
+
+class FakeDynamoDB(FakeService):
+    # only the expressions the license lambda really sends are understood
+
+    def items(self, table):
+        return self.aws.tables.setdefault(table, {})
+
+    def get_item(self, TableName, Key, ConsistentRead=False, **kwargs):
+        self.aws.call('dynamodb', 'get_item')
+        with self.aws.lock:
+            item = self.items(TableName).get(Key['assigned_records']['S'])
+            if None == item:
+                return {}
+            return {'Item': json.loads(json.dumps(item))}
+
+    def batch_get_item(self, RequestItems):
+        self.aws.call('dynamodb', 'batch_get_item')
+        responses = {}
+        with self.aws.lock:
+            for table, request in RequestItems.items():
+                items = self.items(table)
+                responses[table] = [json.loads(json.dumps(items[k['assigned_records']['S']]))
+                    for k in request['Keys'] if k['assigned_records']['S'] in items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+            ConditionExpression=None, **kwargs):
+        self.aws.call('dynamodb', 'update_item')
+        values = ExpressionAttributeValues
+        with self.aws.lock:
+            items = self.items(TableName)
+            key = Key['assigned_records']['S']
+            item = items.setdefault(key, {'assigned_records': {'S': key}})
+            if 'inst_lic_pair' not in UpdateExpression:
+                return self.update_numbers(item, UpdateExpression, values, ConditionExpression)
+            current = set(item.get('inst_lic_pair', {}).get('SS', []))
+            if None != ConditionExpression and not self.check(ConditionExpression, values, current):
+                self.aws.conflicts += 1
+                raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+            action, _, rest = UpdateExpression.partition(' ')
+            attr, value_name = rest.split()[:2]
+            if 'inst_lic_pair' == attr:
+                if 'ADD' == action:
+                    current |= set(values[value_name]['SS'])
+                elif 'DELETE' == action:
+                    current -= set(values[value_name]['SS'])
+                item['inst_lic_pair'] = {'SS': sorted(current)}
+        return {}
+
+    def update_numbers(self, item, expression, values, condition):
+        # 'ADD <attr> :<value> SET <attr> = :<value>' on number attributes, with an
+        # optional '[attribute_not_exists(<attr>) OR ]<attr> = :<value>' condition
+        if None != condition:
+            ok = False
+            for clause in condition.split(' OR '):
+                clause = clause.strip()
+                if clause.startswith('attribute_not_exists('):
+                    ok = ok or clause[len('attribute_not_exists('):-1] not in item
+                else:
+                    attr, value_name = [x.strip() for x in clause.split('=')]
+                    ok = ok or item.get(attr) == values[value_name]
+            if not ok:
+                self.aws.conflicts += 1
+                raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+        for action in re.findall(r'(ADD|SET) (\w+) =? ?(:\w+)', expression):
+            verb, attr, value_name = action
+            value = int(values[value_name]['N'])
+            if 'ADD' == verb:
+                value += int(item.get(attr, {'N': '0'})['N'])
+            item[attr] = {'N': str(value)}
+        return {'Attributes': json.loads(json.dumps(item))}
+
+    def check(self, expression, values, current):
+        for clause in expression.split(' AND '):
+            clause = clause.strip()
+            negate = clause.startswith('not ')
+            if negate:
+                clause = clause[4:]
+            name = clause[clause.index(',') + 1:clause.index(')')].strip()
+            found = values[name]['S'] in current
+            if found == negate:
+                return False
+        return True
+
+    def transact_write_items(self, TransactItems):
+        self.aws.call('dynamodb', 'transact_write_items')
+        with self.aws.lock:
+            reasons = []
+            for t in TransactItems:
+                op, body = list(t.items())[0]
+                items = self.items(body['TableName'])
+                if 'Put' == op:
+                    key = body['Item']['assigned_records']['S']
+                    ok = key not in items
+                else:
+                    key = body['Key']['assigned_records']['S']
+                    ok = self.check_equal(items.get(key), body)
+                reasons.append({'Code': 'None' if ok else 'ConditionalCheckFailed'})
+            if any('None' != r['Code'] for r in reasons):
+                self.aws.conflicts += 1
+                raise client_error('TransactionCanceledException', 'TransactWriteItems',
+                        CancellationReasons=reasons)
+            for t in TransactItems:
+                op, body = list(t.items())[0]
+                items = self.items(body['TableName'])
+                if 'Put' == op:
+                    items[body['Item']['assigned_records']['S']] = json.loads(json.dumps(body['Item']))
+                else:
+                    items.pop(body['Key']['assigned_records']['S'], None)
+        return {}
+
+    def check_equal(self, item, body):
+        # '<attr> = :<value>' conditions of Delete
+        if None == item:
+            return False
+        if 'ConditionExpression' not in body:
+            return True
+        attr, value_name = [x.strip() for x in body['ConditionExpression'].split('=')]
+        return item.get(attr) == body['ExpressionAttributeValues'][value_name]
+
+    def paginate_scan(self, TableName, FilterExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self.aws.call('dynamodb', 'scan')
+        with self.aws.lock:
+            items = [json.loads(json.dumps(i)) for i in self.items(TableName).values()]
+        if None != FilterExpression:
+            prefix = ExpressionAttributeValues[':prefix']['S']
+            items = [i for i in items if i['assigned_records']['S'].startswith(prefix)]
+        yield {'Items': items}
+
+class FakeAutoScaling(FakeService):
+    def describe_auto_scaling_instances(self, InstanceIds, **kwargs):
+        self.aws.call('autoscaling', 'describe_auto_scaling_instances')
+        return {'AutoScalingInstances': [
+            {'InstanceId': i, 'AutoScalingGroupName': self.aws.instances[i],
+                'LifecycleState': self.aws.lifecycle_states.get(i, 'InService')}
+            for i in InstanceIds if i in self.aws.instances]}
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames, **kwargs):
+        self.aws.call('autoscaling', 'describe_auto_scaling_groups')
+        groups = []
+        for name in AutoScalingGroupNames:
+            groups.append({'AutoScalingGroupName': name, 'Instances': [
+                {'InstanceId': i} for i, g in sorted(self.aws.instances.items()) if g == name]})
+        return {'AutoScalingGroups': groups}
+
+class FakeEC2(FakeService):
+    def paginate_describe_instances(self, Filters=None, **kwargs):
+        self.aws.call('ec2', 'describe_instances')
+        wanted = Filters[0]['Values'] if Filters else list(self.aws.instances)
+        instances = [{'InstanceId': i, 'State': {'Name': 'running'}} for i in wanted if i in self.aws.instances]
+        yield {'Reservations': [{'Instances': instances}]}
+
+class FakeAws(object):
+    def __init__(self, latency_ms=0, jitter_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.lock = threading.RLock()
+        self.objects = {}
+        #user metadata of the objects, and whether ETags look like SSE-KMS ones
+        self.metadata = {}
+        self.sse_kms = False
+        self.tables = {}
+        self.instances = {}
+        self.lifecycle_states = {}
+        self.calls = {}
+        self.conflicts = 0
+        self.services = {
+            's3': FakeS3(self),
+            'dynamodb': FakeDynamoDB(self),
+            'autoscaling': FakeAutoScaling(self),
+            'ec2': FakeEC2(self),
+        }
+
+    def get_client(self, service_name, *args, **kwargs):
+        return self.services[service_name]
+
+    def call(self, service, operation):
+        with self.lock:
+            name = service + '.' + operation
+            self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def add_licenses(self, lic_dir_path, count, bucket='fake-S3Bucket'):
+        for i in range(count):
+            self.objects[(bucket, '%slic%d.lic' % (lic_dir_path, i))] = b'license %d' % (i)
+
+    def add_instances(self, asg_name, instance_ids):
+        for i in instance_ids:
+            self.instances[i] = asg_name
+
+    def terminate(self, instance_id):
+        self.instances.pop(instance_id, None)
+
+    def assignments(self, table):
+        # instance -> license from whichever layout holds records
+        pairs = {}
+        double = []
+        for key, item in self.tables.get(table, {}).items():
+            if 'total_records' == key:
+                for record in item.get('inst_lic_pair', {}).get('SS', []):
+                    if '=|fwb|=' in record:
+                        instance_id, lic_name = record.split('=|fwb|=', 1)
+                        pairs[instance_id] = lic_name
+            elif key.startswith('instance#'):
+                pairs[item['instance_id']['S']] = item['lic_name']['S']
+        seen = {}
+        for instance_id, lic_name in pairs.items():
+            if lic_name in seen:
+                double.append((lic_name, seen[lic_name], instance_id))
+            seen[lic_name] = instance_id
+        return pairs, double